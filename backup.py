@@ -1,30 +1,123 @@
 """Back up the flashcards and send them by email."""
 
+import base64
 import datetime as dt
+import math
 import os
+import re
 import smtplib
+import ssl
 import sys
 import tempfile
-from email import encoders
+import time
+import tracemalloc
+from collections.abc import Iterator
+from dataclasses import dataclass
 from email.mime.base import MIMEBase
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
+from email.policy import SMTP
 from pathlib import Path
+from typing import BinaryIO
 from zoneinfo import ZoneInfo
 
+from backup_store import KEEP, BackupStore, default_store_dir
+from collection_service import CollectionClient, open_collection
+from delta import BackupState, write_delta, write_full_backup
 from progress import Progress
-from utils import CollectionWrapper
+from utils import CollectionWrapper, cache_dir, export_format_flag, format_size
 
+# size of the chunks of the attachment that are read and encoded at once
+# (57 bytes of data give a 76 characters base64 line)
+CHUNK_SIZE = 57 * 1024
+# the attachment is replaced by this marker when the rest of the message is generated
+ATTACHMENT_MARKER = b"@@ATTACHMENT@@"
+# maximum size of an email, including the encoded attachment (`SMTP_MAX_SIZE`, defaults to 25 MB which is the
+# limit of most servers); the server limit is used instead if it is lower
+MAX_EMAIL_SIZE = int(os.getenv("SMTP_MAX_SIZE", "25000000"))
+# space kept for the headers and the text of the email
+HEADERS_SIZE = 64 * 1024
 
-def send_email_with_attachment(  # noqa: PLR0913, PLR0917
-    sender_email: str,
-    sender_password: str,
-    recipient_email: str,
-    subject: str,
-    body: str,
-    attachment_path: Path,
-) -> None:
-    """Send an email with an attachment."""
+# only send the changes since the previous backup (and a full backup every `BACKUP_FULL_EVERY` days)
+DIFFERENTIAL = "--differential" in sys.argv
+# make a full backup even if the previous one is recent enough
+FULL = "--full" in sys.argv
+# number of days between two full backups in differential mode
+FULL_BACKUP_EVERY = float(os.getenv("BACKUP_FULL_EVERY", "7"))
+
+# also keep the backup in the local backup store (`--store` or `--store=PATH`, see `backup_store.py`)
+STORE = next(
+    (Path(arg.removeprefix("--store=")) for arg in sys.argv if arg.startswith("--store=")),
+    default_store_dir if "--store" in sys.argv else None,
+)
+
+# format of the backup package when it is not differential (`--backup-format=legacy|latest`, see `EXPORT_FORMATS`)
+BACKUP_FORMAT = export_format_flag("backup-format")
+
+backup_state_file = cache_dir / "backup_state.json"
+
+IMPORT_INSTRUCTIONS = """\
+When importing the file, remember to check:
+- Import any learning progress
+- Import any deck presets
+"""
+FULL_INSTRUCTIONS = """\
+This is a full backup: importing it in Anki replaces the whole collection.
+The next backups only contain the changes since this one.
+"""
+DELTA_INSTRUCTIONS = """\
+This backup only contains the changes since the previous one. To rebuild the collection, download the full backup
+({base}) and all the following backups, then run:
+
+    python restore.py {base} export_*.delta.zip
+
+and import the restored collection in Anki.
+"""
+
+
+@dataclass
+class TransferReport:
+    """Statistics about the emails sent by `send_email_with_attachment`."""
+
+    parts: int = 0
+    size: int = 0
+    duration: float = 0
+    peak_memory: int = 0
+
+    def __str__(self) -> str:
+        """Return a human readable summary of the transfer."""
+        speed = self.size / self.duration if self.duration else 0
+        return (
+            f"{self.parts} email(s), {format_size(self.size)} sent in {self.duration:.1f} s "
+            f"({format_size(speed)}/s), peak memory: {format_size(self.peak_memory)}"
+        )
+
+
+def encode_attachment(file: BinaryIO, length: int) -> Iterator[bytes]:
+    """Read `length` bytes of `file` chunk by chunk and yield them encoded in base64 (with CRLF line endings)."""
+    while length > 0:
+        chunk = file.read(min(CHUNK_SIZE, length))
+        if not chunk:
+            break
+        length -= len(chunk)
+        yield base64.encodebytes(chunk).replace(b"\n", b"\r\n")
+
+
+def encoded_size(length: int) -> int:
+    """Return the size of `length` bytes encoded by `encode_attachment`."""
+    lines, rest = divmod(length, 57)
+    return lines * 78 + (math.ceil(rest / 3) * 4 + 2 if rest else 0)
+
+
+def part_size(max_email_size: int) -> int:
+    """Return the maximum number of bytes of the attachment that can be sent in an email of `max_email_size` bytes."""
+    return max(57, (max_email_size - HEADERS_SIZE) // 78 * 57)
+
+
+def build_message(
+    sender_email: str, recipient_email: str, subject: str, body: str, filename: str
+) -> tuple[bytes, bytes]:
+    """Return the parts of an email before and after the content of the attachment (which is streamed separately)."""
     msg = MIMEMultipart()
     msg["From"] = sender_email
     msg["To"] = recipient_email
@@ -33,42 +126,224 @@ def send_email_with_attachment(  # noqa: PLR0913, PLR0917
     msg.attach(MIMEText(body, "plain"))
 
     attachment = MIMEBase("application", "octet-stream")
-    attachment.set_payload(attachment_path.read_bytes())
-    encoders.encode_base64(attachment)
-    attachment.add_header("Content-Disposition", f"attachment; filename={attachment_path.name}")
+    attachment["Content-Transfer-Encoding"] = "base64"
+    attachment.add_header("Content-Disposition", "attachment", filename=filename)
+    attachment.set_payload(ATTACHMENT_MARKER.decode())
     msg.attach(attachment)
 
-    with smtplib.SMTP_SSL(os.getenv("SMTP_SERVER", ""), int(os.getenv("SMTP_PORT", "465"))) as server:
-        server.login(sender_email, sender_password)
-        server.send_message(msg)
+    head, tail = msg.as_bytes(policy=SMTP).split(ATTACHMENT_MARKER)
+    # lines starting with a dot must be escaped ("dot-stuffing"), this never happens in base64
+    return re.sub(rb"(?m)^\.", b"..", head), re.sub(rb"(?m)^\.", b"..", tail)
+
+
+def send_streaming(  # noqa: PLR0913, PLR0917
+    server: smtplib.SMTP,
+    sender_email: str,
+    recipient_email: str,
+    message: tuple[bytes, bytes],
+    file: BinaryIO,
+    length: int,
+) -> int:
+    """
+    Send an email whose attachment is read from `file` while it is being sent. Return the size of the email.
+
+    Raises:
+        smtplib.SMTPSenderRefused: if the server refused the sender.
+        smtplib.SMTPRecipientsRefused: if the server refused the recipient.
+        smtplib.SMTPDataError: if the server refused the email.
+
+    """
+    head, tail = message
+    size = len(head) + encoded_size(length) + len(tail)
+    options = [f"SIZE={size}"] if server.has_extn("size") else []
+
+    code, resp = server.mail(sender_email, options)
+    if code != 250:  # noqa: PLR2004
+        server.rset()
+        raise smtplib.SMTPSenderRefused(code, resp, sender_email)
+    code, resp = server.rcpt(recipient_email)
+    if code not in {250, 251}:
+        server.rset()
+        raise smtplib.SMTPRecipientsRefused({recipient_email: (code, resp)})
+    code, resp = server.docmd("data")
+    if code != 354:  # noqa: PLR2004
+        raise smtplib.SMTPDataError(code, resp)
 
+    server.send(head)
+    for chunk in encode_attachment(file, length):
+        server.send(chunk)
+    server.send(tail + b".\r\n")
 
-wrapper = CollectionWrapper()
-if "--no-sync" not in sys.argv:
-    with Progress("Syncing"):
-        wrapper.sync()
+    code, resp = server.getreply()
+    if code != 250:  # noqa: PLR2004
+        raise smtplib.SMTPDataError(code, resp)
+    return size
 
-with tempfile.TemporaryDirectory() as export_dir:
-    with Progress("Exporting all the collection"):
-        output_file = wrapper.export(None, export_dir, full_backup=True)
 
-    now = dt.datetime.now().astimezone(ZoneInfo("Europe/Paris"))
-    date = now.strftime("%d/%m/%Y %H:%M:%S")
-    date_filename = now.strftime("%Y-%m-%d_%H-%M-%S")
-    output_file = output_file.rename(output_file.parent / f"export_{date_filename}.apkg")
+def connect() -> smtplib.SMTP:
+    """
+    Connect to the SMTP server (`SMTP_SERVER` and `SMTP_PORT`), with SSL on port 465.
 
-    with Progress("Sending email"):
-        send_email_with_attachment(
-            os.environ.get("ANKIWEB_EMAIL", ""),
-            os.environ.get("EMAIL_PASSWORD", ""),
-            os.environ.get("ANKIWEB_EMAIL", ""),
-            f"Flashcards backup {date}",
-            f"""\
+    On the other ports, the connection is upgraded with STARTTLS if the server supports it, and stays in clear text
+    otherwise (e.g. a local relay on port 25, see `login`).
+    """
+    host = os.getenv("SMTP_SERVER", "")
+    port = int(os.getenv("SMTP_PORT", "465"))
+    if port == 465:  # noqa: PLR2004
+        return smtplib.SMTP_SSL(host, port)
+    server = smtplib.SMTP(host, port)
+    server.ehlo()
+    if server.has_extn("starttls"):
+        server.starttls()
+        server.ehlo()
+    return server
+
+
+def login(server: smtplib.SMTP, email: str, password: str) -> None:
+    """
+    Log in to the SMTP server if it requires it.
+
+    The password is never sent in clear text: logging in fails if the connection is not encrypted, unless
+    `SMTP_INSECURE=1` is set (e.g. for a local test server).
+
+    Raises:
+        smtplib.SMTPNotSupportedError: if the server requires a login on a connection that is not encrypted.
+
+    """
+    server.ehlo_or_helo_if_needed()
+    if not password or not server.has_extn("auth"):
+        return
+    if not isinstance(server.sock, ssl.SSLSocket) and os.getenv("SMTP_INSECURE") != "1":
+        msg = "The SMTP server doesn't support STARTTLS (set SMTP_INSECURE=1 to send the password in clear text)"
+        raise smtplib.SMTPNotSupportedError(msg)
+    server.login(email, password)
+
+
+def send_email_with_attachment(  # noqa: PLR0913, PLR0917
+    sender_email: str,
+    sender_password: str,
+    recipient_email: str,
+    subject: str,
+    body: str,
+    attachment_path: Path,
+) -> TransferReport:
+    """
+    Send an email with an attachment.
+
+    The attachment is encoded while it is sent, so it is never fully loaded in memory. If the email would be bigger
+    than `MAX_EMAIL_SIZE` (or the limit of the server), the attachment is split into several parts that are sent in
+    separate emails.
+    """
+    report = TransferReport()
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        with connect() as server, attachment_path.open("rb") as file:
+            login(server, sender_email, sender_password)
+
+            max_size = MAX_EMAIL_SIZE
+            if server_max_size := int(server.esmtp_features.get("size") or 0):
+                max_size = min(max_size, server_max_size)
+
+            total = attachment_path.stat().st_size
+            size = part_size(max_size)
+            count = max(1, math.ceil(total / size))
+
+            for index in range(count):
+                filename, part_subject, part_body = attachment_path.name, subject, body
+                if count > 1:
+                    filename = f"{attachment_path.name}.{index + 1:03}"
+                    part_subject = f"{subject} ({index + 1}/{count})"
+                    part_body = f"""\
+{body}
+The backup is split into {count} emails. Download all the parts and join them:
+- Windows: copy /b {attachment_path.name}.* {attachment_path.name}
+- macOS / Linux: cat {attachment_path.name}.* > {attachment_path.name}
+"""
+                message = build_message(sender_email, recipient_email, part_subject, part_body, filename)
+                report.size += send_streaming(
+                    server, sender_email, recipient_email, message, file, min(size, total - index * size)
+                )
+                report.parts += 1
+
+        report.duration = time.perf_counter() - start
+        report.peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        # tracing slows down the whole process (e.g. the documentation built at the same time by `run.py`)
+        tracemalloc.stop()
+    return report
+
+
+def export_backup(
+    wrapper: CollectionWrapper | CollectionClient, export_dir: Path, date_filename: str, state: BackupState | None
+) -> tuple[Path, str, str]:
+    """
+    Export the backup. Return the exported file, the kind of backup (for the subject) and the instructions.
+
+    In differential mode (when `state` is given), only the changes since the previous backup are exported, unless a
+    full backup is needed.
+    """
+    if state is None:
+        start = time.perf_counter()
+        with Progress(f"Exporting all the collection ({BACKUP_FORMAT} format)"):
+            output_file = wrapper.export(None, export_dir, full_backup=True, legacy=BACKUP_FORMAT == "legacy")
+        print(f"{format_size(output_file.stat().st_size)} exported in {time.perf_counter() - start:.1f} s")
+        output_file = output_file.rename(output_file.parent / f"export_{date_filename}.apkg")
+        return output_file, "", IMPORT_INSTRUCTIONS
+
+    if FULL or state.needs_full(FULL_BACKUP_EVERY):
+        with Progress("Exporting a full backup of the collection"):
+            output_file = write_full_backup(wrapper, export_dir / f"export_{date_filename}.colpkg", state)
+        return output_file, " (full)", FULL_INSTRUCTIONS
+
+    with Progress(f"Exporting the changes since {state.base}"):
+        output_file = write_delta(wrapper, export_dir / f"export_{date_filename}.delta.zip", state)
+    return output_file, f" (delta {state.sequence})", DELTA_INSTRUCTIONS.format(base=state.base)
+
+
+def main(wrapper: CollectionWrapper | CollectionClient) -> None:
+    """Back up the (already synced) collection and send it by email."""
+    if STORE:
+        store = BackupStore(STORE)
+        with Progress("Adding the backup to the local store"):
+            store.add_collection(wrapper)
+        print(store.summary())
+        with Progress("Pruning the local store"):
+            store.prune(KEEP)
+
+    with tempfile.TemporaryDirectory() as export_dir:
+        now = dt.datetime.now().astimezone(ZoneInfo("Europe/Paris"))
+        date = now.strftime("%d/%m/%Y %H:%M:%S")
+        date_filename = now.strftime("%Y-%m-%d_%H-%M-%S")
+        state = BackupState(backup_state_file) if DIFFERENTIAL else None
+        output_file, kind, instructions = export_backup(wrapper, Path(export_dir), date_filename, state)
+
+        with Progress("Sending email"):
+            report = send_email_with_attachment(
+                os.environ.get("ANKIWEB_EMAIL", ""),
+                os.environ.get("EMAIL_PASSWORD", ""),
+                os.environ.get("ANKIWEB_EMAIL", ""),
+                f"Flashcards backup {date}{kind}",
+                f"""\
 The flashcards backup for {date} is attached.
 
-When importing the file, remember to check:
-- Import any learning progress
-- Import any deck presets
-""",
-            output_file,
-        )
+{instructions}""",
+                output_file,
+            )
+        print(report)
+
+        if state:
+            # the state is only saved once the backup is sent, so the next delta contains the changes of this one
+            # if it failed
+            with Progress("Saving the backup state"):
+                state.save()
+
+
+if __name__ == "__main__":
+    # use the collection service if it is running
+    wrapper = open_collection()
+    if "--no-sync" not in sys.argv:
+        with Progress("Syncing"):
+            wrapper.sync()
+
+    main(wrapper)
@@ -0,0 +1,320 @@
+"""
+Local backup store that only keeps one copy of the data shared by several backups.
+
+The collection and the media files are split into content-defined chunks (so inserting or removing data only changes
+the chunks around it), which are compressed and stored by hash. Each backup is a small JSON file that lists the chunks
+of each file.
+
+Usage: `python backup_store.py [--store PATH] list|prune|verify|restore BACKUP OUTPUT_DIR`
+(backups are added by `backup.py --store`).
+"""
+
+import argparse
+import datetime as dt
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import zlib
+from collections.abc import Callable, Iterator
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, BinaryIO
+
+import numpy as np
+
+from progress import Progress
+from utils import CollectionWrapper, format_size
+
+if TYPE_CHECKING:
+    from collection_service import CollectionClient
+
+# size of the blocks that are read from the files (the rolling hash of a block needs about 24 bytes of memory per byte)
+BLOCK_SIZE = 1024 * 1024
+# minimum, average (a power of 2) and maximum size of a chunk
+MIN_CHUNK_SIZE = 4 * 1024
+AVERAGE_CHUNK_SIZE = 16 * 1024
+MAX_CHUNK_SIZE = 64 * 1024
+# number of bytes used to compute the rolling hash
+WINDOW_SIZE = 64
+# random value of each byte for the rolling hash (it must never change, otherwise the chunks would change)
+GEAR = np.random.default_rng(0x616E6B69).integers(0, 2**64, 256, dtype=np.uint64)
+
+# default location of the store
+default_store_dir = Path(os.getenv("BACKUP_STORE") or Path(__file__).parent / "backups")
+# number of daily, weekly and monthly backups to keep
+KEEP = {
+    "daily": int(os.getenv("BACKUP_KEEP_DAILY", "7")),
+    "weekly": int(os.getenv("BACKUP_KEEP_WEEKLY", "4")),
+    "monthly": int(os.getenv("BACKUP_KEEP_MONTHLY", "12")),
+}
+PERIODS: dict[str, Callable[[dt.datetime], object]] = {
+    "daily": lambda date: date.date(),
+    "weekly": lambda date: date.isocalendar()[:2],
+    "monthly": lambda date: (date.year, date.month),
+}
+
+
+def chunk_boundaries(data: bytes) -> list[int]:
+    """Return the positions where `data` can be cut (where the rolling hash of the previous bytes matches)."""
+    sums = np.zeros(len(data) + 1, np.uint64)
+    np.cumsum(GEAR[np.frombuffer(data, dtype=np.uint8)], dtype=np.uint64, out=sums[1:])
+    # sum of the values of the `WINDOW_SIZE` bytes that end at each position (the overflows are expected)
+    hashes = sums[WINDOW_SIZE:] - sums[:-WINDOW_SIZE]
+    hashes &= np.uint64(AVERAGE_CHUNK_SIZE - 1)
+    return (np.flatnonzero(hashes == 0) + WINDOW_SIZE).tolist()
+
+
+def split_chunks(file: BinaryIO) -> Iterator[bytes]:
+    """Split a file into content-defined chunks while it is read."""
+    buffer = b""
+    eof = False
+    while not eof:
+        block = file.read(BLOCK_SIZE)
+        eof = not block
+        buffer += block
+        start = 0
+        boundaries = iter(chunk_boundaries(buffer))
+        boundary = next(boundaries, None)
+        while len(buffer) - start >= MAX_CHUNK_SIZE or (eof and start < len(buffer)):
+            while boundary is not None and boundary < start + MIN_CHUNK_SIZE:
+                boundary = next(boundaries, None)
+            end = min(boundary or len(buffer), start + MAX_CHUNK_SIZE, len(buffer))
+            yield buffer[start:end]
+            start = end
+        buffer = buffer[start:]
+
+
+class BackupStore:
+    """A folder that contains the compressed chunks (`chunks/`) and the list of the chunks of each backup."""
+
+    def __init__(self, path: Path) -> None:
+        """Create a `BackupStore` in `path`."""
+        self.path = path
+        self.chunks_dir = path / "chunks"
+        self.backups_dir = path / "backups"
+        self.added = 0
+        self.added_size = 0
+        self.total_size = 0
+
+    def chunk_file(self, digest: str) -> Path:
+        """Return the path of a chunk."""
+        return self.chunks_dir / digest[:2] / digest
+
+    def add_chunk(self, data: bytes) -> str:
+        """Store a chunk (if it doesn't exist yet) and return its hash."""
+        digest = hashlib.sha256(data).hexdigest()
+        file = self.chunk_file(digest)
+        self.total_size += len(data)
+        if not file.exists():
+            file.parent.mkdir(parents=True, exist_ok=True)
+            compressed = zlib.compress(data)
+            tmp = file.with_suffix(".tmp")
+            tmp.write_bytes(compressed)
+            tmp.replace(file)
+            self.added += 1
+            self.added_size += len(compressed)
+        return digest
+
+    def read_chunk(self, digest: str) -> bytes:
+        """
+        Return the content of a chunk.
+
+        Raises:
+            ValueError: if the chunk is corrupted.
+
+        """
+        try:
+            data = zlib.decompress(self.chunk_file(digest).read_bytes())
+        except zlib.error as err:
+            msg = f"Chunk {digest} is corrupted"
+            raise ValueError(msg) from err
+        if hashlib.sha256(data).hexdigest() != digest:
+            msg = f"Chunk {digest} is corrupted"
+            raise ValueError(msg)
+        return data
+
+    def backups(self) -> list[Path]:
+        """Return the backups, from the oldest to the newest."""
+        return sorted(self.backups_dir.glob("*.json"))
+
+    @staticmethod
+    def load(backup: Path) -> dict[str, Any]:
+        """Return the content of a backup."""
+        return json.loads(backup.read_text("utf-8"))
+
+    def add_backup(self, files: dict[str, Path]) -> Path:
+        """
+        Store the given files (keyed by their name in the backup) as a new backup. Return the path of the backup.
+
+        The files that have the same size and modification time as in the previous backup are not read again.
+        """
+        previous = self.load(self.backups()[-1])["files"] if self.backups() else {}
+        entries = {}
+        for name, file in files.items():
+            stat = file.stat()
+            old = previous.get(name)
+            if old and [old["size"], old["mtime_ns"]] == [stat.st_size, stat.st_mtime_ns]:
+                entries[name] = old
+                self.total_size += stat.st_size
+                continue
+            with file.open("rb") as f:
+                chunks = [self.add_chunk(chunk) for chunk in split_chunks(f)]
+            entries[name] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "chunks": chunks}
+
+        now = dt.datetime.now(dt.UTC)
+        backup = self.backups_dir / f"{now:%Y-%m-%d_%H-%M-%S}.json"
+        self.backups_dir.mkdir(parents=True, exist_ok=True)
+        tmp = backup.with_suffix(".tmp")
+        tmp.write_text(json.dumps({"time": now.timestamp(), "files": entries}), "utf-8")
+        tmp.replace(backup)
+        return backup
+
+    def add_collection(self, wrapper: "CollectionWrapper | CollectionClient") -> Path:
+        """Store a consistent copy of the collection and its media files as a new backup."""
+        media_dir = wrapper.media_dir()
+        with tempfile.TemporaryDirectory() as tmp:
+            snapshot = wrapper.snapshot(Path(tmp) / "collection.anki2")
+            # the snapshot is always a new file, so it must be read again even if it didn't change
+            files = {"collection.anki2": snapshot}
+            with os.scandir(media_dir) as entries:
+                files.update({
+                    f"collection.media/{entry.name}": Path(entry.path) for entry in entries if entry.is_file()
+                })
+            return self.add_backup(files)
+
+    def backups_to_keep(self, keep: dict[str, int]) -> set[Path]:
+        """Return the backups that must be kept: the newest one of each of the last days, weeks and months."""
+        # newest first
+        backups = [
+            (backup, dt.datetime.fromtimestamp(self.load(backup)["time"], dt.UTC))
+            for backup in reversed(self.backups())
+        ]
+        kept = {backup for backup, _ in backups[:1]}
+        for period, count in keep.items():
+            seen: set[object] = set()
+            for backup, date in backups:
+                key = PERIODS[period](date)
+                if key in seen:
+                    continue
+                if len(seen) >= count:
+                    break
+                seen.add(key)
+                kept.add(backup)
+        return kept
+
+    def prune(self, keep: dict[str, int]) -> tuple[int, int]:
+        """Remove the backups that must not be kept and the unused chunks. Return the number of removed items."""
+        kept = self.backups_to_keep(keep)
+        removed_backups = 0
+        for backup in self.backups():
+            if backup not in kept:
+                backup.unlink()
+                removed_backups += 1
+
+        used = {
+            digest for backup in kept for entry in self.load(backup)["files"].values() for digest in entry["chunks"]
+        }
+        removed_chunks = 0
+        for file in self.chunks_dir.glob("*/*"):
+            if file.name not in used:
+                file.unlink()
+                removed_chunks += 1
+        return removed_backups, removed_chunks
+
+    def verify(self) -> list[str]:
+        """Check that all the chunks used by the backups exist and are not corrupted. Return the errors."""
+        errors = []
+        # error of each chunk (the chunks shared by several backups are only checked once)
+        results: dict[str, str | None] = {}
+        for backup in self.backups():
+            for name, entry in self.load(backup)["files"].items():
+                for digest in entry["chunks"]:
+                    if digest not in results:
+                        try:
+                            self.read_chunk(digest)
+                        except FileNotFoundError:
+                            results[digest] = f"Chunk {digest} is missing"
+                        except (OSError, ValueError) as err:
+                            results[digest] = str(err)
+                        else:
+                            results[digest] = None
+                    if results[digest]:
+                        errors.append(f"{backup.stem}: {name}: {results[digest]}")
+        return errors
+
+    def restore(self, backup: Path, output_dir: Path) -> None:
+        """
+        Write the files of a backup in `output_dir`, chunk by chunk.
+
+        Raises:
+            ValueError: if a file is not restored correctly.
+
+        """
+        for name, entry in self.load(backup)["files"].items():
+            file = output_dir / name
+            file.parent.mkdir(parents=True, exist_ok=True)
+            with file.open("wb") as f:
+                for digest in entry["chunks"]:
+                    f.write(self.read_chunk(digest))
+            if file.stat().st_size != entry["size"]:
+                msg = f"{name} has not been restored correctly"
+                raise ValueError(msg)
+
+    def summary(self) -> str:
+        """Return a human readable summary of the last backup."""
+        return (
+            f"{format_size(self.total_size)} backed up, {self.added} new chunks ({format_size(self.added_size)} stored)"
+        )
+
+
+def main(argv: list[str]) -> int:
+    """Run the command given on the command line. Return the exit code."""
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--store", type=Path, default=default_store_dir, help="store location (default: %(default)s)")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("list", help="list the backups")
+    commands.add_parser("prune", help="remove the old backups according to the retention policy")
+    commands.add_parser("verify", help="check that the chunks of all the backups exist and are not corrupted")
+    restore = commands.add_parser("restore", help="restore a backup")
+    restore.add_argument("backup", help="name of the backup (see `list`), or `latest`")
+    restore.add_argument("output_dir", type=Path, help="folder where the collection is restored")
+    args = parser.parse_args(argv)
+
+    store = BackupStore(args.store)
+
+    if args.command == "list":
+        for backup in store.backups():
+            files = store.load(backup)["files"]
+            print(f"{backup.stem}: {len(files)} files, {format_size(sum(entry['size'] for entry in files.values()))}")
+
+    elif args.command == "prune":
+        with Progress("Pruning the backups"):
+            removed_backups, removed_chunks = store.prune(KEEP)
+        print(f"{removed_backups} backups and {removed_chunks} chunks removed")
+
+    elif args.command == "verify":
+        with Progress("Verifying the backups"):
+            errors = store.verify()
+        for error in errors:
+            print(error)
+        return int(bool(errors))
+
+    elif args.command == "restore":
+        try:
+            backup = store.backups()[-1] if args.backup == "latest" else store.backups_dir / f"{args.backup}.json"
+        except IndexError:
+            print(f"There is no backup in {store.path}")
+            return 1
+        try:
+            with Progress(f"Restoring {backup.stem}"):
+                store.restore(backup, args.output_dir)
+        except (OSError, ValueError) as err:
+            print(err)
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,399 @@
+"""
+Benchmark the slow stages of the build on a synthetic collection.
+
+Usage:
+- `python benchmark.py generate OUTPUT_DIR [--decks N] [--depth N] [--notes N] [--media N] [--media-size BYTES]`
+- `python benchmark.py run [--collection DIR | generator options] [-o RESULTS.json]`
+- `python benchmark.py compare OLD.json NEW.json`
+"""
+
+import argparse
+import contextlib
+import datetime as dt
+import json
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections.abc import Callable, Generator
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any
+
+from anki.buildinfo import version as anki_version
+from anki.collection import AddNoteRequest, Collection
+
+import export_and_build_docs
+from manifest import BuildManifest
+from media_mirror import MediaMirror
+from media_refs import MediaReferences
+from parallel_export import ParallelExporter
+from progress import Progress
+from review_stats import ReviewAnalytics
+from utils import CollectionWrapper, format_size
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+RESULTS_VERSION = 1
+
+
+@dataclass
+class GeneratorOptions:
+    """Size of a synthetic collection (the same options and seed always give the same content)."""
+
+    decks: int = 50
+    depth: int = 3
+    notes: int = 10_000
+    media: int = 200
+    media_size: int = 50 * 1024
+    seed: int = 0
+
+
+def deck_names(options: GeneratorOptions, rng: random.Random) -> list[str]:
+    """Return the names of the decks of a synthetic collection (each parent deck comes before its children)."""
+    names: list[str] = []
+    for i in range(options.decks):
+        # the deck is a top-level deck or the child of a deck that isn't too deep
+        parents = [name for name in names if name.count("::") < options.depth - 1]
+        parent = rng.choice([None, *parents])
+        names.append(f"{parent}::Deck {i:04}" if parent else f"Deck {i:04}")
+    return names
+
+
+def generate_collection(output_dir: Path, options: GeneratorOptions) -> Path:
+    """
+    Build a synthetic collection in `output_dir` with the `anki` library. Return the path of the collection.
+
+    The notes are spread randomly over a tree of decks, and some of them show a media file (random data, which
+    doesn't compress, like real images).
+
+    Raises:
+        FileExistsError: if a collection already exists in `output_dir`.
+
+    """
+    file = output_dir / "collection.anki2"
+    if file.exists():
+        msg = f"{file} already exists"
+        raise FileExistsError(msg)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    rng = random.Random(options.seed)  # noqa: S311
+
+    col = Collection(str(file.absolute()))
+    try:
+        media_dir = Path(col.media.dir())
+        media = [f"media_{i:05}.jpg" for i in range(options.media)]
+        for name in media:
+            (media_dir / name).write_bytes(rng.randbytes(options.media_size))
+
+        deck_ids = [col.decks.id(name) for name in deck_names(options, rng)]
+        notetype = col.models.by_name("Basic")
+        requests = []
+        for i in range(options.notes):
+            note = col.new_note(notetype)
+            words = " ".join(f"word{rng.randrange(10_000)}" for _ in range(rng.randint(3, 12)))
+            note["Front"] = f"Question {i}: {words}?"
+            note["Back"] = f"Answer {i}: <b>{words}</b>"
+            if media and rng.random() < 0.3:  # noqa: PLR2004
+                note["Back"] += f'<br><img src="{rng.choice(media)}">'
+            requests.append(AddNoteRequest(note, rng.choice(deck_ids)))
+        col.add_notes(requests)
+    finally:
+        col.close()
+    return file
+
+
+@dataclass
+class StageResult:
+    """
+    Time and memory used by a stage (the times are in seconds and the memory in bytes).
+
+    `python_peak` is `None` when the memory used by the Python code is not traced.
+    """
+
+    wall: float
+    cpu: float
+    python_peak: int | None
+    rss_peak: int
+
+
+def rss_peak() -> int:
+    """Return the peak resident memory of this process and of its finished child processes (0 if unknown)."""
+    if resource is None:
+        return 0
+    # in kilobytes on Linux, in bytes on macOS
+    unit = 1 if sys.platform == "darwin" else 1024
+    return unit * max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    )
+
+
+class Benchmark:
+    """
+    Run the stages of the build on a collection and record the time and memory they use.
+
+    The CPU time includes all the threads of the process (e.g. the collection thread) but not the worker processes.
+    The Python memory is traced with `tracemalloc` (which slows down the Python code), and the peak resident memory
+    is the highest one since the start of the process (it only grows).
+    """
+
+    def __init__(self, wrapper: CollectionWrapper, work_dir: Path, jobs: int | None = None) -> None:
+        """Create a `Benchmark` that writes its files in `work_dir`."""
+        self.wrapper = wrapper
+        self.work_dir = work_dir
+        self.jobs = jobs
+        self.stages: dict[str, StageResult] = {}
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> Generator[None]:
+        """Record the time and memory used in the block."""
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        cpu = time.process_time()
+        with Progress(f"Running {name}"):
+            yield
+        self.stages[name] = StageResult(
+            wall=time.perf_counter() - start,
+            cpu=time.process_time() - cpu,
+            python_peak=tracemalloc.get_traced_memory()[1] if tracemalloc.is_tracing() else None,
+            rss_peak=rss_peak(),
+        )
+
+    def run(self) -> None:
+        """Run all the stages."""
+        wrapper = self.wrapper
+        decks = sorted(wrapper.all_decks(), key=lambda deck: deck.name if deck else "")
+
+        with self.stage("deck_stats"):
+            stats = wrapper.deck_stats()
+
+        with self.stage("modtime_card_count"):
+            # the methods that compute the statistics for a single deck
+            for deck in decks:
+                wrapper.modtime(deck)
+                wrapper.card_count(deck)
+
+        with self.stage("media_fingerprint"):
+            wrapper.media_fingerprint()
+
+        export_dir = self.work_dir / "export"
+        export_dir.mkdir()
+        manifest = BuildManifest(self.work_dir / "export_manifest.json")
+        with self.stage("export"), ParallelExporter(wrapper, self.jobs) as exporter:
+            futures = [(deck, exporter.submit(deck, export_dir)) for deck in decks]
+            for deck, future in futures:
+                output_file = future.result().file
+                modtime = stats.modtime(deck)
+                manifest.update(
+                    output_file,
+                    id=deck.id if deck else None,
+                    modtime=modtime.timestamp() if modtime else None,
+                    card_count=stats.card_count(deck),
+                    fingerprint=stats.fingerprint(deck),
+                    size=output_file.stat().st_size,
+                )
+
+        mirror = MediaMirror(
+            Path(wrapper.col.media.dir()), self.work_dir / "media", self.work_dir / "media_manifest.json"
+        )
+        with self.stage("mirror_media"):
+            mirror.run()
+        with self.stage("mirror_media_unchanged"):
+            mirror.run()
+
+        references = MediaReferences(self.work_dir / "media_references.json")
+        with self.stage("media_references"):
+            references.run(wrapper)
+        analytics = ReviewAnalytics(self.work_dir / "review_stats.json")
+        with self.stage("review_stats"):
+            analytics.run(wrapper)
+
+        with self.stage("render_pages"):
+            files = export_and_build_docs.render_pages(
+                wrapper, decks, stats, manifest, mirror, None, references, analytics
+            )
+
+        pages_dir = self.work_dir / "pages"
+        pages_dir.mkdir()
+        with self.stage("write_pages"):
+            # the pages are numbered so they are not written in the documentation folder
+            for i, content in enumerate(files.values()):
+                (pages_dir / f"{i}.md").write_text("".join(content), "utf-8")
+
+    def collection_info(self) -> dict[str, int]:
+        """Return the size of the collection."""
+
+        def info() -> dict[str, int]:
+            col = self.wrapper.col
+            media_dir = Path(col.media.dir())
+            return {
+                "decks": len(col.decks.all_names_and_ids(skip_empty_default=True)),
+                "notes": col.note_count(),
+                "cards": col.card_count(),
+                "media": sum(1 for _ in media_dir.iterdir()),
+                "media_size": sum(file.stat().st_size for file in media_dir.iterdir()),
+                "size": Path(col.path).stat().st_size,
+            }
+
+        return self.wrapper.submit(info).result()
+
+
+def run_benchmark(collection: Path, repeat: int = 1, jobs: int | None = None) -> dict[str, Any]:
+    """
+    Benchmark a collection `repeat` times. Return the results (the fastest run of each stage).
+
+    The collection is copied first, so it is not modified.
+    """
+    runs: list[dict[str, StageResult]] = []
+    with tempfile.TemporaryDirectory() as tmp:
+        copy = Path(tmp) / "collection"
+        copy.mkdir()
+        (copy / "collection.anki2").write_bytes(collection.read_bytes())
+        media_dir = collection.with_suffix(".media")
+        (copy / "collection.media").symlink_to(media_dir.absolute(), target_is_directory=True)
+        wrapper = CollectionWrapper(copy / "collection.anki2")
+        try:
+            for i in range(repeat):
+                work_dir = Path(tmp) / f"run{i}"
+                work_dir.mkdir()
+                benchmark = Benchmark(wrapper, work_dir, jobs)
+                benchmark.run()
+                runs.append(benchmark.stages)
+            info = benchmark.collection_info()
+        finally:
+            wrapper.close()
+
+    return {
+        "version": RESULTS_VERSION,
+        "date": dt.datetime.now(dt.UTC).isoformat(),
+        "python": platform.python_version(),
+        "anki": anki_version,
+        "platform": platform.platform(),
+        "jobs": jobs,
+        "repeat": repeat,
+        "tracemalloc": tracemalloc.is_tracing(),
+        "collection": info,
+        "stages": {name: asdict(min((run[name] for run in runs), key=lambda result: result.wall)) for name in runs[0]},
+    }
+
+
+def compare(old: dict[str, Any], new: dict[str, Any]) -> str:
+    """Return a table that compares the stages of two benchmark results."""
+    lines = []
+    # the size of the database file can change a bit between two identical collections
+    if {**old["collection"], "size": 0} != {**new["collection"], "size": 0}:
+        lines.append(f"Warning: the collections are different ({old['collection']} / {new['collection']})")
+    width = max(map(len, {**old["stages"], **new["stages"]}))
+    lines.append(f"{'Stage':<{width}} {'Old (s)':>9} {'New (s)':>9} {'Change':>8}  {'Old peak':>10} {'New peak':>10}")
+
+    def column(results: dict[str, Any] | None, key: str, fmt: Callable[[Any], str]) -> str:
+        return fmt(results[key]) if results and results[key] is not None else "-"
+
+    for name in {**old["stages"], **new["stages"]}:
+        before = old["stages"].get(name)
+        after = new["stages"].get(name)
+        change = f"{(after['wall'] / before['wall'] - 1) * 100:+.1f} %" if before and after and before["wall"] else "-"
+        lines.append(
+            f"{name:<{width}} "
+            f"{column(before, 'wall', lambda value: f'{value:.3f}'):>9} "
+            f"{column(after, 'wall', lambda value: f'{value:.3f}'):>9} "
+            f"{change:>8}  "
+            f"{column(before, 'python_peak', format_size):>10} "
+            f"{column(after, 'python_peak', format_size):>10}"
+        )
+    return "\n".join(lines)
+
+
+def generator_options(args: argparse.Namespace) -> GeneratorOptions:
+    """Return the options of the generator given on the command line."""
+    return GeneratorOptions(args.decks, args.depth, args.notes, args.media, args.media_size, args.seed)
+
+
+def main(argv: list[str]) -> int:
+    """Run the command given on the command line. Return the exit code."""
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    generator = argparse.ArgumentParser(add_help=False)
+    defaults = GeneratorOptions()
+    generator.add_argument("--decks", type=int, default=defaults.decks, help="number of decks (default: %(default)s)")
+    generator.add_argument(
+        "--depth", type=int, default=defaults.depth, help="maximum nesting depth of the decks (default: %(default)s)"
+    )
+    generator.add_argument("--notes", type=int, default=defaults.notes, help="number of notes (default: %(default)s)")
+    generator.add_argument(
+        "--media", type=int, default=defaults.media, help="number of media files (default: %(default)s)"
+    )
+    generator.add_argument(
+        "--media-size",
+        type=int,
+        default=defaults.media_size,
+        help="size of each media file in bytes (default: %(default)s)",
+    )
+    generator.add_argument("--seed", type=int, default=defaults.seed, help="random seed (default: %(default)s)")
+
+    generate = commands.add_parser("generate", parents=[generator], help="generate a synthetic collection")
+    generate.add_argument("output_dir", type=Path, help="folder where the collection is written")
+
+    run = commands.add_parser("run", parents=[generator], help="benchmark a collection")
+    run.add_argument(
+        "--collection", type=Path, help="folder of the collection (default: a synthetic collection is generated)"
+    )
+    run.add_argument("-o", "--output", type=Path, help="file where the results are saved (JSON)")
+    run.add_argument("--repeat", type=int, default=1, help="number of runs (the fastest one is kept)")
+    run.add_argument("--jobs", type=int, help="number of processes used to export the decks")
+    run.add_argument("--no-tracemalloc", action="store_true", help="don't trace the memory used by the Python code")
+
+    compare_parser = commands.add_parser("compare", help="compare two results")
+    compare_parser.add_argument("old", type=Path, help="results of the reference run")
+    compare_parser.add_argument("new", type=Path, help="results of the new run")
+
+    # the other options are read by the other modules (e.g. `--trace`)
+    args, _ = parser.parse_known_args(argv)
+
+    if args.command == "generate":
+        try:
+            with Progress(f"Generating a collection in {args.output_dir}"):
+                generate_collection(args.output_dir, generator_options(args))
+        except FileExistsError as err:
+            print(err)
+            return 1
+
+    elif args.command == "run":
+        if not args.no_tracemalloc:
+            tracemalloc.start()
+        with tempfile.TemporaryDirectory() as tmp:
+            if args.collection:
+                collection = args.collection / "collection.anki2"
+            else:
+                with Progress("Generating a collection"):
+                    collection = generate_collection(Path(tmp), generator_options(args))
+            results = run_benchmark(collection, args.repeat, args.jobs)
+        info = results["collection"]
+        print(
+            f"{info['decks']} decks, {info['cards']} cards, {info['media']} media files "
+            f"({format_size(info['media_size'])})"
+        )
+        for name, stage in results["stages"].items():
+            python_peak = f"{format_size(stage['python_peak'])} (Python), " if stage["python_peak"] is not None else ""
+            print(
+                f"{name}: {stage['wall']:.3f} s (CPU: {stage['cpu']:.3f} s), "
+                f"peak memory: {python_peak}{format_size(stage['rss_peak'])} (process)"
+            )
+        if args.output:
+            args.output.write_text(json.dumps(results, indent=2), "utf-8")
+            print(f"Results written to {args.output}")
+
+    elif args.command == "compare":
+        print(compare(*(json.loads(file.read_text("utf-8")) for file in (args.old, args.new))))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,281 @@
+"""
+Local service that keeps the collection open, so the scripts don't have to open it on every run.
+
+Usage: `python collection_service.py [--socket PATH]` (the scripts use the service when it is running, and open the
+collection themselves otherwise).
+
+The service listens on a Unix domain socket that only the current user can open, and the clients authenticate with a
+random key that the service writes next to the socket (readable by the current user only). Each request is a
+`(method, args, kwargs)` tuple and each response is a `(ok, result)` tuple, where `result` is the type name, message
+and traceback of the exception raised by the method when `ok` is `False` (the exception itself may not be picklable,
+or not importable in the client). The requests of a client are answered in order, and several clients can be
+connected at the same time (the calls to the collection are still made one at a time in the collection thread).
+"""
+
+import argparse
+import os
+import secrets
+import signal
+import sys
+import threading
+import traceback
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Connection, Listener, answer_challenge, deliver_challenge
+from pathlib import Path
+from typing import TYPE_CHECKING, Any
+
+from due import DueCounter, DueCounts
+from progress import Progress
+from utils import CollectionWrapper, DeckStats, cache_dir
+
+if TYPE_CHECKING:
+    from anki.decks import DeckNameId
+
+# location of the socket of the service
+SOCKET = Path(os.getenv("COLLECTION_SOCKET") or cache_dir / "collection.sock")
+# open the collection directly even if the service is running
+NO_SERVICE = "--no-service" in sys.argv
+
+
+def key_file(socket: Path) -> Path:
+    """Return the file that contains the authentication key of the service listening on `socket`."""
+    return socket.with_name(f"{socket.name}.key")
+
+
+class ServiceError(RuntimeError):
+    """An exception raised by a method of the collection service, raised again in the client."""
+
+    def __init__(self, name: str, message: str, remote_traceback: str) -> None:
+        """Create a `ServiceError` from the type name, message and formatted traceback of the original exception."""
+        super().__init__(f"{name}: {message}")
+        self.name = name
+        self.remote_traceback = remote_traceback
+        self.add_note(f"Traceback in the collection service:\n{remote_traceback.rstrip()}")
+
+
+class CollectionService:
+    """Serve the methods of a `CollectionWrapper` (and the due counts) to the clients of a Unix socket."""
+
+    # methods of the wrapper that can be called by the clients
+    WRAPPER_METHODS = frozenset({
+        "all_decks",
+        "deck_stats",
+        "export",
+        "media_dir",
+        "media_fingerprint",
+        "preview_cards",
+        "snapshot",
+    })
+
+    def __init__(self, wrapper: CollectionWrapper) -> None:
+        """Create a `CollectionService` for the collection of `wrapper`."""
+        self.wrapper = wrapper
+        # the counts are only computed again when the collection changed
+        self.counter = DueCounter(wrapper)
+        self._sync_lock = threading.Lock()
+
+    def call(self, method: str, *args: Any, **kwargs: Any) -> Any:  # noqa: ANN401
+        """
+        Call a method of the service.
+
+        Raises:
+            AttributeError: if the method doesn't exist.
+
+        """
+        if method == "ping":
+            return True
+        if method == "due_counts":
+            return self.counter.counts()
+        if method == "sync":
+            # the clients that sync at the same time wait for the same sync instead of queueing several ones
+            if self._sync_lock.acquire(blocking=False):
+                try:
+                    return self.wrapper.sync(*args, **kwargs)
+                finally:
+                    self._sync_lock.release()
+            with self._sync_lock:
+                return None
+        if method in self.WRAPPER_METHODS:
+            return getattr(self.wrapper, method)(*args, **kwargs)
+        msg = f"Unknown method {method!r}"
+        raise AttributeError(msg)
+
+    def handle(self, connection: Connection, authkey: bytes) -> None:
+        """Authenticate a client and answer its requests until it disconnects."""
+        with connection:
+            # authenticated in the thread of the client (not in `Listener.accept`), so a client that doesn't answer
+            # doesn't block the other ones
+            try:
+                deliver_challenge(connection, authkey)
+                answer_challenge(connection, authkey)
+            except (AuthenticationError, EOFError, OSError):
+                return
+            while True:
+                try:
+                    method, args, kwargs = connection.recv()
+                except EOFError:
+                    return
+                try:
+                    response = (True, self.call(method, *args, **kwargs))
+                except Exception as err:  # noqa: BLE001
+                    # the error is raised in the client
+                    response = (False, (type(err).__name__, str(err), traceback.format_exc()))
+                try:
+                    connection.send(response)
+                except OSError:
+                    return
+
+    def serve(self, socket: Path) -> None:
+        """Accept clients on `socket` until the process is interrupted."""
+        socket.parent.mkdir(parents=True, exist_ok=True)
+        # remove the socket and the key left by a service that didn't stop properly
+        socket.unlink(missing_ok=True)
+        key_file(socket).unlink(missing_ok=True)
+        authkey = secrets.token_bytes(32)
+        # only the current user can connect and read the key (the requests are unpickled), from the moment the files
+        # are created
+        umask = os.umask(0o177)
+        try:
+            key_file(socket).write_bytes(authkey)
+            listener = Listener(str(socket), "AF_UNIX")
+        finally:
+            os.umask(umask)
+        # the socket is removed when the listener is closed
+        try:
+            with listener:
+                while True:
+                    connection = listener.accept()
+                    threading.Thread(target=self.handle, args=(connection, authkey), daemon=True).start()
+        finally:
+            key_file(socket).unlink(missing_ok=True)
+
+
+class CollectionClient:
+    """
+    A client of the collection service, with the same methods as `CollectionWrapper` (except `col`).
+
+    Each thread has its own connection to the service, so the threads don't wait for each other's calls.
+    """
+
+    get_export_file = staticmethod(CollectionWrapper.get_export_file)
+
+    def __init__(self, socket: Path = SOCKET) -> None:
+        """Connect to the service listening on `socket` (an `OSError` is raised if the service is not running)."""
+        self.socket = socket
+        self._authkey = key_file(socket).read_bytes()
+        self._local = threading.local()
+        self.call("ping")
+
+    def _connection(self) -> Connection:
+        try:
+            return self._local.connection
+        except AttributeError:
+            self._local.connection = Client(str(self.socket), "AF_UNIX", authkey=self._authkey)
+            return self._local.connection
+
+    def call(self, method: str, *args: Any, **kwargs: Any) -> Any:  # noqa: ANN401
+        """
+        Call a method of the service and return its result.
+
+        Raises:
+            ServiceError: if the method raised an exception in the service.
+
+        """
+        connection = self._connection()
+        connection.send((method, args, kwargs))
+        ok, result = connection.recv()
+        if not ok:
+            raise ServiceError(*result)
+        return result
+
+    def close(self) -> None:
+        """Close the connection of the current thread (the collection stays open in the service)."""
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            connection.close()
+            del self._local.connection
+
+    def sync(self) -> None:
+        """Sync the collection of the service (see `CollectionWrapper.sync`)."""
+        self.call("sync")
+
+    def all_decks(self) -> list["DeckNameId | None"]:
+        """Return all the available decks (only name and ID)."""
+        return self.call("all_decks")
+
+    def deck_stats(self) -> DeckStats:
+        """Return the statistics of all the decks (see `DeckStats`)."""
+        return self.call("deck_stats")
+
+    def due_counts(self) -> DueCounts:
+        """Return the number of cards due today and the forecast (see `DueCounter`)."""
+        return self.call("due_counts")
+
+    def media_dir(self) -> Path:
+        """Return the absolute path of the media folder."""
+        return self.call("media_dir")
+
+    def media_fingerprint(self) -> str:
+        """Return a fingerprint of the media folder (names, sizes and modification times)."""
+        return self.call("media_fingerprint")
+
+    def snapshot(self, file: Path) -> Path:
+        """Write a consistent copy of the collection (without the media) to `file` and return its path."""
+        return self.call("snapshot", Path(file).absolute())
+
+    def preview_cards(self, deck: "DeckNameId | None", limit: int) -> dict[str, Any]:
+        """Return the first `limit` cards of a deck, rendered, with their note types (see `preview.render_cards`)."""
+        return self.call("preview_cards", deck, limit)
+
+    def export(
+        self,
+        deck: "DeckNameId | None",
+        output_dir: str | Path,
+        full_backup: bool = False,
+        with_media: bool = True,
+        legacy: bool = True,
+    ) -> Path:
+        """Export a deck in a directory. Return the path where the deck has been exported."""
+        return self.call("export", deck, Path(output_dir).absolute(), full_backup, with_media, legacy)
+
+
+def open_collection() -> CollectionWrapper | CollectionClient:
+    """Return a client of the collection service if it is running, or open the collection directly otherwise."""
+    if not NO_SERVICE:
+        try:
+            return CollectionClient()
+        except (OSError, AuthenticationError):
+            # not running, or the key was replaced by another service
+            pass
+    return CollectionWrapper()
+
+
+def due_counts(wrapper: CollectionWrapper | CollectionClient) -> DueCounts:
+    """Return the number of cards due today and the forecast, from the service if possible."""
+    if isinstance(wrapper, CollectionClient):
+        return wrapper.due_counts()
+    return DueCounter(wrapper).counts()
+
+
+def main(argv: list[str]) -> int:
+    """Run the service until it is interrupted. Return the exit code."""
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--socket", type=Path, default=SOCKET, help="socket of the service (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    with Progress("Opening the collection"):
+        wrapper = CollectionWrapper()
+    # close the collection properly when the service is stopped
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    print(f"Listening on {args.socket}", flush=True)
+    try:
+        CollectionService(wrapper).serve(args.socket)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        wrapper.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
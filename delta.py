@@ -0,0 +1,284 @@
+"""Differential backups: save only what changed in the collection since the previous backup."""
+
+import datetime as dt
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import zipfile
+from pathlib import Path
+from typing import TYPE_CHECKING, Any
+
+if TYPE_CHECKING:
+    from collection_service import CollectionClient
+    from utils import CollectionWrapper
+
+# tables whose rows are only saved if they changed since the previous backup, with the column that changes with the
+# row (the reviews are never modified, so their ID is enough)
+TRACKED_TABLES = {"notes": "mod", "cards": "mod", "revlog": "id"}
+# small tables that are saved entirely in every delta
+FULL_TABLES = ("col", "config", "deck_config", "decks", "fields", "notetypes", "tags", "templates")
+# tables whose deleted rows are listed in the deltas
+DELETABLE_TABLES = ("notes", "cards")
+
+DELTA_VERSION = 1
+
+
+def connect(file: Path) -> sqlite3.Connection:
+    """Open an Anki database with `sqlite3` (with the collation that Anki uses)."""
+    conn = sqlite3.connect(file)
+    conn.create_collation("unicase", lambda a, b: (a.casefold() > b.casefold()) - (a.casefold() < b.casefold()))
+    return conn
+
+
+def media_state(media_dir: Path) -> dict[str, list[int]]:
+    """Return the size and modification time (in nanoseconds) of each media file."""
+    with os.scandir(media_dir) as entries:
+        return {entry.name: [entry.stat().st_size, entry.stat().st_mtime_ns] for entry in entries if entry.is_file()}
+
+
+class BackupState:
+    """
+    A JSON file that remembers the previous backup.
+
+    It contains the name of the full backup the deltas are based on, the number of deltas since then, the ID and
+    modification time of each note and card and the ID of each review (to find the changed and deleted rows, even
+    if they were changed on another device and synced later, with an older modification time), the newest
+    modification times and the size and modification time of the media files.
+    """
+
+    VERSION = 2
+
+    def __init__(self, path: Path) -> None:
+        """Load the state from `path` (or start an empty one if it doesn't exist or is outdated)."""
+        self.path = path
+        self.base = ""
+        self.full_time = 0.0
+        self.sequence = 0
+        self.watermarks: dict[str, int] = {}
+        # table -> [ID, modification time] of each row (see `TRACKED_TABLES`)
+        self.versions: dict[str, list[list[int]]] = {}
+        self.media: dict[str, list[int]] = {}
+        try:
+            data = json.loads(path.read_text("utf-8"))
+        except (OSError, ValueError):
+            return
+        if data.get("version") != self.VERSION:
+            return
+        self.base = data["base"]
+        self.full_time = data["full_time"]
+        self.sequence = data["sequence"]
+        self.watermarks = data["watermarks"]
+        self.versions = data["versions"]
+        self.media = data["media"]
+
+    def needs_full(self, full_every: float) -> bool:
+        """Return `True` if there is no full backup or if the last one is older than `full_every` days."""
+        age = dt.datetime.now(dt.UTC).timestamp() - self.full_time
+        return not self.base or age >= full_every * 86400
+
+    def update(self, snapshot: Path, media_dir: Path) -> None:
+        """Replace the watermarks, rows and media files with the ones of `snapshot` and `media_dir`."""
+        with connect(snapshot) as conn:
+            self.watermarks = {
+                table: conn.execute(f"select coalesce(max({column}), 0) from {table}").fetchone()[0]  # noqa: S608
+                for table, column in TRACKED_TABLES.items()
+            }
+            self.versions = {
+                table: [list(row) for row in conn.execute(f"select id, {column} from {table} order by id")]  # noqa: S608
+                for table, column in TRACKED_TABLES.items()
+            }
+        conn.close()
+        self.media = media_state(media_dir)
+
+    def save(self) -> None:
+        """Save the state."""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(".tmp")
+        tmp.write_text(
+            json.dumps({
+                "version": self.VERSION,
+                "base": self.base,
+                "full_time": self.full_time,
+                "sequence": self.sequence,
+                "watermarks": self.watermarks,
+                "versions": self.versions,
+                "media": self.media,
+            }),
+            "utf-8",
+        )
+        tmp.replace(self.path)
+
+
+def write_full_backup(wrapper: "CollectionWrapper | CollectionClient", output_file: Path, state: BackupState) -> Path:
+    """
+    Write a full backup of the collection (with the media) to `output_file` and make it the base of the next deltas.
+
+    The backup is a `.colpkg` file that can be imported in Anki to replace the whole collection.
+    """
+    from anki.collection import Collection  # noqa: PLC0415
+
+    media_dir = wrapper.media_dir()
+    with tempfile.TemporaryDirectory() as tmp:
+        snapshot = wrapper.snapshot(Path(tmp) / "snapshot.anki2")
+        state.update(snapshot, media_dir)
+        # the media are read from the folder next to the collection
+        (Path(tmp) / "snapshot.media").symlink_to(media_dir, target_is_directory=True)
+        col = Collection(str(snapshot))
+        # this also closes the collection
+        col.export_collection_package(str(output_file.absolute()), include_media=True, legacy=False)
+
+    state.base = output_file.name
+    state.full_time = dt.datetime.now(dt.UTC).timestamp()
+    state.sequence = 0
+    return output_file
+
+
+def write_delta(wrapper: "CollectionWrapper | CollectionClient", output_file: Path, state: BackupState) -> Path:
+    """
+    Write the changes since the previous backup to `output_file` and update `state`.
+
+    The delta is a ZIP archive that contains `delta.json` (the description of the delta and the deleted notes,
+    cards and media files), `delta.anki2` (the changed rows) and the new or changed media files in `media/`.
+    """
+    media_dir = wrapper.media_dir()
+    previous_watermarks = state.watermarks
+    previous_versions = state.versions
+    previous_media = state.media
+
+    with tempfile.TemporaryDirectory() as tmp:
+        snapshot = wrapper.snapshot(Path(tmp) / "snapshot.anki2")
+        state.update(snapshot, media_dir)
+
+        delta_db = Path(tmp) / "delta.anki2"
+        with connect(snapshot) as conn:
+            conn.execute("attach database ? as delta", (str(delta_db),))
+            for table in (*TRACKED_TABLES, *FULL_TABLES):
+                (sql,) = conn.execute(
+                    "select sql from sqlite_master where type = 'table' and name = ?", (table,)
+                ).fetchone()
+                conn.execute(sql.replace(f"CREATE TABLE {table}", f"CREATE TABLE delta.{table}", 1))
+            conn.execute("create temp table previous (id integer primary key, version integer)")
+            for table, column in TRACKED_TABLES.items():
+                conn.execute("delete from previous")
+                conn.executemany("insert into previous values (?, ?)", previous_versions.get(table, []))
+                # a row changed if it is new or if its modification time is different (not necessarily newer, the
+                # changes made on another device keep their time when they are synced); the modification times are
+                # in seconds, so the rows modified during the same second as the previous backup are saved again
+                same_second = "" if column == "id" else f" or t.{column} >= {int(previous_watermarks.get(table, 0))}"
+                conn.execute(
+                    f"insert into delta.{table} select t.* from {table} t left join previous p on p.id = t.id "  # noqa: S608
+                    f"where p.version is not t.{column}{same_second}"
+                )
+            for table in FULL_TABLES:
+                conn.execute(f"insert into delta.{table} select * from {table}")  # noqa: S608
+        conn.close()
+
+        deleted = {
+            table: sorted(
+                {row[0] for row in previous_versions.get(table, [])} - {row[0] for row in state.versions[table]}
+            )
+            for table in DELETABLE_TABLES
+        }
+        deleted["media"] = sorted(set(previous_media) - set(state.media))
+        changed_media = sorted(name for name, entry in state.media.items() if previous_media.get(name) != entry)
+
+        state.sequence += 1
+        manifest = {
+            "version": DELTA_VERSION,
+            "base": state.base,
+            "sequence": state.sequence,
+            "deleted": deleted,
+        }
+
+        tmp_file = output_file.with_suffix(".tmp")
+        with zipfile.ZipFile(tmp_file, "w", zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr("delta.json", json.dumps(manifest))
+            archive.write(delta_db, "delta.anki2")
+            for name in changed_media:
+                # the media files are already compressed (images, sounds...)
+                archive.write(media_dir / name, f"media/{name}", zipfile.ZIP_STORED)
+        tmp_file.replace(output_file)
+
+    return output_file
+
+
+def read_delta_manifest(delta: Path) -> dict[str, Any]:
+    """
+    Return the description of a delta.
+
+    Raises:
+        ValueError: if the file is not a delta or was written by another version.
+
+    """
+    try:
+        with zipfile.ZipFile(delta) as archive:
+            manifest = json.loads(archive.read("delta.json"))
+    except (KeyError, ValueError, zipfile.BadZipFile) as err:
+        msg = f"{delta} is not a backup delta"
+        raise ValueError(msg) from err
+    if manifest.get("version") != DELTA_VERSION:
+        msg = f"{delta} was written by an unsupported version"
+        raise ValueError(msg)
+    return manifest
+
+
+def apply_delta(collection: Path, media_dir: Path, delta: Path) -> None:
+    """Apply a delta to a collection (which must not be open in Anki)."""
+    manifest = read_delta_manifest(delta)
+    with tempfile.TemporaryDirectory() as tmp, zipfile.ZipFile(delta) as archive:
+        delta_db = Path(archive.extract("delta.anki2", tmp))
+        with connect(collection) as conn:
+            conn.execute("attach database ? as delta", (str(delta_db),))
+            for table in FULL_TABLES:
+                conn.execute(f"delete from {table}")  # noqa: S608
+                conn.execute(f"insert into {table} select * from delta.{table}")  # noqa: S608
+            for table in TRACKED_TABLES:
+                conn.execute(f"insert or replace into {table} select * from delta.{table}")  # noqa: S608
+            for table in DELETABLE_TABLES:
+                conn.executemany(f"delete from {table} where id = ?", ((id_,) for id_ in manifest["deleted"][table]))  # noqa: S608
+        conn.close()
+
+        for name in manifest["deleted"]["media"]:
+            (media_dir / name).unlink(missing_ok=True)
+        for info in archive.infolist():
+            if info.filename.startswith("media/") and not info.is_dir():
+                with archive.open(info) as src, (media_dir / info.filename.removeprefix("media/")).open("wb") as dst:
+                    shutil.copyfileobj(src, dst)
+
+
+def restore(full_backup: Path, deltas: list[Path], output_dir: Path) -> Path:
+    """
+    Rebuild a collection in `output_dir` from a full backup and its deltas. Return the path of the collection.
+
+    The deltas can be given in any order, but they must all be based on `full_backup` and none can be missing.
+
+    Raises:
+        ValueError: if a delta is not based on `full_backup` or if a delta is missing.
+
+    """
+    from anki._backend import RustBackend  # noqa: PLC0415, PLC2701
+
+    manifests = sorted(((read_delta_manifest(delta), delta) for delta in deltas), key=lambda item: item[0]["sequence"])
+    for expected, (manifest, delta) in enumerate(manifests, 1):
+        if manifest["base"] != full_backup.name:
+            msg = f"{delta} is based on {manifest['base']}, not on {full_backup.name}"
+            raise ValueError(msg)
+        if manifest["sequence"] != expected:
+            msg = f"Delta number {expected} is missing (found {delta}, which is number {manifest['sequence']})"
+            raise ValueError(msg)
+
+    output_dir.mkdir(parents=True, exist_ok=True)
+    collection = output_dir / "collection.anki2"
+    media_dir = output_dir / "collection.media"
+    media_dir.mkdir(exist_ok=True)
+    RustBackend().import_collection_package(
+        col_path=str(collection.absolute()),
+        backup_path=str(full_backup.absolute()),
+        media_folder=str(media_dir.absolute()),
+        media_db=str((output_dir / "collection.media.db2").absolute()),
+    )
+    for _, delta in manifests:
+        apply_delta(collection, media_dir, delta)
+    return collection
@@ -0,0 +1,140 @@
+// Search the cards with the index written by search_index.py
+// (only the shards of the terms of the query and the notes of the matching decks are downloaded)
+
+var searchRoot = new URL("../search/", document.currentScript.src);
+var siteRoot = new URL("../", document.currentScript.src);
+var searchFiles = {};
+// maximum number of results shown
+var MAX_RESULTS = 50;
+
+function fetchSearchFile(path) {
+    if(!searchFiles[path]) {
+        searchFiles[path] = fetch(new URL(path, searchRoot))
+            .then(function(response) {
+                return response.ok ? response.json() : null;
+            })
+            .catch(function() {
+                return null;
+            });
+    }
+    return searchFiles[path];
+}
+
+// same terms as `tokenize` in search_index.py
+function tokenize(text, minLength) {
+    var terms = text.normalize("NFKD").toLowerCase().replace(/[\u0300-\u036f]/g, "").match(/[\p{L}\p{N}_]+/gu) || [];
+    return terms.filter(function(term, i) {
+        return Array.from(term).length >= minLength && terms.indexOf(term) == i;
+    });
+}
+
+// same name as `shard_name` in search_index.py
+function shardName(term, prefixLength) {
+    return Array.from(new TextEncoder().encode(Array.from(term).slice(0, prefixLength).join("")))
+        .map(function(byte) {
+            return byte.toString(16).padStart(2, "0");
+        })
+        .join("");
+}
+
+// positions of the notes that contain a term starting with `term`, in each deck
+function findTerm(index, term) {
+    var shard = shardName(term, index.prefix_length);
+    if(index.shards.indexOf(shard) == -1) {
+        return Promise.resolve({});
+    }
+    return fetchSearchFile("shards/" + shard + ".json").then(function(terms) {
+        var found = {};
+        Object.keys(terms || {}).forEach(function(indexedTerm) {
+            if(!indexedTerm.startsWith(term)) {
+                return;
+            }
+            Object.keys(terms[indexedTerm]).forEach(function(deck) {
+                found[deck] = found[deck] || new Set();
+                terms[indexedTerm][deck].forEach(function(position) {
+                    found[deck].add(position);
+                });
+            });
+        });
+        return found;
+    });
+}
+
+// deck and position of the notes that contain all the terms of the query
+function search(index, query) {
+    var terms = tokenize(query, index.min_term_length);
+    if(!terms.length) {
+        return Promise.resolve([]);
+    }
+    return Promise.all(terms.map(function(term) {
+        return findTerm(index, term);
+    })).then(function(results) {
+        var matches = [];
+        Object.keys(results[0]).forEach(function(deck) {
+            results[0][deck].forEach(function(position) {
+                if(results.every(function(result) { return result[deck] && result[deck].has(position); })) {
+                    matches.push([deck, position]);
+                }
+            });
+        });
+        return matches;
+    });
+}
+
+function showResults(container, index, matches) {
+    var shown = matches.slice(0, MAX_RESULTS);
+    var decks = Array.from(new Set(shown.map(function(match) { return match[0]; })));
+    return Promise.all(decks.map(function(deck) {
+        return fetchSearchFile("decks/" + deck + ".json");
+    })).then(function(notes) {
+        container.textContent = "";
+        var count = document.createElement("p");
+        count.textContent = matches.length + " carte(s) trouvée(s)"
+            + (matches.length > MAX_RESULTS ? " (" + MAX_RESULTS + " premières affichées)" : "");
+        container.append(count);
+        var list = document.createElement("ul");
+        shown.forEach(function(match) {
+            var deck = index.decks[match[0]];
+            var note = (notes[decks.indexOf(match[0])] || [])[match[1]];
+            if(!deck || !note) {
+                return;
+            }
+            var item = document.createElement("li");
+            var link = document.createElement("a");
+            link.textContent = deck.name;
+            if(deck.package) {
+                link.href = new URL(deck.package, siteRoot);
+            }
+            item.append(link, " : " + note[1]);
+            list.append(item);
+        });
+        container.append(list);
+    });
+}
+
+document$.subscribe(function() {
+    var input = document.getElementById("card-search-input");
+    var container = document.getElementById("card-search-results");
+    if(!input || !container) {
+        return;
+    }
+    var timeout = null;
+    input.addEventListener("input", function() {
+        clearTimeout(timeout);
+        timeout = setTimeout(function() {
+            var query = input.value;
+            fetchSearchFile("index.json").then(function(index) {
+                if(!index) {
+                    container.textContent = "L'index de recherche n'est pas disponible.";
+                    return;
+                }
+                return search(index, query).then(function(matches) {
+                    // ignore the results of an older query
+                    if(input.value == query) {
+                        return showResults(container, index, matches);
+                    }
+                });
+            });
+        }, 200);
+    });
+});
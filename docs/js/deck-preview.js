@@ -0,0 +1,103 @@
+// Show the preview of a deck written by preview.py
+// (the deck is given after the # of the URL, only its cards and the media they use are downloaded)
+
+var previewsRoot = new URL("../previews/", document.currentScript.src);
+var previewSiteRoot = new URL("../", document.currentScript.src);
+var previewMediaRoot = new URL("../media/", document.currentScript.src);
+
+// resolve the relative URLs of the media files against the media folder of the site
+function fixMediaUrls(root) {
+    root.querySelectorAll("[src]").forEach(function(element) {
+        element.setAttribute("src", new URL(element.getAttribute("src"), previewMediaRoot));
+    });
+    root.querySelectorAll("object[data]").forEach(function(element) {
+        element.setAttribute("data", new URL(element.getAttribute("data"), previewMediaRoot));
+    });
+}
+
+function fixCssUrls(css) {
+    return css.replace(/url\(\s*(["']?)([^"')]+)\1\s*\)/g, function(match, quote, url) {
+        return "url(\"" + new URL(url, previewMediaRoot) + "\")";
+    });
+}
+
+// the styling of each card only applies to the card (it is shown in a shadow root)
+function showCard(container, preview, card) {
+    var notetype = preview.notetypes[card.notetype] || {css: ""};
+    var element = document.createElement("div");
+    element.className = "deck-preview-card";
+    var shadow = element.attachShadow({mode: "open"});
+
+    function render(html) {
+        // parsed in a template so the media files are not loaded before their URLs are fixed
+        var template = document.createElement("template");
+        template.innerHTML = "<style>" + fixCssUrls(notetype.css) + "</style><div class=\"card\">" + html + "</div>";
+        fixMediaUrls(template.content);
+        shadow.replaceChildren(template.content);
+    }
+
+    render(card.question);
+    var button = document.createElement("button");
+    button.className = "md-button";
+    button.textContent = "Afficher la réponse";
+    button.addEventListener("click", function() {
+        var showAnswer = button.textContent == "Afficher la réponse";
+        render(showAnswer ? card.answer : card.question);
+        button.textContent = showAnswer ? "Afficher la question" : "Afficher la réponse";
+    });
+    container.append(element, button);
+}
+
+function showPreview(container, preview) {
+    container.textContent = "";
+    var title = document.createElement("h2");
+    title.textContent = preview.deck || "Toutes les flashcards";
+    var links = document.createElement("p");
+    var download = document.createElement("a");
+    download.href = new URL(preview.package, previewSiteRoot);
+    download.textContent = "Télécharger le paquet";
+    var full = document.createElement("a");
+    full.href = preview.full_preview;
+    full.textContent = "Aperçu complet";
+    links.append(download, " - ", full);
+    var count = document.createElement("p");
+    count.textContent = preview.cards.length < preview.card_count
+        ? preview.cards.length + " premières cartes sur " + preview.card_count
+        : preview.card_count + " carte(s)";
+    container.append(title, links, count);
+    preview.cards.forEach(function(card) {
+        showCard(container, preview, card);
+    });
+}
+
+function loadPreview(container) {
+    var name = decodeURIComponent(location.hash.slice(1));
+    if(!/^(\d+|all)$/.test(name)) {
+        container.textContent = "Aucun paquet choisi.";
+        return;
+    }
+    fetch(new URL(name + ".json", previewsRoot))
+        .then(function(response) {
+            if(!response.ok) {
+                throw new Error(response.statusText);
+            }
+            return response.json();
+        })
+        .then(function(preview) {
+            showPreview(container, preview);
+        })
+        .catch(function() {
+            container.textContent = "L'aperçu de ce paquet n'est pas disponible.";
+        });
+}
+
+document$.subscribe(function() {
+    var container = document.getElementById("deck-preview");
+    if(!container) {
+        return;
+    }
+    loadPreview(container);
+    window.onhashchange = function() {
+        loadPreview(container);
+    };
+});
@@ -0,0 +1,23 @@
+// Display the last update date saved by export_and_build_docs.py
+// (it is not in the configuration so the pages don't change on every build)
+
+var lastUpdate = fetch(new URL("../build.json", document.currentScript.src))
+    .then(function(response) {
+        return response.ok ? response.json() : null;
+    })
+    .catch(function() {
+        return null;
+    });
+
+document$.subscribe(function() {
+    lastUpdate.then(function(data) {
+        var copyright = document.querySelector(".md-copyright");
+        if(!data || !copyright || copyright.querySelector(".last-update")) {
+            return;
+        }
+        var element = document.createElement("div");
+        element.className = "last-update";
+        element.textContent = "Dernière mise à jour : " + data.last_update;
+        copyright.prepend(element);
+    });
+});
@@ -0,0 +1,170 @@
+"""Count the due cards of the collection without building the whole scheduler tree."""
+
+import time
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING
+
+from utils import CollectionWrapper
+
+if TYPE_CHECKING:
+    from anki.collection import Collection
+
+# number of days of the due forecast
+FORECAST_DAYS = 7
+
+# queues of the cards (see `anki.consts`)
+QUEUE_NEW = 0
+QUEUE_LEARN = 1
+QUEUE_REVIEW = 2
+QUEUE_DAY_LEARN = 3
+
+
+@dataclass
+class DueCounts:
+    """Number of new, learning and review cards due today, and number of cards due on each of the next days."""
+
+    new: int = 0
+    learn: int = 0
+    review: int = 0
+    forecast: list[int] = field(default_factory=lambda: [0] * FORECAST_DAYS)
+
+    @property
+    def total(self) -> int:
+        """Number of cards due today."""
+        return self.new + self.learn + self.review
+
+
+def remaining_limit(col: "Collection", deck: dict, kind: str) -> float:
+    """Return the number of new or review (`kind`) cards that can still be studied today in a deck."""
+    if deck["dyn"]:
+        # the filtered decks have no limits
+        return float("inf")
+    today = col.sched.today
+    limit_today = deck.get(f"{kind}LimitToday")
+    if limit_today and limit_today.get("today") == today:
+        limit = limit_today["limit"]
+    elif deck.get(f"{kind}Limit") is not None:
+        limit = deck[f"{kind}Limit"]
+    else:
+        limit = col.decks.config_dict_for_deck_id(deck["id"])["new" if kind == "new" else "rev"]["perDay"]
+    day, done = deck["newToday" if kind == "new" else "revToday"]
+    return max(0, limit - done) if day == today else limit
+
+
+def count_due(col: "Collection") -> tuple[DueCounts, float]:  # noqa: PLR0914
+    """
+    Count the due cards with a few aggregate queries, respecting the deck limits.
+
+    Return the counts and the time until which they stay valid if the collection doesn't change (when the next
+    learning card becomes due).
+    """
+    # imported here so the clients of the collection service (that receive `DueCounts`) start quickly
+    import numpy as np  # noqa: PLC0415
+
+    today = col.sched.today
+    learn_ahead = col.get_preferences().scheduling.learn_ahead_secs
+    learn_cutoff = time.time() + learn_ahead
+
+    # number of cards of each deck in each queue and on each due date, in a single pass over the cards (the due date
+    # of the new cards is their position, so it is ignored)
+    did, queue, due, count = (
+        np
+        .array(
+            col.db.all(
+                """
+                select did, queue, iif(queue = ?, 0, due), count()
+                from cards
+                where queue between ? and ?
+                group by 1, 2, 3
+                """,
+                QUEUE_NEW,
+                QUEUE_NEW,
+                QUEUE_DAY_LEARN,
+            ),
+            dtype=np.int64,
+        )
+        .reshape(-1, 4)
+        .T
+    )
+    is_learn = queue == QUEUE_LEARN
+
+    # new, learning (in the same day), learning (over several days) and review cards due today in each deck
+    dids, deck_index = np.unique(did, return_inverse=True)
+    masks = (
+        queue == QUEUE_NEW,
+        is_learn & (due <= learn_cutoff),
+        (queue == QUEUE_DAY_LEARN) & (due <= today),
+        (queue == QUEUE_REVIEW) & (due <= today),
+    )
+    per_deck = dict(
+        zip(
+            dids.tolist(),
+            np.stack([np.bincount(deck_index, count * mask, len(dids)) for mask in masks], axis=1).tolist(),
+            strict=True,
+        )
+    )
+    ignore_review_limit = col.get_config("newCardsIgnoreReviewLimit", default=False)
+
+    # apply the limits from the leaves to the top-level decks (a parent limit also applies to its children)
+    decks = sorted(col.decks.all(), key=lambda deck: deck["name"].count("::"), reverse=True)
+    totals: dict[str, list[float]] = {}
+    for deck in decks:
+        new, learn, day_learn, review = (
+            a + b for a, b in zip(per_deck.get(deck["id"], [0] * 4), totals.get(deck["name"], [0] * 4), strict=True)
+        )
+        # the learning cards over several days are also limited by the review limit, and use it first
+        review_limit = remaining_limit(col, deck, "review")
+        day_learn = min(day_learn, review_limit)
+        review = min(review, review_limit - day_learn)
+        new = min(new, remaining_limit(col, deck, "new"))
+        if not ignore_review_limit:
+            new = min(new, review_limit - day_learn - review)
+        counts = totals[deck["name"]] = [new, learn, day_learn, review]
+        parent, sep, _ = deck["name"].rpartition("::")
+        if sep:
+            totals[parent] = [a + b for a, b in zip(totals.get(parent, [0] * 4), counts, strict=True)]
+
+    result = DueCounts()
+    for deck in decks:
+        if "::" not in deck["name"]:
+            new, learn, day_learn, review = totals[deck["name"]]
+            result.new += int(new)
+            result.learn += int(learn + day_learn)
+            result.review += int(review)
+
+    # forecast: number of learning and review cards due on each day (the overdue cards are due today)
+    days = np.where(is_learn, (due - col.sched.day_cutoff) // 86400 + 1, due - today)
+    forecast = np.bincount(np.clip(days[queue != QUEUE_NEW], 0, None), count[queue != QUEUE_NEW], FORECAST_DAYS)
+    result.forecast = forecast[:FORECAST_DAYS].astype(int).tolist()
+
+    # the counts change when the next learning card becomes due
+    next_learn = due[is_learn & (due > learn_cutoff)].min(initial=2**62)
+    return result, float(next_learn - learn_ahead)
+
+
+class DueCounter:
+    """
+    Count the due cards of a collection, caching the result until the collection changes.
+
+    The result is computed again when the collection is modified, when the day changes or when a learning card
+    becomes due, so checking it often costs almost nothing.
+    """
+
+    def __init__(self, wrapper: CollectionWrapper) -> None:
+        """Create a `DueCounter` for the collection of `wrapper`."""
+        self.wrapper = wrapper
+        self._key: tuple[int, int] | None = None
+        self._valid_until = 0.0
+        self._counts = DueCounts()
+
+    def _count(self) -> DueCounts:
+        col = self.wrapper.col
+        key = (col.mod, col.sched.today)
+        if key != self._key or time.time() >= self._valid_until:
+            self._counts, self._valid_until = count_due(col)
+            self._key = key
+        return self._counts
+
+    def counts(self) -> DueCounts:
+        """Return the number of cards due today and the forecast."""
+        return self.wrapper.submit(self._count).result()
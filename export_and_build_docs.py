@@ -1,12 +1,11 @@
 """Export all the flashcards and build the documentation with Zensical."""
 
 import datetime as dt
+import json
 import os
-import shutil
 import subprocess as sp  # noqa: S404
 import sys
 from pathlib import Path
-from threading import Thread
 from typing import TYPE_CHECKING
 from urllib.parse import urljoin
 
@@ -15,51 +14,73 @@ import toml
 if TYPE_CHECKING:
     from anki.decks import DeckNameId
 
+from collection_service import CollectionClient, open_collection
+from manifest import BuildManifest
+from media_mirror import MediaMirror
+from media_optimiser import MediaOptimiser
+from media_refs import MediaReferences
+from parallel_export import ParallelExporter
+from precompress import Precompressor
+from preview import DeckPreviews, preview_name
 from progress import Progress
-from utils import CollectionWrapper, collection_dir, format_datetime, format_number, format_size
-
-
-def link(target: Path, source: Path) -> str:
-    """Return a link pointing to `target` that can be put in the `source` file."""
-    return target.relative_to(
-        source.parent if source.suffix == ".md" else source,
-        walk_up=True,
-    ).as_posix()
-
-
-wrapper = CollectionWrapper()
-if "--no-sync" not in sys.argv:
-    with Progress("Syncing"):
-        wrapper.sync()
-
-with Progress("Cleaning up"):
-    docs_dir = Path(__file__).parent / "docs/export"
-    if docs_dir.exists():
-        shutil.rmtree(docs_dir)
-    docs_dir.mkdir()
-
-    media_dir = Path(__file__).parent / "docs/media"
-    if media_dir.exists():
-        shutil.rmtree(media_dir)
-    media_dir.mkdir()
-
-    # remove the exported files
-    export_dir = docs_dir.parent
-    for file in export_dir.iterdir():
-        if file.suffix == ".apkg":
-            file.unlink()
+from review_stats import RECENT_DAYS, ReviewAnalytics, ReviewStats
+from search_index import SearchIndex
+from utils import (
+    CollectionWrapper,
+    DeckStats,
+    cache_dir,
+    collection_dir,
+    export_format_flag,
+    format_datetime,
+    format_duration,
+    format_number,
+    format_size,
+    write_if_changed,
+)
+
+# only export the decks that changed since the previous build
+INCREMENTAL = "--incremental" in sys.argv
+# export the decks without media, and the media in a separate bundle
+LIGHT = "--light" in sys.argv
+# also compare the content of the media files, not only their size and modification time
+HASH_MEDIA = "--hash-media" in sys.argv
+# don't remove the previously built site before building it
+NO_CLEAN = "--no-clean" in sys.argv
+# also publish the media files that are not used by any note
+ALL_MEDIA = "--all-media" in sys.argv
+# recompress the published media files (losslessly, unless `--media-quality=N` (1-100) is given for the images
+# or `--audio-bitrate=RATE` (e.g. `64k`) for the sounds)
+OPTIMISE_MEDIA = "--optimise-media" in sys.argv
+MEDIA_QUALITY = next(
+    (int(arg.removeprefix("--media-quality=")) for arg in sys.argv if arg.startswith("--media-quality=")), None
+)
+AUDIO_BITRATE = next(
+    (arg.removeprefix("--audio-bitrate=") for arg in sys.argv if arg.startswith("--audio-bitrate=")), None
+)
+# don't build the search index of the cards
+NO_SEARCH = "--no-search" in sys.argv
+# don't write the compressed copies of the text files of the site
+NO_PRECOMPRESS = "--no-precompress" in sys.argv
+# number of processes used to export the decks (`--jobs=N`, defaults to the number of CPUs)
+JOBS = next((int(arg.removeprefix("--jobs=")) for arg in sys.argv if arg.startswith("--jobs=")), None)
+# format of the packages of the decks (`--deck-format=legacy|latest`) and of the whole collection
+# (`--all-format=legacy|latest`, defaults to the format of the decks), see `EXPORT_FORMATS`
+DECK_FORMAT = export_format_flag("deck-format")
+ALL_FORMAT = export_format_flag("all-format", DECK_FORMAT)
+
+docs_dir = Path(__file__).parent / "docs/export"
+media_dir = Path(__file__).parent / "docs/media"
+export_dir = docs_dir.parent
 
 TEMPLATE = """\
-| Titre { aria-sort="ascending" } | Aperçu | Taille | Nombre de cartes | Dernière modification |
-| ------------------------------- | ------ | ------ | ---------------- | --------------------- |
+| Titre { aria-sort="ascending" } | Aperçu | Taille | Nombre de cartes | Révisions | Dernière modification |
+| ------------------------------- | ------ | ------ | ---------------- | --------- | --------------------- |
 """
 FLASHCARDS_VIEWER_URL = "https://lfavole.github.io/flashcards-viewer/"
 
-files: dict[Path, str] = {}
-
 GLOBAL_METADATA = ""
 GLOBAL_CONTENT = """\
-[Comment utiliser ce site ?](HELP)
+[Comment utiliser ce site ?](HELP) - [:material-card-search: Rechercher une carte](SEARCH)
 """
 
 HOMEPAGE_METADATA = """\
@@ -70,94 +91,7 @@ icon: material/download
 HOMEPAGE_TITLE = "Télécharger mes flashcards"
 HOMEPAGE_CONTENT = GLOBAL_CONTENT
 
-zensical_config = Path(__file__).parent / "zensical.toml"
-
-# Load the Zensical configuration
-with zensical_config.open() as f:
-    config = toml.load(f)
-
-SITE_URL = os.getenv("SITE_URL", config["project"]["site_url"])
-
-sizes: dict[Path, int] = {}
-
-threads: list[Thread] = []
-
-
-def export_deck(deck: "DeckNameId") -> None:
-    """Export a deck and save its size."""
-    with Progress(f"Exporting {deck.name} ({deck.id})" if deck else "Exporting all the collection"):
-        wrapper.export(deck, export_dir)
-
-    output_file = wrapper.get_export_file(deck, export_dir)
-    sizes[output_file] = (docs_dir / output_file).stat().st_size
-
-
-# sort the decks so the parent deck appears before the child deck
-decks = sorted(wrapper.all_decks(), key=lambda deck: deck.name if deck else "")
-
-for deck in decks:  # pylint: disable=E1133
-    thread = Thread(target=export_deck, args=(deck,))
-    thread.start()
-    threads.append(thread)
-
-for thread in threads:
-    thread.join()
-
-
-for deck in decks:  # pylint: disable=E1133
-    output_file = wrapper.get_export_file(deck, export_dir)
-    size = format_size(sizes[output_file])
-
-    card_count = format_number(wrapper.card_count(deck))
-    modtime = format_datetime(wrapper.modtime(deck))
-    parts = deck.name.split("::") if deck else ""
-
-    # file that will contain the link to the deck
-    # (page of the parent deck)
-    filename = docs_dir.joinpath(*parts[:-1], "index.md")
-    folder_icon = ""
-
-    if not deck or wrapper.has_children(deck):
-        # if the deck has children:
-        # - add a link to the deck page (that lists the subdecks) with a folder icon
-        # - create the deck page
-        new_filename = docs_dir.joinpath(*parts, "index.md")  # file to be linked (deck page)
-        output_url = link(new_filename, filename)
-        folder_icon = ":material-folder: "
-        # create the deck page
-        help_link = link(docs_dir.parent / "questions/start.md", new_filename)
-        NEWLINE = "\n"
-        files[new_filename] = f"""\
-{HOMEPAGE_METADATA if not deck else GLOBAL_METADATA}
-# {deck.name if deck else HOMEPAGE_TITLE}
-
-{(HOMEPAGE_CONTENT if not deck else GLOBAL_CONTENT).replace("HELP", help_link)}
-
-[Fichiers média manquants ? Cliquez ici]({link(media_dir / "index.md", new_filename)})
-
-[:material-download: Télécharger toutes les flashcards]({link(output_file, new_filename)}) ({size}) - \
-[Aperçu]({FLASHCARDS_VIEWER_URL}#{urljoin(SITE_URL, link(output_file, docs_dir.parent))}){{ target=\"_blank\" }} (1)
-{{ .annotate }}
-
-1. {"Dernière modification : " + modtime + NEWLINE + "  " if modtime != "-" else ""}\
-   Nombre de cartes : {card_count}
-
-{TEMPLATE}"""
-
-    else:
-        output_url = link(output_file, filename)
-
-    if deck:
-        # add a link to the deck / deck page
-        # (not for all the collection)
-        files[filename] += f'| \
-[{folder_icon}{parts[-1]}]({output_url}) | \
-[Aperçu]({FLASHCARDS_VIEWER_URL}#{urljoin(SITE_URL, link(output_file, docs_dir.parent))}){{ target="_blank" }} | \
-{size} | \
-{card_count} | \
-{modtime}\n'
-
-files[media_dir / "index.md"] = """\
+MEDIA_PAGE = """\
 ---
 icon: material/image-multiple
 ---
@@ -174,41 +108,412 @@ et déplacez-le dans le dossier suivant :
     - S'il existe : <br> Stockage interne → AnkiDroid → collection.media
     - Sinon (vous pourriez avoir besoin d'un ordinateur) : <br>
       Stockage interne / Carte SD → Android → data → com.ichi2.anki → collection.media
-
-| Nom du fichier { aria-sort="ascending" } | Taille | Dernière modification |
-| ---------------------------------------- | ------ | --------------------- |
 """
 
-(docs_dir / "media").mkdir(parents=True, exist_ok=True)
+zensical_config = Path(__file__).parent / "zensical.toml"
 
-for file in (collection_dir / "collection.media").iterdir():
-    with Progress(f"Copying media file {file}"):
-        shutil.copy(file, media_dir / file.name)
-    mtime = dt.datetime.fromtimestamp(file.stat().st_mtime, tz=dt.UTC)
-    files[media_dir / "index.md"] += f"""\
-| [{file.name}]({file.name}) | {format_size(file.stat().st_size)} | {format_datetime(mtime)} |
-"""
 
+def link(target: Path, source: Path) -> str:
+    """Return a link pointing to `target` that can be put in the `source` file."""
+    return target.relative_to(
+        source.parent if source.suffix == ".md" else source,
+        walk_up=True,
+    ).as_posix()
+
+
+def export_format(deck: "DeckNameId | None") -> str:
+    """Return the format of the package of a deck (or of the whole collection)."""
+    return ALL_FORMAT if deck is None else DECK_FORMAT
+
+
+def export_decks(
+    wrapper: CollectionWrapper | CollectionClient,
+    decks: list["DeckNameId | None"],
+    stats: DeckStats,
+    manifest: BuildManifest,
+    media_fingerprint: str,
+) -> None:
+    """Export the decks that changed since the previous build and save them in the manifest."""
+    decks_to_export: list[DeckNameId | None] = []
+    for deck in decks:
+        output_file = wrapper.get_export_file(deck, export_dir)
+        fingerprint = stats.fingerprint(deck, LIGHT, export_format(deck))
+        if INCREMENTAL and manifest.is_fresh(output_file, fingerprint, media_fingerprint):
+            print(f"Skipping {deck.name if deck else 'all the collection'} (unchanged)")
+        else:
+            decks_to_export.append(deck)
+
+    if decks_to_export:
+        with ParallelExporter(wrapper, JOBS) as exporter:
+            futures = [
+                (
+                    deck,
+                    exporter.submit(deck, export_dir, with_media=not LIGHT, legacy=export_format(deck) == "legacy"),
+                )
+                for deck in decks_to_export
+            ]
+            for deck, future in futures:
+                with Progress(f"Exporting {deck.name} ({deck.id})" if deck else "Exporting all the collection"):
+                    result = future.result()
+
+                modtime = stats.modtime(deck)
+                manifest.update(
+                    result.file,
+                    id=deck.id if deck else None,
+                    modtime=modtime.timestamp() if modtime else None,
+                    card_count=stats.card_count(deck),
+                    fingerprint=stats.fingerprint(deck, LIGHT, export_format(deck)),
+                    size=result.file.stat().st_size,
+                    format=export_format(deck),
+                    export_time=result.duration,
+                )
+        print(export_report([wrapper.get_export_file(deck, export_dir) for deck in decks_to_export], manifest))
+
+    with Progress("Saving the export manifest"):
+        output_files = [wrapper.get_export_file(deck, export_dir) for deck in decks]
+        # remove the files of the decks that don't exist anymore
+        for name in manifest.prune(output_files):
+            (export_dir / name).unlink(missing_ok=True)
+        manifest.save(media_fingerprint)
+
+
+def export_report(output_files: list[Path], manifest: BuildManifest) -> str:
+    """Return a table of the format, export time and size of the exported files (the biggest first)."""
+    entries = sorted(
+        ((file.name, manifest.get(file)) for file in output_files), key=lambda item: item[1]["size"], reverse=True
+    )
+    width = max(len(name) for name, _ in entries)
+    lines = [f"{'Package':<{width}}  {'Format':<6} {'Time (s)':>8} {'Size':>10}"]
+    lines.extend(
+        f"{name:<{width}}  {entry['format']:<6} {entry['export_time']:8.2f} {format_size(entry['size']):>10}"
+        for name, entry in entries
+    )
+    total_time = sum(entry["export_time"] for _, entry in entries)
+    total_size = sum(entry["size"] for _, entry in entries)
+    lines.append(f"{'Total':<{width}}  {'':<6} {total_time:8.2f} {format_size(total_size):>10}")
+    return "\n".join(lines)
+
+
+def build_search_index(
+    wrapper: CollectionWrapper | CollectionClient, decks: list["DeckNameId | None"], stats: DeckStats
+) -> None:
+    """Build the search index of the cards (only the decks that changed are indexed again)."""
+    index = SearchIndex(docs_dir.parent / "search", cache_dir / "search")
+    if not INCREMENTAL:
+        index.clear()
+    packages = {deck.id: link(wrapper.get_export_file(deck, export_dir), docs_dir.parent) for deck in decks if deck}
+    with Progress("Building the search index"):
+        index.build(wrapper, decks, stats, packages)
+    print(index.summary())
+
+
+def build_previews(
+    wrapper: CollectionWrapper | CollectionClient, decks: list["DeckNameId | None"], stats: DeckStats, site_url: str
+) -> None:
+    """Write the previews of the decks (only the decks that changed are rendered again)."""
+    previews = DeckPreviews(docs_dir.parent / "previews", cache_dir / "preview_manifest.json")
+    links = {}
+    for deck in decks:
+        package = link(wrapper.get_export_file(deck, export_dir), docs_dir.parent)
+        links[preview_name(deck)] = {
+            "package": package,
+            # the full package can still be opened in the viewer from the preview
+            "full_preview": f"{FLASHCARDS_VIEWER_URL}#{urljoin(site_url, package)}",
+        }
+    with Progress("Writing the previews of the decks"):
+        previews.build(wrapper, decks, stats, links)
+    print(previews.summary())
+
+
+def analyse_media(wrapper: CollectionWrapper | CollectionClient) -> MediaReferences:
+    """Find the media files used by each deck (only the notes that changed are scanned again)."""
+    references = MediaReferences(cache_dir / "media_references.json")
+    with Progress("Analysing the media references"):
+        references.run(wrapper)
+    print(references.summary())
+    for name in sorted(references.missing):
+        print(f"Missing media file: {name}")
+    return references
+
+
+def analyse_reviews(wrapper: CollectionWrapper | CollectionClient) -> ReviewAnalytics:
+    """Compute the review statistics of the decks (only the reviews made since the previous build are read)."""
+    analytics = ReviewAnalytics(cache_dir / "review_stats.json")
+    with Progress("Computing the review statistics"):
+        analytics.run(wrapper)
+    print(analytics.summary())
+    return analytics
+
+
+def format_review_stats(review_stats: ReviewStats) -> str:
+    """Return a line that sums up the review statistics of a deck (or an empty string if it was never reviewed)."""
+    if not review_stats.reviews:
+        return ""
+    per_day = f"{review_stats.per_day:.1f}".replace(".", ",")
+    parts = [f"{format_number(review_stats.reviews)} révisions ({per_day} par jour ces {RECENT_DAYS} derniers jours)"]
+    if review_stats.retention is not None:
+        parts.append(f"réussite : {review_stats.retention * 100:.0f} %")
+    if review_stats.interval is not None:
+        parts.append(f"intervalle moyen : {format_number(round(review_stats.interval))} jours")
+    parts.append(f"temps passé : {format_duration(review_stats.time)}")
+    return ":material-chart-line: " + " - ".join(parts) + "\n"
+
+
+def mirror_media(references: MediaReferences) -> tuple[MediaMirror, Path | None]:
+    """
+    Mirror the media folder (and bundle it in light mode). Return the mirror and the bundle, if any.
+
+    The files that are not used by any note are left out, unless `--all-media` is given. With `--optimise-media`,
+    the optimised copies of the files are mirrored instead of the original files.
+    """
+    published = references.published | references.unused if ALL_MEDIA else references.published
+    optimised = {}
+    if OPTIMISE_MEDIA:
+        optimiser = MediaOptimiser(cache_dir / "media_optimised", JOBS, MEDIA_QUALITY, AUDIO_BITRATE)
+        with Progress("Optimising the media files"):
+            optimiser.run(collection_dir / "collection.media", published)
+        print(optimiser.summary())
+        optimised = optimiser.optimised
+
+    mirror = MediaMirror(
+        collection_dir / "collection.media", media_dir, cache_dir / "media_manifest.json", use_hash=HASH_MEDIA
+    )
+    with Progress("Mirroring the media files"):
+        mirror.run(keep={"index.md"}, only=published, replacements=optimised)
+    print(mirror.summary())
+
+    if LIGHT:
+        with Progress("Bundling the media files"):
+            return mirror, mirror.bundle(export_dir)
+
+    for file in export_dir.glob("media-*.zip"):
+        file.unlink()
+    return mirror, None
+
+
+def render_pages(  # noqa: PLR0913, PLR0914, PLR0917
+    wrapper: CollectionWrapper | CollectionClient,
+    decks: list["DeckNameId | None"],
+    stats: DeckStats,
+    manifest: BuildManifest,
+    mirror: MediaMirror,
+    media_bundle: Path | None,
+    references: MediaReferences,
+    analytics: ReviewAnalytics,
+) -> dict[Path, list[str]]:
+    """Return the parts of each page (they are joined when the page is written)."""
+    files: dict[Path, list[str]] = {}
+
+    if media_bundle:
+        media_line = (
+            "Les paquets ne contiennent pas les fichiers média : [:material-download: Télécharger les fichiers média]"
+        )
+        media_target = media_bundle
+    else:
+        media_line = "[Fichiers média manquants ? Cliquez ici]"
+        media_target = media_dir / "index.md"
+
+    for deck in decks:
+        output_file = wrapper.get_export_file(deck, export_dir)
+        entry = manifest.get(output_file)
+        size = format_size(entry["size"])
+
+        card_count = format_number(entry["card_count"])
+        modtime = format_datetime(dt.datetime.fromtimestamp(entry["modtime"], dt.UTC) if entry["modtime"] else None)
+        parts = deck.name.split("::") if deck else ""
+        review_stats = analytics.stats(deck, stats)
+
+        # file that will contain the link to the deck
+        # (page of the parent deck)
+        filename = docs_dir.joinpath(*parts[:-1], "index.md")
+        folder_icon = ""
+
+        if not deck or stats.has_children(deck):
+            # if the deck has children:
+            # - add a link to the deck page (that lists the subdecks) with a folder icon
+            # - create the deck page
+            new_filename = docs_dir.joinpath(*parts, "index.md")  # file to be linked (deck page)
+            output_url = link(new_filename, filename)
+            folder_icon = ":material-folder: "
+            # create the deck page
+            help_link = link(docs_dir.parent / "questions/start.md", new_filename)
+            search_link = link(docs_dir.parent / "search.md", new_filename)
+            preview_link = f"{link(docs_dir.parent / 'preview.md', new_filename)}#{preview_name(deck)}"
+            newline = "\n"
+            files[new_filename] = [
+                f"""\
+{HOMEPAGE_METADATA if not deck else GLOBAL_METADATA}
+# {deck.name if deck else HOMEPAGE_TITLE}
+
+{(HOMEPAGE_CONTENT if not deck else GLOBAL_CONTENT).replace("HELP", help_link).replace("SEARCH", search_link)}
 
-for filename, content in files.items():
-    with Progress(f"Writing {filename}"):
-        file = docs_dir / filename
-        file.parent.mkdir(parents=True, exist_ok=True)
-        file.write_text(content, encoding="utf-8")
+{media_line}({link(media_target, new_filename)}) \
+({format_number(len(references.for_deck(deck, stats)))} fichiers média utilisés)
 
-with Progress("Building documentation"):
-    now = dt.datetime.now(dt.UTC)
-    last_change = f"Dernière mise à jour : {format_datetime(now)}"
+[:material-download: Télécharger toutes les flashcards]({link(output_file, new_filename)}) ({size}) - \
+[Aperçu]({preview_link}){{ target=\"_blank\" }} (1)
+{{ .annotate }}
 
-    # Update the site URL
-    config["project"]["site_url"] = SITE_URL
+1. {"Dernière modification : " + modtime + newline + "  " if modtime != "-" else ""}\
+   Nombre de cartes : {card_count}
 
-    # Add the last change date
-    config["project"]["copyright"] = (config["project"].get("copyright", "") + "\n" + last_change).strip()
+{format_review_stats(review_stats)}
+{TEMPLATE}"""
+            ]
 
-    # Save the Zensical configuration
-    with zensical_config.open("w") as f:
-        toml.dump(config, f)
+        else:
+            output_url = link(output_file, filename)
 
-    # Build the documentation
-    sp.run(["uvx", "zensical", "build", "--clean"], check=True)  # noqa: S607
+        if deck:
+            # add a link to the deck / deck page
+            # (not for all the collection)
+            files[filename].append(
+                f'| \
+[{folder_icon}{parts[-1]}]({output_url}) | \
+[Aperçu]({link(docs_dir.parent / "preview.md", filename)}#{preview_name(deck)}){{ target="_blank" }} | \
+{size} | \
+{card_count} | \
+{format_number(review_stats.reviews)} | \
+{modtime}\n'
+            )
+
+    media_page = files[media_dir / "index.md"] = [MEDIA_PAGE]
+
+    if media_bundle:
+        media_page.append(f"""
+[:material-download: Télécharger tous les fichiers média]({link(media_bundle, media_dir / "index.md")}) \
+({format_size(media_bundle.stat().st_size)})
+""")
+
+    media_page.append("""
+| Nom du fichier { aria-sort="ascending" } | Paquets | Taille | Dernière modification |
+| ---------------------------------------- | ------- | ------ | --------------------- |
+""")
+
+    # top-level decks that use each file
+    deck_names = {deck.id: deck.name.split("::")[0] for deck in decks if deck}
+
+    def media_decks(name: str) -> str:
+        return ", ".join(
+            sorted({deck_names[deck_id] for deck_id in references.media_decks.get(name, ()) if deck_id in deck_names})
+        )
+
+    # sort the files so the page doesn't change if the media folder is listed in another order
+    for name, (size, mtime_ns) in sorted(mirror.files.items()):
+        mtime = dt.datetime.fromtimestamp(mtime_ns / 1e9, tz=dt.UTC)
+        media_page.append(f"""\
+| [{name}]({name}) | {media_decks(name) or "-"} | {format_size(size)} | {format_datetime(mtime)} |
+""")
+
+    if references.missing:
+        media_page.append("""
+## Fichiers absents de la collection
+
+Ces fichiers sont utilisés par des cartes mais n'existent pas dans la collection : ils ne peuvent pas être téléchargés.
+
+| Nom du fichier { aria-sort="ascending" } | Paquets |
+| ---------------------------------------- | ------- |
+""")
+        media_page.extend(f"| {name} | {media_decks(name)} |\n" for name in sorted(references.missing))
+
+    return files
+
+
+def write_pages(files: dict[Path, list[str]]) -> None:
+    """Write the pages that changed and remove the pages of the deleted decks."""
+    with Progress("Writing the pages"):
+        # only write the pages that changed, so they are not rebuilt by Zensical
+        written = [filename for filename, content in files.items() if write_if_changed(filename, "".join(content))]
+    print(f"{len(written)} pages written, {len(files) - len(written)} unchanged")
+
+    with Progress("Removing the pages of the deleted decks"):
+        for file in sorted(docs_dir.rglob("*"), reverse=True):
+            if file.is_file() and file not in files:
+                file.unlink()
+            elif file.is_dir() and not any(file.iterdir()):
+                file.rmdir()
+
+
+def build_site(config: dict, site_url: str) -> None:
+    """Build the documentation with Zensical."""
+    with Progress("Building documentation"):
+        # Save the last update date in a separate file, so the pages and the configuration don't change on every
+        # build (it is displayed by `js/last-update.js`)
+        write_if_changed(
+            docs_dir.parent / "build.json", json.dumps({"last_update": format_datetime(dt.datetime.now(dt.UTC))})
+        )
+
+        # Update the site URL (only if it changed, so the configuration stays the same between builds)
+        if config["project"]["site_url"] != site_url:
+            config["project"]["site_url"] = site_url
+            with zensical_config.open("w") as f:
+                toml.dump(config, f)
+
+        # Build the documentation
+        # (without `--clean`, Zensical only rebuilds the pages that changed)
+        sp.run(["uvx", "zensical", "build", *([] if NO_CLEAN else ["--clean"])], check=True)  # noqa: S603, S607
+
+
+def precompress_site(config: dict) -> None:
+    """Write the compressed copies of the text files of the built site (for the hosts that serve them)."""
+    precompressor = Precompressor(
+        Path(__file__).parent / config["project"].get("site_dir", "site"), cache_dir / "precompress_manifest.json", JOBS
+    )
+    with Progress("Compressing the site"):
+        precompressor.run()
+    print(precompressor.summary())
+
+
+def main(wrapper: CollectionWrapper | CollectionClient) -> None:
+    """Export all the flashcards of the (already synced) collection and build the documentation."""
+    manifest = BuildManifest(cache_dir / "export_manifest.json")
+
+    with Progress("Cleaning up"):
+        # the pages are only rewritten if they changed
+        # and the media folder is mirrored incrementally
+        docs_dir.mkdir(exist_ok=True)
+
+        # remove the exported files
+        # (in incremental mode, the stale exported files are removed after the export)
+        if not INCREMENTAL:
+            for file in export_dir.iterdir():
+                if file.suffix == ".apkg":
+                    file.unlink()
+
+    # Load the Zensical configuration
+    with zensical_config.open() as f:
+        config = toml.load(f)
+
+    site_url = os.getenv("SITE_URL", config["project"]["site_url"])
+
+    with Progress("Computing the deck statistics"):
+        stats = wrapper.deck_stats()
+
+    with Progress("Computing the fingerprint of the media folder"):
+        # the packages don't depend on the media in light mode
+        media_fingerprint = "" if LIGHT else wrapper.media_fingerprint()
+
+    # sort the decks so the parent deck appears before the child deck
+    decks = sorted(wrapper.all_decks(), key=lambda deck: deck.name if deck else "")
+
+    export_decks(wrapper, decks, stats, manifest, media_fingerprint)
+    build_previews(wrapper, decks, stats, site_url)
+    if not NO_SEARCH:
+        build_search_index(wrapper, decks, stats)
+    analytics = analyse_reviews(wrapper)
+    references = analyse_media(wrapper)
+    mirror, media_bundle = mirror_media(references)
+    write_pages(render_pages(wrapper, decks, stats, manifest, mirror, media_bundle, references, analytics))
+    build_site(config, site_url)
+    if not NO_PRECOMPRESS:
+        precompress_site(config)
+
+
+if __name__ == "__main__":
+    # use the collection service if it is running
+    wrapper = open_collection()
+    if "--no-sync" not in sys.argv:
+        with Progress("Syncing"):
+            wrapper.sync()
+
+    main(wrapper)
@@ -0,0 +1,66 @@
+"""Persistent manifest of the exported decks, used to skip unchanged decks in incremental builds."""
+
+import json
+from pathlib import Path
+from typing import Any
+
+
+class BuildManifest:
+    """
+    A JSON file that remembers what was exported during the previous build.
+
+    Each entry is keyed by the name of the exported file and contains the deck ID, the newest card modification
+    time, the card count, the fingerprint of the deck content and the size of the exported file.
+    """
+
+    VERSION = 1
+
+    def __init__(self, path: Path) -> None:
+        """Load the manifest from `path` (or start an empty one if it doesn't exist or is outdated)."""
+        self.path = path
+        self.media = ""
+        self.entries: dict[str, dict[str, Any]] = {}
+        try:
+            data = json.loads(path.read_text("utf-8"))
+        except (OSError, ValueError):
+            return
+        if data.get("version") != self.VERSION:
+            return
+        self.media = data.get("media", "")
+        self.entries = data.get("entries", {})
+
+    def is_fresh(self, output_file: Path, fingerprint: str, media: str) -> bool:
+        """Return `True` if `output_file` was exported from the same content and hasn't been modified since."""
+        entry = self.entries.get(output_file.name)
+        if not entry or entry["fingerprint"] != fingerprint or self.media != media:
+            return False
+        try:
+            return output_file.stat().st_size == entry["size"]
+        except OSError:
+            return False
+
+    def get(self, output_file: Path) -> dict[str, Any] | None:
+        """Return the entry of `output_file`, if any."""
+        return self.entries.get(output_file.name)
+
+    def update(self, output_file: Path, **entry: Any) -> None:  # noqa: ANN401
+        """Add or replace the entry of `output_file`."""
+        self.entries[output_file.name] = entry
+
+    def prune(self, output_files: list[Path]) -> list[str]:
+        """Remove the entries that are not in `output_files`. Return the names of the removed entries."""
+        keep = {output_file.name for output_file in output_files}
+        removed = [name for name in self.entries if name not in keep]
+        for name in removed:
+            del self.entries[name]
+        return removed
+
+    def save(self, media: str) -> None:
+        """Save the manifest, along with the fingerprint of the media folder used for this build."""
+        self.media = media
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(".tmp")
+        tmp.write_text(
+            json.dumps({"version": self.VERSION, "media": media, "entries": self.entries}, indent=1), "utf-8"
+        )
+        tmp.replace(self.path)
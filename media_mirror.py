@@ -0,0 +1,202 @@
+"""Mirror the media folder of the collection, copying only the files that changed since the previous build."""
+
+import errno
+import hashlib
+import json
+import os
+import shutil
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+# ioctl that clones a file on filesystems that support reflinks (Btrfs, XFS...)
+FICLONE = 0x40049409
+
+
+def file_hash(file: Path) -> str:
+    """Return the SHA-256 hash of a file."""
+    with file.open("rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+def reflink(source: Path, target: Path) -> None:
+    """
+    Clone `source` into `target` without copying the data.
+
+    Raises:
+        OSError: if the filesystem doesn't support reflinks.
+
+    """
+    if fcntl is None:
+        raise OSError(errno.ENOTSUP, "Reflinks are not supported on this platform")
+    with source.open("rb") as src, target.open("wb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            dst.close()
+            target.unlink(missing_ok=True)
+            raise
+    shutil.copystat(source, target)
+
+
+class MediaMirror:
+    """
+    Mirror a folder into another one, reusing the files that didn't change since the previous run.
+
+    A file is considered unchanged when its size and modification time (and its content hash, if `use_hash` is
+    `True`) are the same as during the previous run. The new and modified files are hardlinked, reflinked or copied
+    (whichever works first) in a thread pool, and the files that don't exist anymore are deleted.
+    """
+
+    def __init__(self, source: Path, target: Path, manifest: Path, use_hash: bool = False) -> None:
+        """Create a `MediaMirror`."""
+        self.source = source
+        self.target = target
+        self.manifest = manifest
+        self.use_hash = use_hash
+        # name -> (size, modification time in nanoseconds)
+        self.files: dict[str, tuple[int, int]] = {}
+        # name -> [size, modification time in nanoseconds, hash (if `use_hash` is `True`)]
+        self.entries: dict[str, list] = {}
+        # name -> file that is mirrored (in the source folder, or its replacement)
+        self.paths: dict[str, Path] = {}
+        self.copied = 0
+        self.linked = 0
+        self.unchanged = 0
+        self.removed = 0
+
+    def _load_manifest(self) -> dict[str, list]:
+        try:
+            return json.loads(self.manifest.read_text("utf-8"))
+        except (OSError, ValueError):
+            return {}
+
+    def _save_manifest(self, entries: dict[str, list]) -> None:
+        self.manifest.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.manifest.with_suffix(".tmp")
+        tmp.write_text(json.dumps(entries), "utf-8")
+        tmp.replace(self.manifest)
+
+    def _mirror_file(self, name: str) -> bool:
+        """Mirror a single file. Return `True` if it was linked, `False` if it was copied."""
+        source = self.paths[name]
+        target = self.target / name
+        target.unlink(missing_ok=True)
+        try:
+            os.link(source, target)
+        except OSError:
+            pass
+        else:
+            return True
+        try:
+            reflink(source, target)
+        except OSError:
+            shutil.copy2(source, target)
+            return False
+        return True
+
+    def run(
+        self,
+        keep: set[str] | None = None,
+        jobs: int | None = None,
+        only: set[str] | None = None,
+        replacements: dict[str, Path] | None = None,
+    ) -> None:
+        """
+        Mirror the files.
+
+        Args:
+            keep: names of files in the target folder that must not be deleted (e.g. generated pages).
+            jobs: number of threads used to copy the files.
+            only: names of the files to mirror (all the files by default), the other ones are deleted from the
+                target folder.
+            replacements: files to mirror instead of the files of the source folder, by name (e.g. optimised
+                copies).
+
+        """
+        keep = keep or set()
+        replacements = replacements or {}
+        previous = self._load_manifest()
+        self.target.mkdir(parents=True, exist_ok=True)
+
+        entries: dict[str, list] = {}
+        to_mirror: list[str] = []
+        with os.scandir(self.source) as it:
+            for entry in it:
+                if not entry.is_file() or (only is not None and entry.name not in only):
+                    continue
+                path = self.paths[entry.name] = replacements.get(entry.name, Path(entry.path))
+                stat = path.stat() if entry.name in replacements else entry.stat()
+                self.files[entry.name] = (stat.st_size, stat.st_mtime_ns)
+                old = previous.get(entry.name)
+                present = (self.target / entry.name).exists()
+                if present and old and old[:2] == [stat.st_size, stat.st_mtime_ns]:
+                    entries[entry.name] = old
+                    self.unchanged += 1
+                    continue
+                digest = file_hash(path) if self.use_hash else None
+                entries[entry.name] = [stat.st_size, stat.st_mtime_ns, digest]
+                if present and old and digest and old[2] == digest:
+                    # only the modification time changed (e.g. when the collection is restored from a cache)
+                    self.unchanged += 1
+                    continue
+                to_mirror.append(entry.name)
+
+        with ThreadPoolExecutor(jobs) as executor:
+            for linked in executor.map(self._mirror_file, to_mirror):
+                if linked:
+                    self.linked += 1
+                else:
+                    self.copied += 1
+
+        with os.scandir(self.target) as it:
+            for entry in it:
+                if entry.name not in self.files and entry.name not in keep and entry.is_file():
+                    Path(entry.path).unlink()
+                    self.removed += 1
+
+        self._save_manifest(entries)
+        self.entries = entries
+
+    def digest(self) -> str:
+        """
+        Return a digest of the mirrored files.
+
+        It only depends on the content of the files if `use_hash` is `True`, otherwise it also depends on their
+        modification times.
+        """
+        digest = hashlib.sha256()
+        for name, (size, mtime_ns, file_digest) in sorted(self.entries.items()):
+            digest.update(f"{name}\0{size}\0{file_digest or mtime_ns}\n".encode())
+        return digest.hexdigest()
+
+    def bundle(self, output_dir: Path) -> Path:
+        """
+        Write all the mirrored files in a ZIP archive named after their digest. Return its path.
+
+        The archive is only written if it doesn't exist yet, and the archives of the previous builds are removed.
+        """
+        bundle = output_dir / f"media-{self.digest()[:16]}.zip"
+        if not bundle.exists():
+            tmp = bundle.with_suffix(".tmp")
+            # the media files are already compressed (images, sounds...)
+            with zipfile.ZipFile(tmp, "w", zipfile.ZIP_STORED) as archive:
+                for name in sorted(self.files):
+                    archive.write(self.paths[name], name)
+            tmp.replace(bundle)
+        for file in output_dir.glob("media-*.zip"):
+            if file != bundle:
+                file.unlink()
+        return bundle
+
+    def summary(self) -> str:
+        """Return a human readable summary of the last run."""
+        return (
+            f"{self.copied} copied, {self.linked} linked, {self.unchanged} unchanged, {self.removed} removed "
+            f"({len(self.files)} files)"
+        )
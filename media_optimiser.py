@@ -0,0 +1,212 @@
+"""
+Recompress the media files of the collection for publication, in a process pool.
+
+The images are recompressed with Pillow and the sounds with `ffmpeg` (each is skipped if it is not installed). By
+default, only lossless optimisations are made: PNG and GIF files are compressed again, the Huffman tables of JPEG
+files are optimised with `jpegtran` (they are left as they are if it is not installed, as Pillow would decode and
+encode them again) and the metadata and cover art of the sounds are removed. A quality limit (`quality` for the
+images, `audio_bitrate` for the sounds) allows lossy recompression.
+
+The optimised copies are saved in a cache folder, named after the content hash of the original file and the
+settings, so each file is only processed once across builds. The collection itself is never modified.
+"""
+
+import hashlib
+import json
+import multiprocessing
+import shutil
+import subprocess as sp  # noqa: S404
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+try:
+    from PIL import Image
+except ImportError:  # optional, the images are not optimised without it
+    Image = None
+
+from media_mirror import file_hash
+from utils import format_size
+
+IMAGE_SUFFIXES = frozenset({".gif", ".jpeg", ".jpg", ".png", ".webp"})
+AUDIO_SUFFIXES = frozenset({".m4a", ".mp3", ".oga", ".ogg", ".opus"})
+
+
+def optimise_image(source: Path, target: Path, quality: int | None) -> None:
+    """
+    Write a recompressed copy of the image `source` to `target` (lossless if `quality` is `None`).
+
+    Raises:
+        ValueError: if the image can't be recompressed losslessly.
+
+    """
+    with Image.open(source) as image:
+        image_format = image.format
+        if image_format == "JPEG" and quality is None:
+            if not shutil.which("jpegtran"):
+                msg = "JPEG images are only recompressed losslessly with jpegtran"
+                raise ValueError(msg)
+            # the image data is kept as it is, only its encoding is optimised
+            command = ["jpegtran", "-optimize", "-progressive", "-copy", "all", "-outfile", str(target), str(source)]
+            sp.run(command, check=True, stdin=sp.DEVNULL)  # noqa: S603
+            return
+        # the color profile and the orientation are kept
+        options = {key: image.info[key] for key in ("icc_profile", "exif") if key in image.info}
+        options["optimize"] = True
+        if getattr(image, "is_animated", False):
+            options["save_all"] = True
+        if image_format == "JPEG":
+            options.update(quality=quality, progressive=True)
+        elif image_format == "WEBP":
+            if quality is None:
+                # a lossy image would get bigger if it is written again losslessly
+                msg = "WebP images are only recompressed with a quality limit"
+                raise ValueError(msg)
+            options["quality"] = quality
+        image.save(target, image_format, **options)
+
+
+def optimise_audio(source: Path, target: Path, bitrate: str | None) -> None:
+    """Write a copy of the sound `source` without metadata to `target` (encoded again if `bitrate` is given)."""
+    command = ["ffmpeg", "-v", "error", "-y", "-i", str(source)]
+    # only the sound is kept (not the cover art)
+    command += [
+        "-map",
+        "0:a",
+        "-map_metadata",
+        "-1",
+        *(["-b:a", bitrate] if bitrate else ["-c:a", "copy"]),
+        str(target),
+    ]
+    sp.run(command, check=True, stdin=sp.DEVNULL)  # noqa: S603
+
+
+def optimise_file(source: Path, target: Path, quality: int | None, audio_bitrate: str | None) -> int | None:
+    """
+    Write an optimised copy of `source` to `target`. Return its size.
+
+    Return `None` (and don't write `target`) if the file can't be optimised or if the copy is not smaller.
+    """
+    tmp = target.with_name(f"{target.stem}.tmp{target.suffix}")
+    try:
+        if source.suffix.lower() in IMAGE_SUFFIXES:
+            optimise_image(source, tmp, quality)
+        else:
+            optimise_audio(source, tmp, audio_bitrate)
+    except (OSError, ValueError, sp.CalledProcessError):
+        tmp.unlink(missing_ok=True)
+        return None
+    size = tmp.stat().st_size
+    if size >= source.stat().st_size:
+        tmp.unlink()
+        return None
+    tmp.replace(target)
+    return size
+
+
+class MediaOptimiser:
+    """
+    Optimise the media files of a folder, reusing the results of the previous builds.
+
+    The content hash of each file is saved in `cache_dir` with its size and modification time, so the unchanged
+    files are not read again.
+    """
+
+    VERSION = 2
+
+    def __init__(
+        self, cache_dir: Path, jobs: int | None = None, quality: int | None = None, audio_bitrate: str | None = None
+    ) -> None:
+        """Create a `MediaOptimiser`."""
+        self.cache_dir = cache_dir
+        self.manifest_file = cache_dir / "manifest.json"
+        self.jobs = jobs
+        self.quality = quality
+        self.audio_bitrate = audio_bitrate
+        self.suffixes = (IMAGE_SUFFIXES if Image is not None else frozenset()) | (
+            AUDIO_SUFFIXES if shutil.which("ffmpeg") else frozenset()
+        )
+        # name -> optimised copy of the file
+        self.optimised: dict[str, Path] = {}
+        self.files = 0
+        self.processed = 0
+        self.original_size = 0
+        self.optimised_size = 0
+
+    def _load_manifest(self) -> tuple[dict[str, list], dict[str, int | None]]:
+        try:
+            data = json.loads(self.manifest_file.read_text("utf-8"))
+        except (OSError, ValueError):
+            return {}, {}
+        if data.get("version") != self.VERSION:
+            return {}, {}
+        return data["hashes"], data["results"]
+
+    def _key(self, digest: str) -> str:
+        """Return the name of the optimised copy of a file (it depends on the content of the file and the settings)."""
+        return hashlib.sha256(f"{digest}\0{self.quality}\0{self.audio_bitrate}".encode()).hexdigest()
+
+    @staticmethod
+    def _hash(file: Path, previous: list | None) -> list:
+        """Return the size, the modification time and the content hash of a file (the hash is reused if possible)."""
+        stat = file.stat()
+        if previous and previous[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return previous
+        return [stat.st_size, stat.st_mtime_ns, file_hash(file)]
+
+    def run(self, folder: Path, names: set[str]) -> None:
+        """Optimise the files of `folder` whose name is in `names`."""
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        previous_hashes, previous_results = self._load_manifest()
+        hashes: dict[str, list] = {}
+        results: dict[str, int | None] = {}
+        keys: dict[str, str] = {}
+        to_process: list[str] = []
+
+        for name in sorted(names):
+            file = folder / name
+            if file.suffix.lower() not in self.suffixes or not file.is_file():
+                continue
+            hashes[name] = self._hash(file, previous_hashes.get(name))
+            key = keys[name] = f"{self._key(hashes[name][2])}{file.suffix.lower()}"
+            self.files += 1
+            if key in previous_results and (previous_results[key] is None or (self.cache_dir / key).exists()):
+                results[key] = previous_results[key]
+            else:
+                to_process.append(name)
+
+        # forking a process that runs other threads (e.g. the collection thread) is not safe
+        with ProcessPoolExecutor(self.jobs, mp_context=multiprocessing.get_context("spawn")) as executor:
+            for name, size in zip(
+                to_process,
+                executor.map(
+                    optimise_file,
+                    [folder / name for name in to_process],
+                    [self.cache_dir / keys[name] for name in to_process],
+                    [self.quality] * len(to_process),
+                    [self.audio_bitrate] * len(to_process),
+                ),
+                strict=True,
+            ):
+                results[keys[name]] = size
+                self.processed += 1
+
+        for name, key in keys.items():
+            if results[key] is not None:
+                self.optimised[name] = self.cache_dir / key
+                self.original_size += hashes[name][0]
+                self.optimised_size += results[key]
+
+        # remove the copies of the files that don't exist anymore (or that were optimised with other settings)
+        for file in self.cache_dir.iterdir():
+            if file != self.manifest_file and file.name not in results:
+                file.unlink()
+        self.manifest_file.write_text(
+            json.dumps({"version": self.VERSION, "hashes": hashes, "results": results}), "utf-8"
+        )
+
+    def summary(self) -> str:
+        """Return a human readable summary of the last run."""
+        return (
+            f"{len(self.optimised)} files optimised ({self.processed} processed, the other ones from the cache), "
+            f"{format_size(self.original_size - self.optimised_size)} saved ({self.files} optimisable files)"
+        )
@@ -0,0 +1,157 @@
+"""
+Find the media files used by each deck, and the media files that are missing or unused.
+
+All the notes are scanned in a single pass over a snapshot of the collection, with precompiled patterns for the HTML
+elements (`<img>`, `<audio>`...), the sounds (`[sound:...]`) and the CSS references (`url(...)`). The URLs of the
+HTML elements and of the CSS references are percent-decoded, as Anki's editor encodes the names of the files in them
+(e.g. `caf%C3%A9.jpg` for `café.jpg`), but not the names of the sounds. The files used by each note are cached with
+its modification time, so only the notes edited since the previous run are scanned again.
+"""
+
+import html
+import json
+import os
+import re
+import tempfile
+import urllib.parse
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from delta import connect
+from utils import DeckStats
+
+if TYPE_CHECKING:
+    from anki.decks import DeckNameId
+
+    from collection_service import CollectionClient
+    from utils import CollectionWrapper
+
+REFS_VERSION = 2
+
+# value of the `src` (or `data`) attribute of the HTML elements that load a file
+HTML_RE = re.compile(
+    r"""<(?:img|audio|video|source|track|object|embed)\b[^>]*?\s(?:src|data)\s*=\s*"""
+    r"""(?:"([^"]*)"|'([^']*)'|([^\s>]+))""",
+    re.IGNORECASE,
+)
+SOUND_RE = re.compile(r"\[sound:([^\]]+)\]")
+CSS_RE = re.compile(r"""url\(\s*(?:"([^"]*)"|'([^']*)'|([^)\s]+))\s*\)""", re.IGNORECASE)
+# URLs of files that are not in the media folder (`https://...`, `data:...`, `//...`)
+REMOTE_RE = re.compile(r"^(?:[a-z][a-z0-9+.-]*:|//)", re.IGNORECASE)
+
+
+def media_references(text: str) -> set[str]:
+    """Return the names of the media files referenced in a text (fields of a note, template or styling)."""
+    names = set()
+    # the CSS of the `style` attributes is HTML-escaped (e.g. `url(&quot;file.png&quot;)`)
+    unescaped = html.unescape(text)
+    for pattern, source, is_url in ((HTML_RE, text, True), (SOUND_RE, text, False), (CSS_RE, unescaped, True)):
+        for match in pattern.finditer(source):
+            name = html.unescape(next(group for group in match.groups() if group is not None)).strip()
+            if name and not REMOTE_RE.match(name):
+                names.add(urllib.parse.unquote(name) if is_url else name)
+    return names
+
+
+class MediaReferences:
+    """
+    The media files used by the decks of a collection.
+
+    The files used by the note type of a note (in its templates or its styling) count as used by the note. The files
+    whose name starts with `_` are never reported as unused, as Anki keeps them for the templates.
+    """
+
+    def __init__(self, cache_file: Path) -> None:
+        """Create a `MediaReferences` that caches the references of the notes in `cache_file`."""
+        self.cache_file = cache_file
+        # deck ID -> files used by the cards of the deck (not of its subdecks)
+        self.deck_media: dict[int, set[str]] = {}
+        # file -> IDs of the decks that use it
+        self.media_decks: dict[str, set[int]] = {}
+        # files that are used but not in the media folder
+        self.missing: set[str] = set()
+        # files of the media folder that are not used
+        self.unused: set[str] = set()
+        # files of the media folder that are used (or kept for the templates)
+        self.published: set[str] = set()
+        self.notes = 0
+        self.scanned = 0
+
+    def _load_cache(self) -> dict[str, list]:
+        try:
+            data = json.loads(self.cache_file.read_text("utf-8"))
+        except (OSError, ValueError):
+            return {}
+        return data["notes"] if data.get("version") == REFS_VERSION else {}
+
+    def _save_cache(self, notes: dict[str, list]) -> None:
+        self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.cache_file.with_suffix(".tmp")
+        tmp.write_text(json.dumps({"version": REFS_VERSION, "notes": notes}), "utf-8")
+        tmp.replace(self.cache_file)
+
+    def _scan(self, snapshot: Path) -> None:
+        """Find the files used by each deck in a snapshot of the collection."""
+        cached = self._load_cache()
+        notes: dict[str, list] = {}
+        conn = connect(snapshot)
+        try:
+            # the templates and the styling are in protobuf messages, but their text can be searched directly
+            notetype_media: dict[int, set[str]] = {}
+            for notetype_id, config in conn.execute(
+                "select id, config from notetypes union all select ntid, config from templates"
+            ):
+                notetype_media.setdefault(notetype_id, set()).update(media_references(config.decode("utf-8", "ignore")))
+
+            # only the notes that are new or were modified since the previous run are scanned
+            conn.execute("create temp table cached (id integer primary key, mod integer)")
+            conn.executemany("insert into cached values (?, ?)", ((int(nid), mod) for nid, (mod, _) in cached.items()))
+            for note_id, mod, fields in conn.execute(
+                "select n.id, n.mod, n.flds from notes n left join cached c on c.id = n.id where c.mod is not n.mod"
+            ):
+                cached[str(note_id)] = [mod, sorted(media_references(fields))]
+                self.scanned += 1
+
+            for note_id, deck_id, notetype_id in conn.execute(
+                "select c.nid, iif(c.odid, c.odid, c.did), n.mid from cards c join notes n on n.id = c.nid "
+                "group by c.nid, iif(c.odid, c.odid, c.did)"
+            ):
+                # the notes that were deleted are not kept in the cache
+                notes[str(note_id)] = cached[str(note_id)]
+                media = self.deck_media.setdefault(deck_id, set())
+                media.update(notes[str(note_id)][1])
+                media.update(notetype_media.get(notetype_id, ()))
+        finally:
+            conn.close()
+        self.notes = len(notes)
+        self._save_cache(notes)
+
+    def run(self, wrapper: "CollectionWrapper | CollectionClient") -> None:
+        """Find the files used by each deck and compare them with the media folder of the collection."""
+        with tempfile.TemporaryDirectory() as tmp:
+            self._scan(wrapper.snapshot(Path(tmp) / "snapshot.anki2"))
+
+        for deck_id, media in self.deck_media.items():
+            for name in media:
+                self.media_decks.setdefault(name, set()).add(deck_id)
+        with os.scandir(wrapper.media_dir()) as entries:
+            present = {entry.name for entry in entries if entry.is_file()}
+        self.missing = self.media_decks.keys() - present
+        self.unused = {name for name in present - self.media_decks.keys() if not name.startswith("_")}
+        self.published = present - self.unused
+
+    def for_deck(self, deck: "DeckNameId | None", stats: DeckStats) -> set[str]:
+        """Return the files used by a deck and its subdecks (or by the whole collection)."""
+        if deck is None:
+            return set(self.media_decks)
+        media = set(self.deck_media.get(deck.id, ()))
+        for child in stats.children(deck):
+            media |= self.for_deck(child, stats)
+        return media
+
+    def summary(self) -> str:
+        """Return a human readable summary of the last run."""
+        return (
+            f"{self.scanned} of {self.notes} notes scanned, {len(self.media_decks)} files used, "
+            f"{len(self.missing)} missing, {len(self.unused)} unused"
+        )
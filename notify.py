@@ -3,121 +3,162 @@
 import json
 import os
 import sys
+import time
 from pathlib import Path
-from typing import Any
-from urllib.error import HTTPError
-from urllib.request import Request, urlopen
 
+from collection_service import CollectionClient, due_counts, open_collection
+from due import DueCounter, DueCounts
 from progress import Progress
+from telegram_client import TelegramClient
 from utils import CollectionWrapper
 
+BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "")
+# IDs of the chats that receive the message (separated by commas)
+CHAT_IDS = [chat_id.strip() for chat_id in os.getenv("TELEGRAM_CHAT_ID", "").split(",") if chat_id.strip()]
+# base URL of the Telegram API (can be changed to use a local server)
+API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org")
 
-def make_request(bot_token: str, method: str, params: dict) -> Any:  # noqa: ANN401
-    """
-    Make a request to the Telegram API.
+client = TelegramClient(BOT_TOKEN, API_URL, timeout=float(os.getenv("TELEGRAM_TIMEOUT", "10")))
 
-    Raises:
-        RuntimeError: if the call to the Telegram API fails.
+MESSAGE_ID_FILE = Path(__file__).parent / ".message_id"
 
-    """
-    error = False
-    try:
-        with urlopen(
-            Request(
-                f"https://api.telegram.org/bot{bot_token}/{method}",
-                json.dumps(params).encode(),
-                {"Content-Type": "application/json"},
-                method="POST",
-            )
-        ) as f:
-            data = json.load(f)
-    except HTTPError as e:
-        error = e
-        data = json.load(e.file)
+# keep the collection open and update the message when the due cards change
+WATCH = "--watch" in sys.argv
+# number of seconds between two checks in watch mode (`--interval=N`)
+INTERVAL = next((float(arg.removeprefix("--interval=")) for arg in sys.argv if arg.startswith("--interval=")), 60)
 
-    if not data["ok"] or error:
-        msg = f"Failed to call Telegram API: {data['description']}"
-        if error:
-            new_error = RuntimeError(msg)
-            new_error.data = data
-            raise new_error from error
-        raise RuntimeError(msg)
 
-    return data["result"]
+def format_message(counts: DueCounts) -> str | None:
+    """Return the message that shows the due cards (or `None` if there are no due cards)."""
+    if not counts.total:
+        return None
+    return (
+        f"Review your flashcards today!\n"
+        "\n"
+        f"New cards: {counts.new}\n"
+        f"Learning cards: {counts.learn}\n"
+        f"Cards to review: {counts.review}\n"
+        "\n"
+        f"Next days: {', '.join(map(str, counts.forecast[1:]))}"
+    )
 
 
-def send_telegram_message(bot_token: str, chat_id: str, message: str) -> None:
-    """
-    Send a message to a Telegram chat.
+def read_message_ids() -> dict[str, str]:
+    """Return the ID of the previous message in each chat."""
+    try:
+        message_ids = json.loads(MESSAGE_ID_FILE.read_text("utf-8") or "{}")
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(message_ids, dict):
+        # file written when only one chat was supported
+        return {CHAT_IDS[0]: str(message_ids)} if CHAT_IDS else {}
+    return message_ids
 
-    Args:
-        bot_token (str): Token of the Telegram bot.
-        chat_id (str): ID of the Telegram chat.
-        message (str): The message to send.
 
-    """
-    return make_request(bot_token, "sendMessage", {"chat_id": chat_id, "text": message})
+def write_message_ids(message_ids: dict[str, str]) -> None:
+    """Save the ID of the message in each chat."""
+    MESSAGE_ID_FILE.write_text(json.dumps({chat_id: id_ for chat_id, id_ in message_ids.items() if id_}), "utf-8")
 
 
-def delete_telegram_message(bot_token: str, chat_id: str, message_id: str) -> None:
+def update_message(chat_id: str, message_id: str, message: str | None) -> str:
     """
-    Delete a message in a Telegram chat.
-
-    Args:
-        bot_token (str): Token of the Telegram bot.
-        chat_id (str): ID of the Telegram chat.
-        message_id (str): The ID of the message to delete.
+    Replace the text of the message `message_id` (if any) by `message`. Return the ID of the updated message.
 
-    Raises:
-        RuntimeError: if the call to the Telegram API fails and the message to delete exists.
+    The message is deleted if `message` is `None`, and a new message is sent if it doesn't exist.
+    """
+    if message_id and not message:
+        client.delete_message(chat_id, message_id)
+        return ""
+    if message_id and not client.edit_message(chat_id, message_id, message):
+        message_id = ""
+    if message and not message_id:
+        # new message (with a notification) when cards become due
+        message_id = str(client.send_message(chat_id, message)["message_id"])
+    return message_id
+
+
+def watch(wrapper: CollectionWrapper, interval: float, sync: bool = True) -> None:
+    """
+    Keep the message up to date with the due cards, checking the collection every `interval` seconds.
 
+    The sync is skipped when the server has no changes and the cards are only counted again when the collection
+    changed (see `DueCounter`). The message is edited when the counts change and deleted when there are no due
+    cards anymore, so a new message (and notification) is only sent when cards become due.
     """
-    try:
-        return make_request(bot_token, "deleteMessage", {"chat_id": chat_id, "message_id": message_id})
-    except RuntimeError as e:
-        if "message to delete not found" in e.data.get("description", ""):
-            print("Previous message has been deleted, skipping deletion")
-        else:
-            raise
+    counter = DueCounter(wrapper)
+    message_ids = read_message_ids()
+    # text of the message in each chat
+    texts: dict[str, str | None] = {}
+    printed = ""
+    while True:
+        if sync:
+            try:
+                wrapper.sync()
+            except Exception as err:  # noqa: BLE001
+                # try again at the next check
+                print(f"Sync failed: {type(err).__name__}: {err}", file=sys.stderr)
+
+        text = format_message(counter.counts())
+        if chat_ids := [chat_id for chat_id in CHAT_IDS if chat_id not in texts or texts[chat_id] != text]:
+            if text != printed:
+                print(text or "No flashcards to review", flush=True)
+                printed = text
+            results = client.for_each_chat(
+                lambda chat_id: update_message(chat_id, message_ids.get(chat_id, ""), text),  # noqa: B023
+                chat_ids,
+            )
+            for chat_id, result in results.items():
+                if isinstance(result, Exception):
+                    # try again at the next check
+                    print(
+                        f"Failed to update the message in {chat_id}: {type(result).__name__}: {result}", file=sys.stderr
+                    )
+                else:
+                    message_ids[chat_id] = result
+                    texts[chat_id] = text
+            write_message_ids(message_ids)
 
+        time.sleep(interval)
 
-BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "")
-CHAT_ID = os.getenv("TELEGRAM_CHAT_ID", "")
 
-MESSAGE_ID_FILE = Path(__file__).parent / ".message_id"
+def main(wrapper: CollectionWrapper | CollectionClient) -> None:
+    """
+    Send a Telegram message to each chat if there are due cards in the (already synced) collection.
 
-if MESSAGE_ID_FILE.exists():
-    message_id = MESSAGE_ID_FILE.read_text("utf-8").strip()
-    if message_id:
-        delete_telegram_message(BOT_TOKEN, CHAT_ID, message_id)
-
-MESSAGE_ID_FILE.write_text("")
-
-wrapper = CollectionWrapper()
-if "--no-sync" not in sys.argv:
-    with Progress("Syncing"):
-        wrapper.sync()
-
-counts = {
-    "new": 0,
-    "learn": 0,
-    "review": 0,
-}
-for deck in wrapper.col.sched.deck_due_tree().children:
-    counts["new"] += deck.new_count
-    counts["learn"] += deck.learn_count
-    counts["review"] += deck.review_count
-
-if counts["new"] > 0 or counts["learn"] > 0 or counts["review"] > 0:
-    message = (
-        f"Review your flashcards today!\n"
-        "\n"
-        f"New cards: {counts['new']}\n"
-        f"Learning cards: {counts['learn']}\n"
-        f"Cards to review: {counts['review']}"
+    If the previous message can't be deleted or the new message can't be sent in a chat, the first error is raised
+    once all the chats have been handled.
+    """
+    previous_ids = read_message_ids()
+    deleted = client.for_each_chat(
+        lambda chat_id: update_message(chat_id, previous_ids.get(chat_id, ""), None), CHAT_IDS
     )
-    print(message)
-    result = send_telegram_message(BOT_TOKEN, CHAT_ID, message)
-    MESSAGE_ID_FILE.write_text(str(result["message_id"]), "utf-8")
-else:
-    print("No flashcards to review")
+    write_message_ids({})
+
+    message = format_message(due_counts(wrapper))
+
+    sent = {}
+    if message:
+        print(message)
+        sent = client.for_each_chat(lambda chat_id: update_message(chat_id, "", message), CHAT_IDS)
+        write_message_ids({chat_id: result for chat_id, result in sent.items() if isinstance(result, str)})
+    else:
+        print("No flashcards to review")
+
+    # the error of a chat is kept even if the next step succeeded in it
+    errors = [result for results in (deleted, sent) for result in results.values() if isinstance(result, Exception)]
+    if errors:
+        raise errors[0]
+
+
+if __name__ == "__main__":
+    if WATCH:
+        # the watch mode keeps its own collection open
+        watch(CollectionWrapper(), INTERVAL, sync="--no-sync" not in sys.argv)
+    else:
+        # use the collection service if it is running
+        wrapper = open_collection()
+        if "--no-sync" not in sys.argv:
+            with Progress("Syncing"):
+                wrapper.sync()
+
+        main(wrapper)
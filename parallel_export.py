@@ -0,0 +1,146 @@
+"""Export decks in parallel, in worker processes that each open their own snapshot of the collection."""
+
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import dataclass
+from functools import partial
+from pathlib import Path
+from types import TracebackType
+from typing import TYPE_CHECKING, Self
+
+if TYPE_CHECKING:
+    from anki.decks import DeckNameId
+
+    from collection_service import CollectionClient
+
+from progress import Progress, Stage, tracer
+from utils import CollectionWrapper
+
+# the collection opened by the current worker process
+_worker: CollectionWrapper | None = None
+
+
+def default_jobs() -> int:
+    """Return the default number of worker processes (the number of CPUs available to this process)."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def _init_worker(snapshot: Path, media_dir: Path, work_dir: Path) -> None:
+    """Open a private copy of the snapshot in a worker process."""
+    global _worker  # noqa: PLW0603
+
+    # Anki opens the collection with an exclusive lock, so each worker needs its own copy
+    worker_dir = Path(tempfile.mkdtemp(dir=work_dir))
+    file = worker_dir / "collection.anki2"
+    shutil.copyfile(snapshot, file)
+    # the media are read from the folder next to the collection
+    (worker_dir / "collection.media").symlink_to(media_dir, target_is_directory=True)
+    _worker = CollectionWrapper(file)
+
+
+@dataclass
+class ExportResult:
+    """An exported file and the time it took to export it (in seconds, in the worker process)."""
+
+    file: Path
+    duration: float
+
+
+def _export(
+    deck: "DeckNameId | None", output_dir: Path, full_backup: bool, with_media: bool, legacy: bool
+) -> tuple[ExportResult, list[Stage]]:
+    """
+    Export a deck from the collection of the current worker process. Return the result and the stages.
+
+    Raises:
+        RuntimeError: if the worker process has not been initialized.
+
+    """
+    if _worker is None:
+        msg = "The worker process has not been initialized"
+        raise RuntimeError(msg)
+    start = time.perf_counter()
+    with Progress(f"Export {deck.name if deck else 'all the collection'}", quiet=True):
+        output_file = _worker.export(deck, output_dir, full_backup, with_media, legacy)
+    # the stages are recorded in the main process
+    return ExportResult(output_file, time.perf_counter() - start), tracer.take()
+
+
+def _record_stages(future: Future[tuple[ExportResult, list[Stage]]], result: Future[ExportResult]) -> None:
+    """Record the stages of a finished export and set the result of the export as the result of `result`."""
+    if err := future.exception():
+        result.set_exception(err)
+    else:
+        export_result, stages = future.result()
+        tracer.add(*stages)
+        result.set_result(export_result)
+
+
+class ParallelExporter:
+    """
+    A pool of processes that export decks in parallel.
+
+    The collection is copied into a consistent read-only snapshot when the pool starts, and every worker opens
+    its own copy of that snapshot, so the exports don't have to wait for each other on a single collection.
+    The number of processes is bounded by `jobs` to keep the memory usage under control.
+    """
+
+    def __init__(self, wrapper: "CollectionWrapper | CollectionClient", jobs: int | None = None) -> None:
+        """Create a `ParallelExporter` for the collection of `wrapper`."""
+        self.wrapper = wrapper
+        self.jobs = max(1, jobs or default_jobs())
+        self._tmp: tempfile.TemporaryDirectory | None = None
+        self._pool: ProcessPoolExecutor | None = None
+
+    def __enter__(self) -> Self:
+        """Take the snapshot and start the worker processes."""
+        self._tmp = tempfile.TemporaryDirectory()
+        work_dir = Path(self._tmp.name)
+        snapshot = self.wrapper.snapshot(work_dir / "snapshot.anki2")
+        self._pool = ProcessPoolExecutor(
+            max_workers=self.jobs,
+            # forking a process that runs other threads (e.g. the collection thread) is not safe
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(snapshot, self.wrapper.media_dir(), work_dir),
+        )
+        return self
+
+    def __exit__(self, exc: type[BaseException] | None, value: BaseException | None, tb: TracebackType | None) -> None:
+        """Stop the worker processes and remove the snapshots."""
+        if self._pool:
+            self._pool.shutdown(cancel_futures=exc is not None)
+            self._pool = None
+        if self._tmp:
+            self._tmp.cleanup()
+            self._tmp = None
+
+    def submit(
+        self,
+        deck: "DeckNameId | None",
+        output_dir: str | Path,
+        full_backup: bool = False,
+        with_media: bool = True,
+        legacy: bool = True,
+    ) -> Future[ExportResult]:
+        """
+        Schedule the export of a deck. Return a future that resolves to the exported file and the export time.
+
+        Raises:
+            RuntimeError: if the exporter is not started.
+
+        """
+        if not self._pool:
+            msg = "The exporter must be used as a context manager"
+            raise RuntimeError(msg)
+        result: Future[ExportResult] = Future()
+        future = self._pool.submit(_export, deck, Path(output_dir).absolute(), full_backup, with_media, legacy)
+        future.add_done_callback(partial(_record_stages, result=result))
+        return result
@@ -0,0 +1,154 @@
+"""Write compressed copies (`.gz` and `.br`) of the text files of the built site, for the hosts that serve them."""
+
+import gzip
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+try:
+    import brotli
+except ImportError:  # optional, only the `.gz` files are written without it
+    brotli = None
+
+from utils import format_size
+
+# files that are worth compressing (the packages and the media files are already compressed)
+COMPRESSIBLE_SUFFIXES = frozenset({".css", ".html", ".js", ".json", ".map", ".svg", ".txt", ".xml"})
+# smaller files are sent in a single packet anyway
+MIN_SIZE = 512
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    """Compress `data` with `encoding` (`gz` or `br`) at the highest level (the result only depends on `data`)."""
+    if encoding == "br":
+        return brotli.compress(data, quality=11)
+    return gzip.compress(data, 9, mtime=0)
+
+
+def compress_file(
+    file: Path, encodings: tuple[str, ...], not_smaller: list[str]
+) -> tuple[dict[str, tuple[int, int]], list[str]]:
+    """
+    Write the compressed copies of `file` that are not up to date.
+
+    A copy is up to date when it has the same modification time as the file, and is removed if it is not smaller than
+    the file. `not_smaller` contains the encodings whose copy of the current version of the file was not smaller (they
+    are not tried again). Return the size of the file and of each compressed copy that was written, by encoding, and
+    the encodings whose copy is not smaller.
+    """
+    stat = file.stat()
+    data = None
+    written = {}
+    skipped = []
+    for encoding in encodings:
+        target = file.with_name(f"{file.name}.{encoding}")
+        if encoding in not_smaller:
+            skipped.append(encoding)
+            continue
+        try:
+            if target.stat().st_mtime_ns == stat.st_mtime_ns:
+                continue
+        except OSError:
+            pass
+        if data is None:
+            data = file.read_bytes()
+        compressed = compress(data, encoding)
+        if len(compressed) >= len(data):
+            target.unlink(missing_ok=True)
+            skipped.append(encoding)
+            continue
+        tmp = target.with_name(f"{target.name}.tmp")
+        tmp.write_bytes(compressed)
+        # the modification time tells which version of the file the copy comes from
+        os.utime(tmp, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        tmp.replace(target)
+        written[encoding] = (len(data), len(compressed))
+    return written, skipped
+
+
+class Precompressor:
+    """
+    Write compressed copies of the text files of a folder next to them, in a process pool.
+
+    The copies that are already up to date are kept, and the copies of the files that don't exist anymore (or that
+    became smaller than `MIN_SIZE`) are removed. The files whose copies are not smaller are saved in `manifest` with
+    their size and modification time, so they are not compressed again until they change.
+    """
+
+    def __init__(self, folder: Path, manifest: Path, jobs: int | None = None) -> None:
+        """Create a `Precompressor`."""
+        self.folder = folder
+        self.manifest = manifest
+        self.jobs = jobs
+        self.encodings = ("gz", "br") if brotli is not None else ("gz",)
+        self.files = 0
+        # number of written copies, size of the original files and of the copies, by encoding
+        self.written = dict.fromkeys(self.encodings, 0)
+        self.original_size = dict.fromkeys(self.encodings, 0)
+        self.compressed_size = dict.fromkeys(self.encodings, 0)
+        self.removed = 0
+
+    def _load_manifest(self) -> dict[str, list]:
+        try:
+            return json.loads(self.manifest.read_text("utf-8"))
+        except (OSError, ValueError):
+            return {}
+
+    def _save_manifest(self, entries: dict[str, list]) -> None:
+        self.manifest.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.manifest.with_suffix(".tmp")
+        tmp.write_text(json.dumps(entries), "utf-8")
+        tmp.replace(self.manifest)
+
+    def run(self) -> None:
+        """Compress the files."""
+        # relative path -> size, modification time and encodings whose copies are not smaller
+        previous = self._load_manifest()
+        files = []
+        not_smaller = []
+        for file in self.folder.rglob("*"):
+            if file.suffix in {".gz", ".br"} and file.parent.joinpath(file.stem).suffix in COMPRESSIBLE_SUFFIXES:
+                original = file.parent.joinpath(file.stem)
+                # the copies of the small files may be outdated
+                if not original.exists() or original.stat().st_size < MIN_SIZE:
+                    file.unlink()
+                    self.removed += 1
+            elif file.suffix in COMPRESSIBLE_SUFFIXES and file.is_file() and (stat := file.stat()).st_size >= MIN_SIZE:
+                files.append(file)
+                entry = previous.get(file.relative_to(self.folder).as_posix())
+                not_smaller.append(entry[2] if entry and entry[:2] == [stat.st_size, stat.st_mtime_ns] else [])
+        self.files = len(files)
+
+        entries = {}
+        # forking a process that runs other threads (e.g. the collection thread) is not safe
+        with ProcessPoolExecutor(self.jobs, mp_context=multiprocessing.get_context("spawn")) as executor:
+            for file, (written, skipped) in zip(
+                files,
+                executor.map(
+                    compress_file,
+                    files,
+                    [self.encodings] * len(files),
+                    not_smaller,
+                    chunksize=max(1, len(files) // 64),
+                ),
+                strict=True,
+            ):
+                for encoding, (original, compressed) in written.items():
+                    self.written[encoding] += 1
+                    self.original_size[encoding] += original
+                    self.compressed_size[encoding] += compressed
+                if skipped:
+                    stat = file.stat()
+                    entries[file.relative_to(self.folder).as_posix()] = [stat.st_size, stat.st_mtime_ns, skipped]
+        self._save_manifest(entries)
+
+    def summary(self) -> str:
+        """Return a human readable summary of the last run."""
+        parts = [
+            f"{self.written[encoding]} .{encoding} written "
+            f"({format_size(self.original_size[encoding] - self.compressed_size[encoding])} saved)"
+            for encoding in self.encodings
+        ]
+        return f"{', '.join(parts)}, {self.removed} removed ({self.files} compressible files)"
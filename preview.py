@@ -0,0 +1,161 @@
+"""
+Lightweight previews of the decks, read by `docs/js/deck-preview.js`.
+
+A preview is a small JSON file with the first cards of a deck (rendered), the templates and the styling of their
+note types and the names of the media files they use, which are loaded one by one from the media folder of the site.
+Opening it downloads a few kilobytes instead of the whole package of the deck.
+"""
+
+import html
+import json
+import re
+from pathlib import Path
+from typing import TYPE_CHECKING, Any
+
+from utils import DeckStats, write_if_changed
+
+if TYPE_CHECKING:
+    from anki.collection import Collection
+    from anki.decks import DeckNameId
+
+    from collection_service import CollectionClient
+    from utils import CollectionWrapper
+
+PREVIEW_VERSION = 1
+# number of cards in each preview
+PREVIEW_CARDS = 20
+
+# reference to a sound of the question (`q`) or of the answer (`a`) in the rendered text of a card
+AV_REF_RE = re.compile(r"\[anki:play:([qa]):(\d+)\]")
+
+
+def preview_name(deck: "DeckNameId | None") -> str:
+    """Return the name of the preview of a deck (or of the whole collection), without extension."""
+    return str(deck.id) if deck else "all"
+
+
+def render_cards(col: "Collection", deck: "DeckNameId | None", limit: int) -> dict[str, Any]:
+    """
+    Render the first `limit` cards of a deck and of its subdecks (in the order the notes were added).
+
+    The sounds are replaced by `<audio>` elements. This must be called in the thread that owns the collection.
+    """
+    query = "select id from cards"
+    args: list[int] = []
+    if deck:
+        deck_ids = col.decks.deck_and_child_ids(deck.id)
+        placeholders = ", ".join("?" * len(deck_ids))
+        # the cards of the filtered decks count in their original deck
+        query += f" where did in ({placeholders}) or odid in ({placeholders})"
+        args += [*deck_ids, *deck_ids]
+
+    notetypes: dict[str, dict[str, Any]] = {}
+    cards = []
+    # the cards are loaded and rendered one at a time
+    for card_id in col.db.list(f"{query} order by nid, ord limit ?", *args, limit):
+        card = col.get_card(card_id)
+        output = card.render_output()
+        av_tags = {"q": output.question_av_tags, "a": output.answer_av_tags}
+        media: set[str] = set()
+
+        def replace_av_ref(match: re.Match, av_tags: dict[str, list] = av_tags, media: set[str] = media) -> str:
+            filename = getattr(av_tags[match[1]][int(match[2])], "filename", None)
+            if filename is None:
+                # text to speech can't be previewed
+                return ""
+            media.add(filename)
+            return f'<audio controls src="{html.escape(filename)}"></audio>'
+
+        question = AV_REF_RE.sub(replace_av_ref, output.question_text)
+        answer = AV_REF_RE.sub(replace_av_ref, output.answer_text)
+        notetype_id = card.note().mid
+        media.update(col.media.files_in_str(notetype_id, f"{question}{answer}"))
+
+        if str(notetype_id) not in notetypes:
+            notetype = col.models.get(notetype_id)
+            notetypes[str(notetype_id)] = {
+                "name": notetype["name"],
+                "css": notetype["css"],
+                "templates": [
+                    {"name": template["name"], "question": template["qfmt"], "answer": template["afmt"]}
+                    for template in notetype["tmpls"]
+                ],
+                # files used by the styling or the templates (e.g. fonts)
+                "media": sorted(col.media.extract_static_media_files(notetype_id)),
+            }
+
+        cards.append({
+            "id": card.id,
+            "notetype": str(notetype_id),
+            "template": card.ord,
+            "question": question,
+            "answer": answer,
+            "media": sorted(name for name in media if col.media.have(name)),
+        })
+
+    return {"notetypes": notetypes, "cards": cards}
+
+
+class DeckPreviews:
+    """
+    The previews of the decks, written in `output_dir`.
+
+    The fingerprint of each preview is saved in `manifest_file`, so only the previews of the decks that changed are
+    rendered again.
+    """
+
+    def __init__(self, output_dir: Path, manifest_file: Path) -> None:
+        """Create a `DeckPreviews`."""
+        self.output_dir = output_dir
+        self.manifest_file = manifest_file
+        self.written = 0
+        self.unchanged = 0
+
+    def _load_manifest(self) -> dict[str, str]:
+        try:
+            data = json.loads(self.manifest_file.read_text("utf-8"))
+        except (OSError, ValueError):
+            return {}
+        return data["decks"] if data.get("version") == PREVIEW_VERSION else {}
+
+    def build(
+        self,
+        wrapper: "CollectionWrapper | CollectionClient",
+        decks: list["DeckNameId | None"],
+        stats: DeckStats,
+        links: dict[str, dict[str, str]],
+    ) -> None:
+        """
+        Write the previews of the decks that changed since the previous build and remove the stale ones.
+
+        `links` contains the links added to each preview (e.g. to the package of the deck), by preview name.
+        """
+        previous = self._load_manifest()
+        fingerprints = {}
+        for deck in decks:
+            name = preview_name(deck)
+            fingerprint = stats.fingerprint(deck, PREVIEW_VERSION, PREVIEW_CARDS, links.get(name))
+            fingerprints[name] = fingerprint
+            file = self.output_dir / f"{name}.json"
+            if previous.get(name) == fingerprint and file.exists():
+                self.unchanged += 1
+                continue
+            preview = {
+                "version": PREVIEW_VERSION,
+                "deck": deck.name if deck else None,
+                "card_count": stats.card_count(deck),
+                **links.get(name, {}),
+                **wrapper.preview_cards(deck, PREVIEW_CARDS),
+            }
+            write_if_changed(file, json.dumps(preview, ensure_ascii=False))
+            self.written += 1
+
+        for file in self.output_dir.glob("*.json"):
+            if file.stem not in fingerprints:
+                file.unlink()
+        self.manifest_file.parent.mkdir(parents=True, exist_ok=True)
+        self.manifest_file.write_text(json.dumps({"version": PREVIEW_VERSION, "decks": fingerprints}), "utf-8")
+
+    def summary(self) -> str:
+        """Return a human readable summary of the last build."""
+        return f"{self.written} previews written, {self.unchanged} unchanged"
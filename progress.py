@@ -1,24 +1,196 @@
-"""Utilities for progress messages."""
+"""Utilities for progress messages, and timing of the stages they describe."""
 
+import atexit
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
 from types import TracebackType
 from typing import Self
 
+# write the timings of all the stages to a file in the Chrome trace event format (`--trace=FILE`), that can be
+# opened in https://ui.perfetto.dev or chrome://tracing
+TRACE_FILE = next((Path(arg.removeprefix("--trace=")) for arg in sys.argv if arg.startswith("--trace=")), None)
+# print the slowest stages at the end
+TIMINGS = "--timings" in sys.argv
+
+
+@dataclass
+class Stage:
+    """
+    A finished stage, with its start time, wall time and CPU time (in nanoseconds).
+
+    The CPU time is the one of the whole process (the work of a stage is often done in another thread, e.g. the
+    collection thread), so it also counts the other threads that run at the same time.
+    """
+
+    name: str
+    start: int
+    wall: int
+    cpu: int
+    pid: int
+    tid: int
+    thread: str
+    depth: int
+    error: bool = False
+
+
+class Tracer:
+    """
+    Collect the stages of all the threads (and of the worker processes that send them back).
+
+    The stages are only kept if `enabled` is `True`, so a long-running process (e.g. the collection service) doesn't
+    accumulate them when they are never reported.
+    """
+
+    def __init__(self, enabled: bool = True) -> None:
+        """Create an empty `Tracer`."""
+        self.enabled = enabled
+        self.stages: list[Stage] = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def stack(self) -> list["Progress"]:
+        """Return the stages that are running in the current thread, from the outermost to the innermost."""
+        try:
+            return self._local.stack
+        except AttributeError:
+            self._local.stack = []
+            return self._local.stack
+
+    def add(self, *stages: Stage) -> None:
+        """Add finished stages (ignored if the `Tracer` is not enabled)."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self.stages.extend(stages)
+
+    def take(self) -> list[Stage]:
+        """Remove all the stages and return them (e.g. to send them from a worker process)."""
+        with self._lock:
+            stages, self.stages = self.stages, []
+        return stages
+
+    def write_trace(self, file: Path) -> None:
+        """Write the stages to `file` in the Chrome trace event format."""
+        with self._lock:
+            stages = list(self.stages)
+        events: list[dict] = [
+            {"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": thread}}
+            for pid, tid, thread in {(stage.pid, stage.tid, stage.thread) for stage in stages}
+        ]
+        events.extend(
+            {
+                "name": stage.name,
+                "cat": "error" if stage.error else "stage",
+                "ph": "X",
+                "ts": stage.start / 1000,
+                "dur": stage.wall / 1000,
+                "pid": stage.pid,
+                "tid": stage.tid,
+                "args": {"cpu_ms": stage.cpu / 1e6},
+            }
+            for stage in stages
+        )
+        file.write_text(json.dumps({"traceEvents": events, "displayTimeUnit": "ms"}), "utf-8")
+
+    def summary(self, count: int = 10) -> str:
+        """Return a table of the `count` slowest stages."""
+        with self._lock:
+            stages = sorted(self.stages, key=lambda stage: stage.wall, reverse=True)[:count]
+        width = max((len(stage.thread) for stage in stages), default=0)
+        lines = [f"{'Wall (s)':>9} {'CPU (s)':>9}  {'Thread':<{width}}  Stage"]
+        lines.extend(
+            f"{stage.wall / 1e9:9.3f} {stage.cpu / 1e9:9.3f}  {stage.thread:<{width}}  {'  ' * stage.depth}{stage.name}"
+            for stage in stages
+        )
+        return "\n".join(lines)
+
+
+# the stages are only recorded if they are reported at the end
+tracer = Tracer(enabled=TRACE_FILE is not None or TIMINGS)
+
+# lock that prevents the threads from printing in the middle of each other's messages
+_output_lock = threading.Lock()
+# progress whose message ends the last printed line (and that will print "OK" on the same line)
+_open_line: "Progress | None" = None
+
 
 class Progress:
-    """A utility that print a progress message and its confirmation."""
+    """
+    A utility that print a progress message and its confirmation, and records the time spent in the stage.
+
+    The stages are nested per thread. When several threads print progress messages at the same time, each
+    confirmation is printed on the same line as its message if nothing was printed since, or on a new line with a
+    copy of the message otherwise (the messages of the other threads than the main thread start with the thread name).
+    With `quiet=True`, the stage is only recorded.
+    """
 
-    def __init__(self, message: str) -> None:
+    def __init__(self, message: str, quiet: bool = False) -> None:
         """Create a `Progress`."""
         self.message = message
+        self.quiet = quiet
+        thread = threading.current_thread()
+        self.prefix = "" if thread is threading.main_thread() else f"[{thread.name}] "
+        self._start = 0
+        self._cpu = 0
 
     def __enter__(self) -> Self:
         """Print the message for a `Progress`."""
-        print(f"{self.message}... ", end="", flush=True)
+        global _open_line  # noqa: PLW0603
+        tracer.stack().append(self)
+        if not self.quiet:
+            with _output_lock:
+                if _open_line is not None:
+                    # finish the line of the other progress, it will print its message again
+                    print(flush=True)
+                print(f"{self.prefix}{self.message}... ", end="", flush=True)
+                _open_line = self
+        self._start = time.perf_counter_ns()
+        self._cpu = time.process_time_ns()
         return self
 
     def __exit__(self, exc: type[BaseException] | None, value: BaseException | None, tb: TracebackType | None) -> None:
         """Print the error that occurred during a `Progress` or print "OK"."""
-        if exc:
-            print("ERROR: ", end="", flush=True)
-        else:
-            print("OK", flush=True)
+        global _open_line  # noqa: PLW0603
+        wall = time.perf_counter_ns() - self._start
+        cpu = time.process_time_ns() - self._cpu
+        stack = tracer.stack()
+        stack.remove(self)
+        thread = threading.current_thread()
+        tracer.add(
+            Stage(
+                self.message, self._start, wall, cpu, os.getpid(), thread.ident or 0, thread.name, len(stack), bool(exc)
+            )
+        )
+        if self.quiet:
+            return
+
+        with _output_lock:
+            if _open_line is not self:
+                if _open_line is not None:
+                    print(flush=True)
+                print(f"{self.prefix}{self.message}... ", end="", flush=True)
+            # the error is printed after "ERROR: " by the caller
+            print("ERROR: " if exc else "OK", end="" if exc else "\n", flush=True)
+            _open_line = None
+
+
+def _report() -> None:
+    """Write the trace and print the slowest stages, if requested on the command line."""
+    if multiprocessing.parent_process() is not None:
+        # the worker processes send their stages to the main process
+        return
+    if TRACE_FILE:
+        tracer.write_trace(TRACE_FILE)
+        print(f"Trace written to {TRACE_FILE}")
+    if TIMINGS and tracer.stages:
+        print("Slowest stages:")
+        print(tracer.summary())
+
+
+atexit.register(_report)
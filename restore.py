@@ -0,0 +1,46 @@
+"""
+Rebuild the collection from a full backup and the differential backups that followed it.
+
+Usage: `python restore.py FULL_BACKUP.colpkg [DELTA.delta.zip...] [-o OUTPUT.colpkg]`
+"""
+
+import argparse
+import sys
+import tempfile
+from pathlib import Path
+
+from anki.collection import Collection
+
+from delta import restore
+from progress import Progress
+
+
+def main(argv: list[str]) -> int:
+    """Restore the backups given on the command line. Return the exit code."""
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("full_backup", type=Path, help="full backup (.colpkg file)")
+    parser.add_argument("deltas", type=Path, nargs="*", help="differential backups (.delta.zip files), in any order")
+    parser.add_argument(
+        "-o", "--output", type=Path, default=Path("restored.colpkg"), help="restored collection (default: %(default)s)"
+    )
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        try:
+            with Progress(f"Restoring {args.full_backup.name} and {len(args.deltas)} delta(s)"):
+                collection = restore(args.full_backup, args.deltas, Path(tmp))
+        except ValueError as err:
+            print(err)
+            return 1
+
+        with Progress(f"Writing {args.output}"):
+            col = Collection(str(collection))
+            # this also closes the collection
+            col.export_collection_package(str(args.output.absolute()), include_media=True, legacy=False)
+
+    print(f"Import {args.output} in Anki to replace the collection with the restored one.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,243 @@
+"""
+Review statistics of the decks (reviews per day, retention, average interval, time spent), from the review log.
+
+The new reviews are read from a snapshot of the collection in chunks, loaded into NumPy arrays and aggregated by deck
+and by day with vectorised operations. The totals are saved with the newest update sequence number (USN) of the
+reviews, so each run only reads the reviews that were added since the previous run: the ones synced since then have
+a newer USN (even if they were made earlier on another device), and the ones that were not synced yet have the USN
+-1 (their IDs are saved, so they are not counted again when they are synced).
+
+A review counts in the deck its card was in when the review was processed, and the reviews of deleted cards are
+ignored.
+"""
+
+import json
+import tempfile
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from delta import connect
+from utils import DeckStats
+
+if TYPE_CHECKING:
+    import numpy as np
+    from anki.decks import DeckNameId
+
+    from collection_service import CollectionClient
+    from utils import CollectionWrapper
+
+STATS_VERSION = 2
+# number of reviews loaded at once
+CHUNK_SIZE = 200_000
+# number of days of the "recent reviews"
+RECENT_DAYS = 30
+
+# types of the reviews (see `anki.consts`)
+REVLOG_REVIEW = 1
+# answer of the reviews that were not answered (e.g. rescheduled cards)
+EASE_NONE = 0
+EASE_AGAIN = 1
+
+# totals of each deck: reviews, reviews of review cards, passed reviews of review cards, sum and number of the
+# intervals (in days) after a review of a review card, time spent (in milliseconds)
+TOTALS = ("reviews", "graded", "passed", "interval_sum", "interval_count", "time")
+
+
+@dataclass
+class ReviewStats:
+    """Review statistics of a deck (including its subdecks)."""
+
+    # number of reviews
+    reviews: int = 0
+    # number of reviews in the last `RECENT_DAYS` days
+    recent: int = 0
+    # share of the reviews of review cards that were not answered "Again"
+    retention: float | None = None
+    # average interval (in days) after a review of a review card
+    interval: float | None = None
+    # time spent (in seconds)
+    time: float = 0
+
+    @property
+    def per_day(self) -> float:
+        """Average number of reviews per day in the last `RECENT_DAYS` days."""
+        return self.recent / RECENT_DAYS
+
+
+class ReviewAnalytics:
+    """The review statistics of the decks, saved in `cache_file` between the runs."""
+
+    def __init__(self, cache_file: Path) -> None:
+        """Create a `ReviewAnalytics`."""
+        self.cache_file = cache_file
+        # creation time of the collection (the days are counted from it)
+        self.crt = 0
+        # newest USN of the reviews that were processed
+        self.usn = -1
+        # IDs of the reviews that were processed before they were synced (with the USN -1)
+        self.unsynced: list[int] = []
+        # deck ID -> totals (see `TOTALS`)
+        self.totals: dict[int, list[int]] = {}
+        # deck ID -> day -> number of reviews
+        self.days: dict[int, dict[int, int]] = {}
+        self.processed = 0
+        self._load()
+
+    def _load(self) -> None:
+        try:
+            data = json.loads(self.cache_file.read_text("utf-8"))
+        except (OSError, ValueError):
+            return
+        if data.get("version") != STATS_VERSION:
+            return
+        self.crt = data["crt"]
+        self.usn = data["usn"]
+        self.unsynced = data["unsynced"]
+        self.totals = {int(deck_id): totals for deck_id, totals in data["totals"].items()}
+        self.days = {
+            int(deck_id): {int(day): count for day, count in days.items()} for deck_id, days in data["days"].items()
+        }
+
+    def _save(self) -> None:
+        self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.cache_file.with_suffix(".tmp")
+        tmp.write_text(
+            json.dumps({
+                "version": STATS_VERSION,
+                "crt": self.crt,
+                "usn": self.usn,
+                "unsynced": self.unsynced,
+                "totals": self.totals,
+                "days": self.days,
+            }),
+            "utf-8",
+        )
+        tmp.replace(self.cache_file)
+
+    def _reset(self, crt: int) -> None:
+        self.crt = crt
+        self.usn = -1
+        self.unsynced = []
+        self.totals = {}
+        self.days = {}
+
+    def _aggregate(self, chunk: "np.ndarray", card_ids: "np.ndarray", card_decks: "np.ndarray") -> None:  # noqa: PLR0914
+        """Add a chunk of reviews (ID, card ID, answer, interval, time) to the totals."""
+        import numpy as np  # noqa: PLC0415
+
+        self.processed += len(chunk)
+        review_id, card_id, ease, interval, taken, kind = chunk.T
+        # deck of the card of each review
+        position = np.minimum(np.searchsorted(card_ids, card_id), len(card_ids) - 1)
+        keep = (card_ids[position] == card_id) & (ease != EASE_NONE)
+        review_id, ease, interval, taken, kind = (column[keep] for column in (review_id, ease, interval, taken, kind))
+        deck_ids, deck_index = np.unique(card_decks[position[keep]], return_inverse=True)
+
+        graded = kind == REVLOG_REVIEW
+        # the negative intervals are learning steps (in seconds)
+        has_interval = graded & (interval > 0)
+        totals = np.stack(
+            [
+                np.bincount(deck_index, minlength=len(deck_ids)),
+                np.bincount(deck_index, graded, len(deck_ids)),
+                np.bincount(deck_index, graded & (ease != EASE_AGAIN), len(deck_ids)),
+                np.bincount(deck_index, np.where(has_interval, interval, 0), len(deck_ids)),
+                np.bincount(deck_index, has_interval, len(deck_ids)),
+                np.bincount(deck_index, taken, len(deck_ids)),
+            ],
+            axis=1,
+        ).astype(np.int64)
+        for deck_id, deck_totals in zip(deck_ids.tolist(), totals.tolist(), strict=True):
+            self.totals[deck_id] = [
+                a + b for a, b in zip(self.totals.get(deck_id, [0] * len(TOTALS)), deck_totals, strict=True)
+            ]
+
+        # number of reviews of each deck on each day
+        day = (review_id // 1000 - self.crt) // 86400
+        if not len(day):
+            return
+        # a single key for each (deck, day) pair is much faster to group than the pairs
+        first_day = day.min()
+        day_count = day.max() - first_day + 1
+        keys, counts = np.unique(deck_index * day_count + (day - first_day), return_counts=True)
+        indexes, day_numbers = np.divmod(keys, day_count)
+        for index, day_number, count in zip(
+            indexes.tolist(), (day_numbers + first_day).tolist(), counts.tolist(), strict=True
+        ):
+            days = self.days.setdefault(deck_ids[index].item(), {})
+            days[day_number] = days.get(day_number, 0) + count
+
+    def _process(self, snapshot: Path) -> None:
+        """Add the reviews made since the previous run to the totals."""
+        import numpy as np  # noqa: PLC0415
+
+        conn = connect(snapshot)
+        try:
+            crt, newest = conn.execute("select crt, (select coalesce(max(usn), -1) from revlog) from col").fetchone()
+            # another collection, or reviews were removed (e.g. the collection was restored from a backup)
+            if crt != self.crt or newest < self.usn:
+                self._reset(crt)
+
+            # the cards of the filtered decks count in their original deck
+            card_ids, card_decks = (
+                np
+                .array(conn.execute("select id, iif(odid, odid, did) from cards order by id").fetchall(), np.int64)
+                .reshape(-1, 2)
+                .T
+            )
+            if not len(card_ids):
+                return
+            conn.execute("create temp table unsynced (id integer primary key)")
+            conn.executemany("insert into unsynced values (?)", ((review_id,) for review_id in self.unsynced))
+            cursor = conn.execute(
+                "select id, cid, ease, ivl, time, type from revlog "
+                "where (usn > ? or usn = -1) and id not in (select id from unsynced) order by id",
+                (self.usn,),
+            )
+            while rows := cursor.fetchmany(CHUNK_SIZE):
+                self._aggregate(np.array(rows, np.int64), card_ids, card_decks)
+            self.usn = newest
+            self.unsynced = [row[0] for row in conn.execute("select id from revlog where usn = -1 order by id")]
+        finally:
+            conn.close()
+
+    def run(self, wrapper: "CollectionWrapper | CollectionClient") -> None:
+        """Add the reviews made since the previous run to the totals and save them."""
+        with tempfile.TemporaryDirectory() as tmp:
+            self._process(wrapper.snapshot(Path(tmp) / "snapshot.anki2"))
+        self._save()
+
+    def _deck_ids(self, deck: "DeckNameId | None", stats: DeckStats) -> list[int]:
+        if deck is None:
+            return list(self.totals)
+        deck_ids = [deck.id]
+        for child in stats.children(deck):
+            deck_ids += self._deck_ids(child, stats)
+        return deck_ids
+
+    def stats(self, deck: "DeckNameId | None", stats: DeckStats) -> ReviewStats:
+        """Return the review statistics of a deck and its subdecks (or of the whole collection)."""
+        deck_ids = self._deck_ids(deck, stats)
+        totals = [0] * len(TOTALS)
+        for deck_id in deck_ids:
+            totals = [a + b for a, b in zip(totals, self.totals.get(deck_id, [0] * len(TOTALS)), strict=True)]
+        reviews, graded, passed, interval_sum, interval_count, taken = totals
+        first_recent_day = (int(time.time()) - self.crt) // 86400 - RECENT_DAYS + 1
+        return ReviewStats(
+            reviews=reviews,
+            recent=sum(
+                count
+                for deck_id in deck_ids
+                for day, count in self.days.get(deck_id, {}).items()
+                if day >= first_recent_day
+            ),
+            retention=passed / graded if graded else None,
+            interval=interval_sum / interval_count if interval_count else None,
+            time=taken / 1000,
+        )
+
+    def summary(self) -> str:
+        """Return a human readable summary of the last run."""
+        return f"{self.processed} new reviews processed ({sum(totals[0] for totals in self.totals.values())} in total)"
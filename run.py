@@ -0,0 +1,66 @@
+"""
+Open and sync the collection once, then run the chosen tasks against it.
+
+Usage: `python run.py [backup] [notify] [docs] [--no-sync] [options of the tasks...]`
+(all the tasks are run if none is given). The independent tasks are run concurrently.
+"""
+
+import argparse
+import sys
+import threading
+import traceback
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+
+import backup
+import export_and_build_docs
+import notify
+from collection_service import CollectionClient, open_collection
+from progress import Progress
+from utils import CollectionWrapper
+
+TASKS: dict[str, Callable[[CollectionWrapper | CollectionClient], None]] = {
+    "backup": backup.main,
+    "notify": notify.main,
+    "docs": export_and_build_docs.main,
+}
+
+
+def run_task(task: str, wrapper: CollectionWrapper | CollectionClient) -> None:
+    """Run a task in the current thread (its progress messages start with the name of the task)."""
+    threading.current_thread().name = task
+    with Progress(task, quiet=True):
+        TASKS[task](wrapper)
+
+
+def main(argv: list[str]) -> int:
+    """Run the tasks given on the command line. Return the exit code."""
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("tasks", nargs="*", help=f"tasks to run: {', '.join(TASKS)} (default: all)")
+    parser.add_argument("--no-sync", action="store_true", help="don't sync the collection before running the tasks")
+    # the other options are read by the tasks themselves
+    args, _ = parser.parse_known_args(argv)
+    if unknown := [task for task in args.tasks if task not in TASKS]:
+        parser.error(f"unknown tasks: {', '.join(unknown)}")
+    tasks = list(dict.fromkeys(args.tasks)) or list(TASKS)
+
+    # use the collection service if it is running
+    wrapper = open_collection()
+    if not args.no_sync:
+        with Progress("Syncing"):
+            wrapper.sync()
+
+    with ThreadPoolExecutor(len(tasks)) as executor:
+        futures = {task: executor.submit(run_task, task, wrapper) for task in tasks}
+
+    failed = False
+    for task, future in futures.items():
+        if err := future.exception():
+            failed = True
+            print(f"Task {task} failed:", file=sys.stderr)
+            traceback.print_exception(err)
+    return int(failed)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,224 @@
+"""
+Search index of the cards of the published site, read by `docs/js/card-search.js`.
+
+The index is split so the browser only downloads what a query needs:
+- `index.json`: the indexed decks (name and package) and the list of the shards;
+- `decks/DECK_ID.json`: the notes of a deck (ID and snippet), referenced by their position;
+- `shards/PREFIX.json`: the terms that start with `PREFIX` (hex-encoded) and the positions of their notes in each deck.
+
+Each deck is indexed in a streaming pass over a snapshot of the collection, and its terms are saved in a sorted file
+in the cache. The shards are then merged from these files one at a time, so the memory used depends on the biggest
+deck and on the biggest shard, not on the size of the collection. Only the decks that changed are indexed again.
+"""
+
+import heapq
+import html
+import itertools
+import json
+import operator
+import re
+import shutil
+import tempfile
+import unicodedata
+from collections.abc import Iterator
+from pathlib import Path
+from typing import TYPE_CHECKING, Any
+
+from delta import connect
+from utils import DeckStats, write_if_changed
+
+if TYPE_CHECKING:
+    from anki.decks import DeckNameId
+
+    from collection_service import CollectionClient
+    from utils import CollectionWrapper
+
+INDEX_VERSION = 1
+# number of characters of the terms used to choose their shard
+PREFIX_LENGTH = 2
+# shorter terms are not indexed
+MIN_TERM_LENGTH = 2
+# maximum length of the text shown in the results
+SNIPPET_LENGTH = 160
+
+TAG_RE = re.compile(r"<[^>]*>")
+SOUND_RE = re.compile(r"\[sound:[^\]]*\]")
+CLOZE_RE = re.compile(r"\{\{c\d+::(.*?)(?:::[^}]*)?\}\}")
+# the same characters are removed and split by the JavaScript code
+DIACRITICS_RE = re.compile(r"[\u0300-\u036f]")
+TERM_RE = re.compile(r"\w+")
+
+
+def strip_html(text: str) -> str:
+    """Return the text of a field, without HTML, sounds and cloze markers."""
+    text = CLOZE_RE.sub(r"\1", text)
+    text = SOUND_RE.sub(" ", text)
+    text = TAG_RE.sub(" ", text)
+    return " ".join(html.unescape(text).split())
+
+
+def tokenize(text: str) -> set[str]:
+    """Return the terms of a text (lowercase, without accents)."""
+    text = DIACRITICS_RE.sub("", unicodedata.normalize("NFKD", text).lower())
+    return {term for term in TERM_RE.findall(text) if len(term) >= MIN_TERM_LENGTH}
+
+
+def shard_name(term: str) -> str:
+    """Return the name of the shard that contains a term."""
+    return term[:PREFIX_LENGTH].encode().hex()
+
+
+class SearchIndex:
+    """
+    The search index of the site, written in `output_dir`.
+
+    The terms of each deck are saved in `cache_dir` (with a fingerprint of the deck, to know which decks changed).
+    """
+
+    def __init__(self, output_dir: Path, cache_dir: Path) -> None:
+        """Create a `SearchIndex`."""
+        self.output_dir = output_dir
+        self.cache_dir = cache_dir
+        self.manifest_file = cache_dir / "manifest.json"
+        self.indexed = 0
+        self.shards = 0
+
+    def _load_manifest(self) -> dict[str, str]:
+        try:
+            data = json.loads(self.manifest_file.read_text("utf-8"))
+        except (OSError, ValueError):
+            return {}
+        return data["decks"] if data.get("version") == INDEX_VERSION else {}
+
+    def _terms_file(self, deck_id: int) -> Path:
+        return self.cache_dir / f"{deck_id}.jsonl"
+
+    def _notes_file(self, deck_id: int) -> Path:
+        return self.output_dir / "decks" / f"{deck_id}.json"
+
+    def _write_deck(self, deck_id: int, notes: list[list[Any]], terms: dict[str, list[int]]) -> None:
+        """Write the notes of a deck to the site and its terms (sorted by shard and term) to the cache."""
+        write_if_changed(self._notes_file(deck_id), json.dumps(notes, ensure_ascii=False))
+        tmp = self._terms_file(deck_id).with_suffix(".tmp")
+        with tmp.open("w", encoding="utf-8") as f:
+            for term in sorted(terms, key=lambda term: (shard_name(term), term)):
+                f.write(json.dumps([shard_name(term), term, terms[term]], ensure_ascii=False) + "\n")
+        tmp.replace(self._terms_file(deck_id))
+
+    def _index_decks(self, snapshot: Path, deck_ids: list[int]) -> None:
+        """Index the notes of the given decks (the cards of the filtered decks count in their original deck)."""
+        conn = connect(snapshot)
+        try:
+            rows = conn.execute(
+                f"""
+                select iif(c.odid, c.odid, c.did) as deck, n.id, n.flds
+                from cards c join notes n on n.id = c.nid
+                where deck in ({", ".join("?" * len(deck_ids))})
+                group by deck, n.id
+                order by deck, n.id
+                """,  # noqa: S608
+                deck_ids,
+            )
+            for deck_id, deck_rows in itertools.groupby(rows, key=operator.itemgetter(0)):
+                notes: list[list[Any]] = []
+                terms: dict[str, list[int]] = {}
+                for _, note_id, fields in deck_rows:
+                    texts = [strip_html(field) for field in fields.split("\x1f")]
+                    for term in tokenize(" ".join(texts)):
+                        terms.setdefault(term, []).append(len(notes))
+                    notes.append([note_id, " — ".join(text for text in texts if text)[:SNIPPET_LENGTH]])
+                self._write_deck(deck_id, notes, terms)
+                self.indexed += 1
+            # the decks without notes
+            for deck_id in deck_ids:
+                if not self._terms_file(deck_id).exists():
+                    self._write_deck(deck_id, [], {})
+        finally:
+            conn.close()
+
+    def _read_terms(self, deck_id: int) -> Iterator[tuple[str, str, int, list[int]]]:
+        with self._terms_file(deck_id).open(encoding="utf-8") as f:
+            for line in f:
+                shard, term, positions = json.loads(line)
+                yield shard, term, deck_id, positions
+
+    def _write_shards(self, deck_ids: list[int]) -> set[str]:
+        """Merge the terms of all the decks into the shards. Return the names of the shards."""
+        shards_dir = self.output_dir / "shards"
+        names = set()
+        merged = heapq.merge(*(self._read_terms(deck_id) for deck_id in deck_ids), key=operator.itemgetter(0, 1))
+        for shard, items in itertools.groupby(merged, key=operator.itemgetter(0)):
+            content: dict[str, dict[int, list[int]]] = {}
+            for _, term, deck_id, positions in items:
+                content.setdefault(term, {})[deck_id] = positions
+            write_if_changed(shards_dir / f"{shard}.json", json.dumps(content, ensure_ascii=False))
+            names.add(shard)
+
+        for file in shards_dir.glob("*.json"):
+            if file.stem not in names:
+                file.unlink()
+        return names
+
+    def build(
+        self,
+        wrapper: "CollectionWrapper | CollectionClient",
+        decks: list["DeckNameId | None"],
+        stats: DeckStats,
+        packages: dict[int, str],
+    ) -> None:
+        """
+        Index the decks that changed since the previous build and write the index.
+
+        `packages` contains the URL of the package of each deck, relative to the folder of the site.
+        """
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        previous = self._load_manifest()
+        fingerprints = {str(deck.id): stats.fingerprint(deck, INDEX_VERSION) for deck in decks if deck}
+        deck_ids = [deck.id for deck in decks if deck]
+        # a deck is also indexed again if one of its files was removed (e.g. the site was built from scratch)
+        changed = [
+            deck_id
+            for deck_id in deck_ids
+            if previous.get(str(deck_id)) != fingerprints[str(deck_id)]
+            or not self._terms_file(deck_id).exists()
+            or not self._notes_file(deck_id).exists()
+        ]
+
+        if changed:
+            for deck_id in changed:
+                self._terms_file(deck_id).unlink(missing_ok=True)
+            with tempfile.TemporaryDirectory() as tmp:
+                self._index_decks(wrapper.snapshot(Path(tmp) / "snapshot.anki2"), changed)
+
+        # remove the decks that don't exist anymore
+        for file in self.cache_dir.glob("*.jsonl"):
+            if int(file.stem) not in deck_ids:
+                file.unlink()
+                self._notes_file(int(file.stem)).unlink(missing_ok=True)
+
+        shards = self._write_shards(deck_ids)
+        self.shards = len(shards)
+        write_if_changed(
+            self.output_dir / "index.json",
+            json.dumps(
+                {
+                    "version": INDEX_VERSION,
+                    "prefix_length": PREFIX_LENGTH,
+                    "min_term_length": MIN_TERM_LENGTH,
+                    "decks": {deck.id: {"name": deck.name, "package": packages.get(deck.id)} for deck in decks if deck},
+                    "shards": sorted(shards),
+                },
+                ensure_ascii=False,
+            ),
+        )
+        # the manifest is saved last, so the decks are indexed again if the build is interrupted
+        self.manifest_file.write_text(json.dumps({"version": INDEX_VERSION, "decks": fingerprints}), "utf-8")
+
+    def clear(self) -> None:
+        """Remove the index and its cache."""
+        shutil.rmtree(self.output_dir, ignore_errors=True)
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def summary(self) -> str:
+        """Return a human readable summary of the last build."""
+        return f"{self.indexed} decks indexed, {self.shards} shards"
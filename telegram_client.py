@@ -0,0 +1,227 @@
+"""Small client for the Telegram Bot API that reuses its connections and respects the rate limits."""
+
+import http.client
+import json
+import queue
+import threading
+import time
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, TypeVar
+from urllib.parse import urlsplit
+
+T = TypeVar("T")
+
+# errors raised when the server closed an idle connection
+RECONNECT_ERRORS = (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError)
+# status codes that are worth retrying (the server is overloaded or temporarily unavailable)
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class TelegramError(RuntimeError):
+    """An error returned by the Telegram API (the full response is in `data`)."""
+
+    def __init__(self, data: dict[str, Any]) -> None:
+        """Create a `TelegramError` from the response of the Telegram API."""
+        super().__init__(f"Failed to call Telegram API: {data.get('description', 'unknown error')}")
+        self.data = data
+
+
+class TokenBucket:
+    """
+    A rate limiter that allows `rate` calls per second on average, and bursts of up to `capacity` calls.
+
+    The callers that exceed the rate wait for their turn, in the order they called `acquire`.
+    """
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        """Create a full `TokenBucket`."""
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """Take a token, waiting until one is available."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            # the token is reserved even if it isn't available yet, so the next callers wait longer
+            self._tokens -= 1
+            wait = -self._tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+class TelegramClient:
+    """
+    A client for the Telegram Bot API.
+
+    The HTTP connections are kept alive and reused (up to `pool_size` of them, which is also the number of
+    concurrent requests of the batch methods). The calls are rate limited with a token bucket, and the calls that
+    fail because of the rate limits or a temporary server error are retried (after the delay given by Telegram in
+    `retry_after`, if any).
+    """
+
+    def __init__(  # noqa: PLR0913
+        self,
+        token: str,
+        api_url: str = "https://api.telegram.org",
+        *,
+        timeout: float = 10,
+        pool_size: int = 4,
+        rate: float = 30,
+        burst: float = 30,
+        max_retries: int = 3,
+    ) -> None:
+        """Create a `TelegramClient` for the bot `token` (no connection is opened until the first call)."""
+        url = urlsplit(api_url)
+        self.token = token
+        self.scheme = url.scheme
+        self.host = url.netloc
+        self.path = url.path.rstrip("/")
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.rate_limiter = TokenBucket(rate, burst)
+        self._pool: queue.LifoQueue[http.client.HTTPConnection] = queue.LifoQueue(pool_size)
+
+    def _connection(self, new: bool = False) -> http.client.HTTPConnection:
+        """Return an idle connection from the pool (unless `new` is `True`), or a new one."""
+        try:
+            if not new:
+                return self._pool.get_nowait()
+        except queue.Empty:
+            pass
+        connection_class = http.client.HTTPSConnection if self.scheme == "https" else http.client.HTTPConnection
+        return connection_class(self.host, timeout=self.timeout)
+
+    def _release(self, connection: http.client.HTTPConnection) -> None:
+        """Put a connection back into the pool (or close it if the pool is full)."""
+        try:
+            self._pool.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+    def _post(self, method: str, body: bytes, new_connection: bool = False) -> tuple[int, dict[str, Any]]:
+        """
+        Send a request with a connection of the pool. Return the status and the decoded response.
+
+        A response that is not JSON (e.g. an error page of a proxy) is replaced by an error response with its status,
+        so the server errors are retried in the same way.
+        """
+        connection = self._connection(new_connection)
+        try:
+            connection.request(
+                "POST",
+                f"{self.path}/bot{self.token}/{method}",
+                body,
+                {"Content-Type": "application/json", "Connection": "keep-alive"},
+            )
+            response = connection.getresponse()
+            raw = response.read()
+        except RECONNECT_ERRORS:
+            connection.close()
+            if new_connection:
+                raise
+            # the server closed the idle connection: try again with a new one
+            return self._post(method, body, new_connection=True)
+        except BaseException:
+            connection.close()
+            raise
+        self._release(connection)
+        try:
+            data = json.loads(raw)
+        except ValueError:
+            data = {
+                "ok": False,
+                "error_code": response.status,
+                "description": f"{response.status} {response.reason} (the response is not JSON)",
+            }
+        return response.status, data
+
+    def call(self, method: str, params: dict[str, Any]) -> Any:  # noqa: ANN401
+        """
+        Call a method of the Telegram API and return its result.
+
+        Raises:
+            TelegramError: if the call fails (after the retries, if the error is temporary).
+
+        """
+        body = json.dumps(params).encode()
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.acquire()
+            status, data = self._post(method, body)
+            if data.get("ok"):
+                return data["result"]
+            if status not in RETRY_STATUSES or attempt == self.max_retries:
+                break
+            retry_after = data.get("parameters", {}).get("retry_after")
+            time.sleep(retry_after if retry_after is not None else 2**attempt)
+        raise TelegramError(data)
+
+    def send_message(self, chat_id: str, text: str) -> dict[str, Any]:
+        """Send a message to a chat and return it."""
+        return self.call("sendMessage", {"chat_id": chat_id, "text": text})
+
+    def edit_message(self, chat_id: str, message_id: str, text: str) -> bool:
+        """
+        Replace the text of a message.
+
+        Returns:
+            `False` if the message doesn't exist anymore, `True` otherwise.
+
+        Raises:
+            TelegramError: if the call fails and the message to edit exists.
+
+        """
+        try:
+            self.call("editMessageText", {"chat_id": chat_id, "message_id": message_id, "text": text})
+        except TelegramError as e:
+            description = e.data.get("description", "")
+            if "message is not modified" in description:
+                return True
+            if "message to edit not found" in description:
+                return False
+            raise
+        return True
+
+    def delete_message(self, chat_id: str, message_id: str) -> None:
+        """
+        Delete a message.
+
+        Raises:
+            TelegramError: if the call fails and the message to delete exists.
+
+        """
+        try:
+            self.call("deleteMessage", {"chat_id": chat_id, "message_id": message_id})
+        except TelegramError as e:
+            if "message to delete not found" in e.data.get("description", ""):
+                print("Previous message has been deleted, skipping deletion")
+            else:
+                raise
+
+    def for_each_chat(self, func: Callable[[str], T], chat_ids: list[str]) -> dict[str, T | Exception]:
+        """
+        Call `func` for each chat concurrently (with as many threads as connections in the pool).
+
+        Return the result of each chat, or the exception raised for this chat.
+        """
+        with ThreadPoolExecutor(min(self.pool_size, len(chat_ids)) or 1) as executor:
+            futures = {chat_id: executor.submit(func, chat_id) for chat_id in chat_ids}
+        return {chat_id: future.exception() or future.result() for chat_id, future in futures.items()}
+
+    def send_messages(self, chat_ids: list[str], text: str) -> dict[str, dict[str, Any] | Exception]:
+        """Send the same message to several chats. Return the message sent to each chat (or the exception)."""
+        return self.for_each_chat(lambda chat_id: self.send_message(chat_id, text), chat_ids)
+
+    def close(self) -> None:
+        """Close the idle connections."""
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                return
@@ -1,21 +1,31 @@
 """Utility functions to manage Anki flashcards."""
 
+import asyncio
 import datetime as dt
+import hashlib
+import itertools
 import os
 import random
 import re
 import sys
 import threading
 import time
-from collections.abc import Callable
+from collections.abc import Callable, Generator
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
 from functools import wraps
 from pathlib import Path
-from typing import TypeVar
+from typing import TYPE_CHECKING, Any, TypeVar
 from zoneinfo import ZoneInfo
 
-from anki.collection import Collection, DeckIdLimit, ExportAnkiPackageOptions
-from anki.decks import DeckNameId
-from anki.errors import SyncError
+from progress import Progress
+
+# `anki` takes a while to import, so it is only imported when the collection is opened (the clients of the collection
+# service don't need it)
+if TYPE_CHECKING:
+    from anki.collection import Collection
+    from anki.decks import DeckNameId
+    from anki.sync import SyncAuth
 
 
 def sanitize_filename(filename: str) -> str:
@@ -44,171 +54,402 @@ def format_number(number: int) -> str:
     return re.sub(r"(\d\d\d)", r"\1 ", str(number)[::-1])[::-1]
 
 
+def format_duration(seconds: float) -> str:
+    """Return a human formatted duration."""
+    minutes, seconds = divmod(round(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{format_number(hours)} h {minutes:02} min"
+    if minutes:
+        return f"{minutes} min"
+    return f"{seconds} s"
+
+
+def write_if_changed(file: Path, content: str) -> bool:
+    """Write `content` to `file` unless the file already has this content. Return `True` if it was written."""
+    data = content.encode()
+    try:
+        if file.stat().st_size == len(data) and file.read_bytes() == data:
+            return False
+    except OSError:
+        pass
+    file.parent.mkdir(parents=True, exist_ok=True)
+    file.write_bytes(data)
+    return True
+
+
+# package formats: "legacy" packages can be imported by all the versions of Anki, "latest" packages are compressed
+# (smaller and faster to write) but need Anki 2.1.50+ or AnkiDroid 2.16+
+EXPORT_FORMATS = ("legacy", "latest")
+
+
+def export_format_flag(name: str, default: str = "legacy") -> str:
+    """
+    Return the package format given on the command line with `--NAME=legacy|latest` (or `default`).
+
+    Raises:
+        ValueError: if the format is unknown.
+
+    """
+    value = next((arg.removeprefix(f"--{name}=") for arg in sys.argv if arg.startswith(f"--{name}=")), default)
+    if value not in EXPORT_FORMATS:
+        msg = f"Unknown format for --{name}: {value!r} (expected one of: {', '.join(EXPORT_FORMATS)})"
+        raise ValueError(msg)
+    return value
+
+
 FunctionT = TypeVar("FunctionT", bound=Callable)
+T = TypeVar("T")
 
 
-def run_in_thread(func: FunctionT) -> FunctionT:
-    """Run a function in a thread."""
+def on_collection_thread(func: FunctionT) -> FunctionT:
+    """Run a method of `CollectionWrapper` in the thread that owns the collection and wait for its result."""
 
     @wraps(func)
-    def decorator(*args, **kwargs):  # noqa: ANN002, ANN003, ANN202
-        val = None
+    def decorator(self: "CollectionWrapper", *args, **kwargs):  # noqa: ANN002, ANN003, ANN202
+        return self.submit(func, self, *args, **kwargs).result()
 
-        def thread_func(*args, **kwargs):  # noqa: ANN002, ANN003, ANN202
-            nonlocal val
-            val = func(*args, **kwargs)
+    return decorator
 
-        thread = threading.Thread(target=thread_func, args=args, kwargs=kwargs)
 
-        exc: BaseException | None = None
+class DeckStats:
+    """
+    Statistics of all the decks (modification time, card count, children and fingerprint).
+
+    They are computed with a single grouped query over the cards, then rolled up the `::` hierarchy in memory,
+    so getting the statistics of every deck costs O(cards + decks) instead of one query per deck.
+    A card counts in its deck, in its original deck (if it is in a filtered deck) and in all their parents.
+    """
+
+    def __init__(self, col: "Collection") -> None:
+        """Load the deck tree and the card statistics of `col`."""
+        decks = col.decks.all_names_and_ids(include_filtered=True)
+        ids_by_name = {deck.name: deck.id for deck in decks}
+
+        self._children: dict[int, list[DeckNameId]] = {deck.id: [] for deck in decks}
+        self._parents: dict[int, int] = {}
+        # the deck itself and all its parents
+        lineage: dict[int, set[int]] = {}
+        for deck in decks:
+            parts = deck.name.split("::")
+            lineage[deck.id] = {
+                ids_by_name[name] for i in range(1, len(parts) + 1) if (name := "::".join(parts[:i])) in ids_by_name
+            }
+            parent = ids_by_name.get("::".join(parts[:-1]))
+            if parent is not None:
+                self._children[parent].append(deck)
+                self._parents[deck.id] = parent
+
+        # count, newest card mod, sum of card mods, sum of card IDs, newest note mod, sum of note mods
+        # (the key `None` is the whole collection)
+        self._stats: dict[int | None, list[float]] = {}
+        for did, odid, *row in col.db.all(
+            "select c.did, c.odid, count(), max(c.mod), total(c.mod), total(c.id), max(n.mod), total(n.mod) "
+            "from cards c join notes n on n.id = c.nid group by c.did, c.odid"
+        ):
+            for target in (None, *(lineage.get(did, set()) | lineage.get(odid, set()))):
+                stats = self._stats.setdefault(target, [0, 0, 0, 0, 0, 0])
+                stats[0] += row[0]
+                stats[1] = max(stats[1], row[1])
+                stats[2] += row[2]
+                stats[3] += row[3]
+                stats[4] = max(stats[4], row[4])
+                stats[5] += row[5]
+
+        self._notetypes = col.db.first("select count(), max(mtime_secs) from notetypes")
+
+    def _get(self, deck: "DeckNameId | None") -> list[float]:
+        return self._stats.get(deck.id if deck else None, [0, 0, 0, 0, 0, 0])
+
+    def modtime(self, deck: "DeckNameId | None") -> dt.datetime | None:
+        """Return the modification time of the deck (the newest modification time of its cards)."""
+        mod = self._get(deck)[1]
+        return dt.datetime.fromtimestamp(mod, dt.UTC) if mod else None
+
+    def card_count(self, deck: "DeckNameId | None") -> int:
+        """Return the number of cards in the deck (including its subdecks)."""
+        return int(self._get(deck)[0])
+
+    def children(self, deck: "DeckNameId") -> "list[DeckNameId]":
+        """Return the direct children of the deck."""
+        return self._children.get(deck.id, [])
+
+    def has_children(self, deck: "DeckNameId") -> bool:
+        """Return `True` if the deck has children decks."""
+        return bool(self.children(deck))
 
-        def invoke_excepthook(_thread: threading.Thread) -> None:
-            nonlocal exc
-            exc = sys.exc_info()[1]
+    def is_child(self, deck: "DeckNameId") -> bool:
+        """Return `True` if the deck is a child deck."""
+        return deck.id in self._parents
 
-        thread._invoke_excepthook = invoke_excepthook  # noqa: SLF001
-        thread.start()
-        thread.join()
-        if exc:
-            raise exc
-        return val
+    def fingerprint(self, deck: "DeckNameId | None", *options: object) -> str:
+        """
+        Return a fingerprint of everything that ends up in the exported package of the deck.
 
-    return decorator
+        The fingerprint changes when a card or a note of the deck (or of its subdecks) is added, modified,
+        moved or deleted, when a note type is modified or when the export `options` change. Media changes are
+        tracked separately (see `CollectionWrapper.media_fingerprint`).
+        """
+        return hashlib.sha256(
+            repr((deck.name if deck else None, self._get(deck), self._notetypes, options)).encode()
+        ).hexdigest()
 
 
 collection_dir = Path(__file__).parent / "collection"
 collection_dir.mkdir(exist_ok=True)
 
+cache_dir = Path(__file__).parent / ".cache"
+
+# first delay (in seconds) before retrying a sync, doubled on each attempt
+SYNC_BASE_DELAY = 2
+
 
 class CollectionWrapper:
-    """A wrapper to use `anki.collection.Collection`."""
+    """
+    A wrapper to use `anki.collection.Collection`.
+
+    The collection is bound to a single long-lived worker thread: every call to the collection is queued to that
+    thread. The methods block until their result is available, but `submit` (which returns a future) and `run`
+    (which can be awaited) can be used to queue several calls without waiting for each of them.
+    """
 
-    @run_in_thread
     def __init__(
         self,
         file: Path = collection_dir / "collection.anki2",
         email: str = os.environ.get("ANKIWEB_EMAIL", ""),
         password: str = os.environ.get("ANKIWEB_PASSWORD", ""),
+        endpoint: str | None = os.environ.get("ANKIWEB_ENDPOINT") or None,
     ) -> None:
-        """Create a `Collection`."""
-        self.col = Collection(str(Path(file).absolute()))
+        """
+        Create a `Collection`.
+
+        `endpoint` can be set to sync with another server than AnkiWeb (e.g. a self-hosted or local sync server).
+        """
+        self._thread_id: int | None = None
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="collection", initializer=self._bind_thread
+        )
+        from anki.collection import Collection  # noqa: PLC0415
+
+        self.col: Collection = self.submit(Collection, str(Path(file).absolute())).result()
         self.email = email
         self.password = password
-
-    @run_in_thread
-    def sync(self) -> None:
+        self.endpoint = endpoint
+        self._auth: SyncAuth | None = None
+        # duration of each phase of the last sync (in seconds)
+        self.sync_timings: dict[str, float] = {}
+
+    def _bind_thread(self) -> None:
+        self._thread_id = threading.get_ident()
+
+    def submit(self, func: Callable[..., T], *args, **kwargs) -> Future[T]:  # noqa: ANN002, ANN003
+        """Queue a call to `func` in the thread that owns the collection and return its future."""
+        if threading.get_ident() == self._thread_id:
+            # already in the collection thread: waiting for the queue would deadlock
+            future: Future[T] = Future()
+            try:
+                future.set_result(func(*args, **kwargs))
+            except BaseException as err:  # noqa: BLE001
+                future.set_exception(err)
+            return future
+        return self._executor.submit(func, *args, **kwargs)
+
+    async def run(self, func: Callable[..., T], *args, **kwargs) -> T:  # noqa: ANN002, ANN003
+        """Call `func` in the thread that owns the collection without blocking the event loop."""
+        return await asyncio.wrap_future(self.submit(func, *args, **kwargs))
+
+    def close(self) -> None:
+        """Close the collection and stop its thread."""
+        self.submit(self.col.close).result()
+        self._executor.shutdown()
+
+    @contextmanager
+    def _timed(self, phase: str) -> Generator[None]:
+        """Add the time spent in the block to the duration of a sync phase (and record it as a stage)."""
+        start = time.perf_counter()
+        try:
+            with Progress(f"Sync: {phase}", quiet=True):
+                yield
+        finally:
+            self.sync_timings[phase] = self.sync_timings.get(phase, 0) + time.perf_counter() - start
+
+    def _sync_once(self) -> None:
+        """Make a single sync attempt."""
+        if self._auth is None:
+            with self._timed("login"):
+                self._auth = self.submit(
+                    self.col.sync_login, self.email, self.password, endpoint=self.endpoint
+                ).result()
+
+        # cheap check to skip the sync if nothing changed
+        with self._timed("status"):
+            status = self.submit(self.col.sync_status, self._auth).result()
+        if status.new_endpoint:
+            self._auth.endpoint = status.new_endpoint
+        if status.required == status.NO_CHANGES:
+            return
+
+        with self._timed("sync"):
+            output = self.submit(self.col.sync_collection, self._auth, True).result()
+
+        # https://github.com/ankitects/anki/blob/a515463/qt/aqt/sync.py#L93
+        if output.new_endpoint:
+            self._auth.endpoint = output.new_endpoint
+
+        if output.server_message:
+            print(output.server_message, file=sys.stderr)
+            return
+
+        if output.required in {output.FULL_SYNC, output.FULL_DOWNLOAD, output.FULL_UPLOAD}:
+            with self._timed("full_download"):
+                self.submit(
+                    self.col.full_upload_or_download,
+                    auth=self._auth,
+                    server_usn=output.server_media_usn,
+                    upload=False,
+                ).result()
+
+    def sync(self, deadline: float = 600, max_delay: float = 60) -> None:
         """
         Sync the flashcards.
 
+        The login is reused between calls, and a cheap status check skips the sync if nothing changed.
+        If the server asks to try again later (e.g. because several programs are syncing the same account at the
+        same time), the sync is retried with a capped exponential backoff and random jitter, until `deadline`
+        seconds have passed. The time spent in each phase is saved in `sync_timings`.
+
         Raises:
             ValueError: if the email or password is not provided.
-            SyncError: if an error occurs during sync.
+            SyncError: if an error occurs during sync (or if the server still asks to try again at the deadline).
 
         """
         if not self.email and not self.password:
             msg = "Email and password not provided"
             raise ValueError(msg)
-        endpoint = None
-
-        # Retry if multiple programs are connecting to the same account in the same time
-        while True:
-            try:
-                auth = self.col.sync_login(self.email, self.password, endpoint=endpoint)
-                output = self.col.sync_collection(auth, True)
-                status = self.col.sync_status(auth)
 
-                # https://github.com/ankitects/anki/blob/a515463/qt/aqt/sync.py#L93
-                if output.new_endpoint:
-                    endpoint = output.new_endpoint
+        from anki.errors import SyncError, SyncErrorKind  # noqa: PLC0415
 
-                if output.server_message:
-                    print(output.server_message, file=sys.stderr)
-                    return
-
-                if status.required == status.NO_CHANGES:
-                    return
-
-                auth = self.col.sync_login(self.email, self.password, endpoint=endpoint)
-                self.col.full_upload_or_download(
-                    auth=auth, server_usn=getattr(output, "server_media_usn", None), upload=False
-                )
+        self.sync_timings = {}
+        start = time.monotonic()
+        for attempt in itertools.count():
+            try:
+                self._sync_once()
             except SyncError as err:
-                if "try again" in str(err).lower():
-                    seconds = random.randint(0, 30)  # noqa: S311
-                    print(f"{type(err).__name__}: {err}")
-                    print(f"Too many connections, retrying in {seconds} seconds...")
-                    time.sleep(seconds)
+                if err.kind == SyncErrorKind.AUTH and self._auth is not None and attempt == 0:
+                    # the saved login may have expired
+                    self._auth = None
                     continue
-                raise
-            break
+                if "try again" not in str(err).lower():
+                    raise
+                # "full jitter": spread the programs that failed at the same time
+                seconds = random.uniform(0, min(max_delay, SYNC_BASE_DELAY * 2**attempt))  # noqa: S311
+                if time.monotonic() - start + seconds > deadline:
+                    raise
+                print(f"{type(err).__name__}: {err}")
+                print(f"Too many connections, retrying in {seconds:.1f} seconds...")
+                with self._timed("wait"):
+                    time.sleep(seconds)
+            else:
+                return
 
-    def all_decks(self) -> list[DeckNameId | None]:
+    @on_collection_thread
+    def all_decks(self) -> "list[DeckNameId | None]":
         """Return all the available decks (only name and ID)."""
-        return [
-            None,
-            *run_in_thread(self.col.decks.all_names_and_ids)(skip_empty_default=True, include_filtered=False),
-        ]
+        return [None, *self.col.decks.all_names_and_ids(skip_empty_default=True, include_filtered=False)]
 
-    def has_children(self, deck: DeckNameId) -> bool:
+    @on_collection_thread
+    def has_children(self, deck: "DeckNameId") -> bool:
         """Return `True` if the deck has children decks."""
-        return bool(run_in_thread(self.col.decks.children)(deck.id))
+        return bool(self.col.decks.children(deck.id))
 
-    def is_child(self, deck: DeckNameId) -> bool:
+    @on_collection_thread
+    def is_child(self, deck: "DeckNameId") -> bool:
         """Return `True` if the deck is a child deck."""
-        return bool(run_in_thread(self.col.decks.parents)(deck.id))
-
-    @run_in_thread
-    def modtime(self, deck: DeckNameId | None) -> dt.datetime | None:
-        """Return the modification time of the deck."""
-        ret = (
-            self.col.db.scalar(
-                "select mod from cards where did = ? or odid = ? order by mod desc limit 1", deck.id, deck.id
-            )
-            if deck
-            else self.col.db.scalar("select mod from cards order by mod desc limit 1")
-        )
-        ret = dt.datetime.fromtimestamp(ret, dt.UTC) if ret else None
-        rets: list[dt.datetime | None] = [ret]
-        # recursively check for the largest modification time
-        if deck and self.has_children(deck):
-            rets.extend(
-                self.modtime(DeckNameId(name=child[0], id=child[1]))
-                for child in run_in_thread(self.col.decks.children)(deck.id)
-            )
-
-        rets2: list[dt.datetime] = [ret for ret in rets if ret]
-        if not rets2:
-            return None
-        return max(rets2)
-
-    @run_in_thread
-    def card_count(self, deck: DeckNameId | None) -> int:
-        """Return the number of cards in the deck."""
-        return (
-            self.col.decks.card_count(deck.id, include_subdecks=True)
-            if deck
-            else self.col.db.scalar("select count() from cards")
-        )
+        return bool(self.col.decks.parents(deck.id))
+
+    @on_collection_thread
+    def deck_stats(self) -> DeckStats:
+        """Return the statistics of all the decks (see `DeckStats`)."""
+        return DeckStats(self.col)
+
+    def modtime(self, deck: "DeckNameId | None") -> dt.datetime | None:
+        """
+        Return the modification time of the deck.
+
+        Use `deck_stats` instead when this is needed for many decks.
+        """
+        return self.deck_stats().modtime(deck)
+
+    def card_count(self, deck: "DeckNameId | None") -> int:
+        """
+        Return the number of cards in the deck.
+
+        Use `deck_stats` instead when this is needed for many decks.
+        """
+        return self.deck_stats().card_count(deck)
+
+    @on_collection_thread
+    def media_dir(self) -> Path:
+        """Return the absolute path of the media folder."""
+        return Path(self.col.media.dir()).absolute()
+
+    @on_collection_thread
+    def media_fingerprint(self) -> str:
+        """Return a fingerprint of the media folder (names, sizes and modification times)."""
+        digest = hashlib.sha256()
+        with os.scandir(self.col.media.dir()) as entries:
+            for entry in sorted(entries, key=lambda entry: entry.name):
+                stat = entry.stat()
+                digest.update(f"{entry.name}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode())
+        return digest.hexdigest()
+
+    @on_collection_thread
+    def snapshot(self, file: Path) -> Path:
+        """Write a consistent copy of the collection (without the media) to `file` and return its path."""
+        file.unlink(missing_ok=True)
+        self.col.db.execute("vacuum into ?", str(Path(file).absolute()))
+        return file
+
+    @on_collection_thread
+    def preview_cards(self, deck: "DeckNameId | None", limit: int) -> dict[str, Any]:
+        """Return the first `limit` cards of a deck, rendered, with their note types (see `preview.render_cards`)."""
+        from preview import render_cards  # noqa: PLC0415
+
+        return render_cards(self.col, deck, limit)
 
     @staticmethod
-    def get_export_file(deck: DeckNameId | None, output_dir: str | Path) -> Path:
+    def get_export_file(deck: "DeckNameId | None", output_dir: str | Path) -> Path:
         """Return the path where the deck will be been exported."""
         filename = sanitize_filename(deck.name) if deck else "all"
         return Path(output_dir) / f"{filename}.apkg"
 
-    def export(self, deck: DeckNameId | None, output_dir: str | Path, full_backup: bool = False) -> Path:
-        """Export a deck in a directory. Return the path where the deck has been exported."""
+    @on_collection_thread
+    def export(
+        self,
+        deck: "DeckNameId | None",
+        output_dir: str | Path,
+        full_backup: bool = False,
+        with_media: bool = True,
+        legacy: bool = True,
+    ) -> Path:
+        """
+        Export a deck in a directory. Return the path where the deck has been exported.
+
+        With `legacy=False`, the package is written in the latest format (see `EXPORT_FORMATS`).
+        """
+        from anki.collection import DeckIdLimit, ExportAnkiPackageOptions  # noqa: PLC0415
+
         output = self.get_export_file(deck, output_dir)
 
         limit = DeckIdLimit(deck.id) if deck else None
-        run_in_thread(self.col.export_anki_package)(
+        self.col.export_anki_package(
             out_path=str(output.absolute()),
             limit=limit,
             options=ExportAnkiPackageOptions(
                 with_scheduling=full_backup,
                 with_deck_configs=full_backup,
-                with_media=True,
-                legacy=True,
+                with_media=with_media,
+                legacy=legacy,
             ),
         )
         return output